@@ -1,20 +1,54 @@
 # batch_numeric.py 
 
 import os
+import call_policy
+import image_asset
+import image_dedup
+import image_preprocess
+import pipeline_metrics
+import run_manifest
 import vlm_numeric
+import vlm_cache
+import watch_folder
 import pnn_model
 import gemma_report
-import base64
+import model_routing
+import ollama_pool
+import argparse
+import asyncio
+import collections
 import re
+import report_index
+import signal
+import textwrap
+import time
 
 IMAGE_DIR = 'images'
 OUTPUT_DIR = 'out'
+SUPPORTED_FORMATS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+# 非同步模式下「每台主機」同時處理的請求數，預設對齊伺服器的 OLLAMA_NUM_PARALLEL；
+# 總並行上限為此值乘上 ollama_pool 中的主機數
+DEFAULT_CONCURRENCY = int(os.environ.get('OLLAMA_NUM_PARALLEL', '4'))
+
+# 單次執行的計數器 (於每次 run 開始時歸零)，供結尾摘要使用
+RUN_STATS = collections.Counter()
+
+# 以串流方式生成報告：模型每產出一行就寫進 <報告>.partial.html，完成後再換上正式報告
+STREAM_REPORTS = False
+
+# 報告頁面版面："inline" 將原圖以 base64 內嵌、樣式寫在每份報告內 (單檔可攜)；
+# "compact" 改放縮圖並連結原圖、共用一份樣式表，並產生批次索引 index.html
+HTML_LAYOUTS = ("inline", "compact")
+HTML_LAYOUT = "inline"
+THUMBNAIL_SUBDIR = 'thumbs'
+THUMBNAIL_MAX_SIDE = 480
+STYLESHEET_NAME = 'report.css'
 
 # --- 輔助函式 (不變) ---
 def image_to_base64(image_path):
-    """讀取圖片檔並回傳 Base64 編碼的字串"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    """讀取圖片檔並回傳 Base64 編碼的字串 (image_path 可為路徑或 ImageAsset)"""
+    return image_asset.as_asset(image_path).b64
 
 def text_to_html(text_content):
     """將 Gemma 產出的純文字 (類-Markdown) 轉換為基礎 HTML"""
@@ -25,139 +59,1006 @@ def text_to_html(text_content):
     # 轉換換行
     html_content = html_content.replace('\n', '<br>\n')
     return f'<div class="report-text">{html_content}</div>'
+
+def _line_to_html(line):
+    """text_to_html 的逐行版本，供串流寫入時轉換已完整收到的一行"""
+    line = line.replace("**", "")
+    line = re.sub(r'^\s*###\s*(.*?)\s*###\s*$', r'<h3>\1</h3>', line)
+    line = re.sub(r'^\s*(一、|二、|三、|四、|五、|六、)\s*(.*)\s*$', r'<h4>\1 \2</h4>', line)
+    return line + '<br>\n'
 # --- 輔助函式結束 ---
 
-def process_all_images():
+def collect_image_paths():
+    """
+    遞迴收集 IMAGE_DIR 中所有支援格式的圖片。
+    目錄與檔名皆排序，確保每次執行的處理順序一致。
+    """
     if not os.path.exists(IMAGE_DIR):
         os.makedirs(IMAGE_DIR)
         print(f"已建立 '{IMAGE_DIR}' 資料夾。請將待測圖片放入此處。")
-        return
+        return []
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
 
-    supported_formats = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
     image_paths_to_process = [] 
     
     for dirpath, dirnames, filenames in os.walk(IMAGE_DIR):
-        for filename in filenames:
-            if filename.lower().endswith(supported_formats):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(SUPPORTED_FORMATS):
                 full_path = os.path.join(dirpath, filename)
                 image_paths_to_process.append(full_path)
 
     if not image_paths_to_process:
         print(f"在 '{IMAGE_DIR}' 資料夾及其子資料夾中未找到任何圖片。")
-        return
+    return image_paths_to_process
 
-    print(f"找到 {len(image_paths_to_process)} 張圖片，開始處理...")
+def report_path_for(image_path):
+    """由圖片相對路徑產生唯一的報告檔名 (子資料夾以底線串接)"""
+    relative_path = os.path.relpath(image_path, IMAGE_DIR)
+    base_name_with_subdir = os.path.splitext(relative_path)[0]
+    unique_report_name = base_name_with_subdir.replace(os.sep, '_')
+    report_filename = f"{unique_report_name}_report.html"
+    return os.path.join(OUTPUT_DIR, report_filename)
 
-    for image_path in image_paths_to_process:
-        
-        filename = os.path.basename(image_path)
-        
-        print(f"\n{'='*50}")
-        print(f"處理中: {image_path}") 
-        print(f"{'='*50}")
-        
-        # 步驟 1: VLM 提取特徵 (不變)
-        features = vlm_numeric.get_features_from_vlm(image_path)
-        
-        if features is None:
-            print(f"無法從 {filename} 提取特徵，跳過此圖片。")
-            continue
-            
-        # 步驟 2: PNN 進行分類 (不變)
-        frontend_eye_toggle = 1.0     
-        frontend_nose_toggle = 1.0    
-        frontend_clothes_toggle = 1.0 
-        
+def classify(features):
+    """步驟 2: PNN 進行分類 (不變)"""
+    frontend_eye_toggle = 1.0     
+    frontend_nose_toggle = 1.0    
+    frontend_clothes_toggle = 1.0 
+    
+    with pipeline_metrics.stage('pnn'):
         classification_result = pnn_model.classify_breed(
             features, 
             eye_toggle=frontend_eye_toggle, 
             nose_toggle=frontend_nose_toggle, 
             clothes_toggle=frontend_clothes_toggle
         )
-        print(f"PNN 分類結果: {classification_result}")
-        
-        # 步驟 3: Gemma 生成報告
-        final_report_text_raw = gemma_report.generate_gemma_report(
-            image_filename=filename, 
-            features=features, 
-            classification_result=classification_result, 
-            image_path=image_path 
-        )
-        
-        # --- 1. 關鍵修改：在這裡清理 Gemma 的輸出 ---
-        # 移除所有 `**` 符號，防止它們破壞 HTML 轉換
-        final_report_text = final_report_text_raw.replace("**", "")
-        # --- 結束修改 ---
-        
-        # 步驟 4: 格式化與打包
-        # 現在傳入的是清理過的 `final_report_text`
-        report_html_body = text_to_html(final_report_text)
-        
-        try:
-            b64_image = image_to_base64(image_path) 
-            image_html = f'<img src="data:image/jpeg;base64,{b64_image}" alt="{filename}" style="max-width: 100%; height: auto; border-radius: 10px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);">'
-        except Exception as e:
-            print(f"錯誤：無法編碼圖片 {filename}。錯誤：{e}")
-            image_html = f"<p>無法載入圖片: {filename}</p>"
-
-        # (報告命名邏輯不變)
-        relative_path = os.path.relpath(image_path, IMAGE_DIR)
-        base_name_with_subdir = os.path.splitext(relative_path)[0]
-        unique_report_name = base_name_with_subdir.replace(os.sep, '_')
-        report_filename = f"{unique_report_name}_report.html"
-        report_path = os.path.join(OUTPUT_DIR, report_filename)
-        
-        # (HTML 模板和儲存邏輯不變)
-        final_html_content = f"""
-        <!DOCTYPE html>
-        <html lang="zh-Hant">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>分析報告: {filename}</title>
-            <style>
-                body {{ font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; line-height: 1.6; background-color: #f4f7f6; color: #333; margin: 0; padding: 20px; }}
-                .container {{ max-width: 900px; margin: 20px auto; background: #ffffff; border-radius: 10px; box-shadow: 0 4px 12px rgba(0,0,0,0.05); overflow: hidden; }}
-                .header {{ background-color: #0056b3; color: white; padding: 20px 30px; }}
-                .header h1 {{ margin: 0; font-size: 24px; }}
-                .content {{ display: flex; flex-wrap: wrap; padding: 30px; }}
-                .image-column {{ flex: 1; min-width: 300px; padding-right: 30px; box-sizing: border-box; }}
-                .report-column {{ flex: 1.5; min-width: 400px; box-sizing: border-box; }}
-                .report-text h3 {{ color: #0056b3; border-bottom: 2px solid #0056b3; padding-bottom: 5px; margin-top: 0; }}
-                .report-text h4 {{ color: #333; margin-top: 20px; margin-bottom: 10px; }}
-                .report-text br {{ content: " "; display: block; margin: 10px 0; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>犬隻品種分析報告</h1>
+    print(f"PNN 分類結果: {classification_result}")
+    pipeline_metrics.set_result(breed=classification_result.get('breed'),
+                                status=classification_result.get('status'))
+    return classification_result
+
+def write_report(image_path, final_report_text_raw):
+    """步驟 4: 將 Gemma 報告格式化為 HTML 並儲存，回傳報告路徑 (image_path 可為路徑或 ImageAsset)"""
+    with pipeline_metrics.stage('html'):
+        return _write_report_html(image_path, final_report_text_raw)
+
+# 報告頁面模板中報告內文的位置 (串流寫入時以此切成前後兩段)
+_BODY_MARKER = "\0report-body\0"
+
+# 報告頁面的樣式 (inline 版面內嵌於每份報告，compact 版面寫成共用樣式表)
+REPORT_CSS = """\
+            body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; line-height: 1.6; background-color: #f4f7f6; color: #333; margin: 0; padding: 20px; }
+            .container { max-width: 900px; margin: 20px auto; background: #ffffff; border-radius: 10px; box-shadow: 0 4px 12px rgba(0,0,0,0.05); overflow: hidden; }
+            .header { background-color: #0056b3; color: white; padding: 20px 30px; }
+            .header h1 { margin: 0; font-size: 24px; }
+            .content { display: flex; flex-wrap: wrap; padding: 30px; }
+            .image-column { flex: 1; min-width: 300px; padding-right: 30px; box-sizing: border-box; }
+            .report-column { flex: 1.5; min-width: 400px; box-sizing: border-box; }
+            .report-text h3 { color: #0056b3; border-bottom: 2px solid #0056b3; padding-bottom: 5px; margin-top: 0; }
+            .report-text h4 { color: #333; margin-top: 20px; margin-bottom: 10px; }
+            .report-text br { content: " "; display: block; margin: 10px 0; }
+"""
+_IMAGE_STYLE = "max-width: 100%; height: auto; border-radius: 10px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);"
+
+# --- 精簡輸出 (縮圖、共用樣式表、批次索引) ---
+def thumbnail_path_for(image_path):
+    """與報告同名的縮圖路徑 (OUTPUT_DIR/thumbs/<報告名稱>.jpg)"""
+    report_name = os.path.basename(report_path_for(image_path))[:-len("_report.html")]
+    return os.path.join(OUTPUT_DIR, THUMBNAIL_SUBDIR, f"{report_name}.jpg")
+
+def _write_thumbnail(asset):
+    """寫出縮圖並回傳其路徑；無法產生縮圖時回傳 None (頁面改為直接顯示原圖)"""
+    thumbnail = image_preprocess.make_thumbnail(asset.data, THUMBNAIL_MAX_SIDE)
+    if thumbnail is None:
+        return None
+    path = thumbnail_path_for(asset.path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(thumbnail)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+def write_stylesheet():
+    """寫出 compact 版面共用的樣式表 (報告頁與索引頁)，內容未變時不重寫"""
+    path = os.path.join(OUTPUT_DIR, STYLESHEET_NAME)
+    content = textwrap.dedent(REPORT_CSS) + report_index.INDEX_CSS
+    try:
+        with open(path, encoding='utf-8') as f:
+            if f.read() == content:
+                return path
+    except OSError:
+        pass
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    _write_atomic(path, content)
+    return path
+
+def write_index(manifest):
+    """compact 版面：依 manifest 重寫批次索引 OUTPUT_DIR/index.html"""
+    if HTML_LAYOUT != "compact":
+        return None
+    write_stylesheet()
+    path, rows = report_index.write_index(manifest, OUTPUT_DIR, thumbnail_path_for, STYLESHEET_NAME)
+    print(f"批次索引已更新: {path} ({rows} 份報告)")
+    return path
+
+def _image_html(asset):
+    filename = asset.filename
+    if HTML_LAYOUT == "compact":
+        # 頁面只放縮圖，點擊後開啟原圖
+        original = report_index.href(asset.path, OUTPUT_DIR)
+        thumbnail = _write_thumbnail(asset)
+        src = report_index.href(thumbnail, OUTPUT_DIR) if thumbnail else original
+        return f'<a href="{original}"><img src="{src}" alt="{filename}" style="{_IMAGE_STYLE}"></a>'
+    try:
+        b64_image = asset.b64
+        return f'<img src="data:image/jpeg;base64,{b64_image}" alt="{filename}" style="{_IMAGE_STYLE}">'
+    except Exception as e:
+        print(f"錯誤：無法編碼圖片 {filename}。錯誤：{e}")
+        return f"<p>無法載入圖片: {filename}</p>"
+
+def _report_page(asset):
+    """回傳報告頁面在報告內文之前與之後的兩段 HTML"""
+    filename = asset.filename
+    image_html = _image_html(asset)
+    if HTML_LAYOUT == "compact":
+        styles = f'<link rel="stylesheet" href="{STYLESHEET_NAME}">'
+    else:
+        styles = f"<style>\n{REPORT_CSS}        </style>"
+
+    # (HTML 模板和儲存邏輯不變)
+    page = f"""
+    <!DOCTYPE html>
+    <html lang="zh-Hant">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>分析報告: {filename}</title>
+        {styles}
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>犬隻品種分析報告</h1>
+            </div>
+            <div class="content">
+                <div class="image-column">
+                    <h2>分析照片:</h2>
+                    <p>{filename}</p>
+                    {image_html}
                 </div>
-                <div class="content">
-                    <div class="image-column">
-                        <h2>分析照片:</h2>
-                        <p>{filename}</p>
-                        {image_html}
-                    </div>
-                    <div class="report-column">
-                        {report_html_body}
-                    </div>
+                <div class="report-column">
+                    {_BODY_MARKER}
                 </div>
             </div>
-        </body>
-        </html>
-        """
+        </div>
+    </body>
+    </html>
+    """
+    head, _, tail = page.partition(_BODY_MARKER)
+    return head, tail
+
+def _partial_path(report_path):
+    root, ext = os.path.splitext(report_path)
+    return f"{root}.partial{ext}"
+
+def _write_atomic(path, content):
+    """先寫到暫存檔再以 os.replace 換上，讀者不會看到寫到一半的報告"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def _write_report_html(image_path, final_report_text_raw):
+    asset = image_asset.as_asset(image_path)
+
+    # --- 1. 關鍵修改：在這裡清理 Gemma 的輸出 ---
+    # 移除所有 `**` 符號，防止它們破壞 HTML 轉換
+    final_report_text = final_report_text_raw.replace("**", "")
+    # --- 結束修改 ---
+    
+    # 現在傳入的是清理過的 `final_report_text`
+    report_html_body = text_to_html(final_report_text)
+    head, tail = _report_page(asset)
+
+    # (報告命名邏輯不變)
+    report_path = report_path_for(asset.path)
+    _write_atomic(report_path, head + report_html_body + tail)
+    pipeline_metrics.mark_first_content()
+        
+    print(f"HTML 報告已儲存至: {report_path}")
+    return report_path
+
+class StreamingReportWriter:
+    """
+    串流報告的寫出器：open() 先寫出頁首與圖片，feed() 每收到完整的一行就轉成 HTML 追加並 flush，
+    審閱者重新整理 <報告>.partial.html 即可看到已生成的部分。close() 以完整報告重新轉換一次
+    (與非串流模式的輸出完全相同)，原子地換上正式報告並刪除 partial 檔。
+    """
+
+    def __init__(self, image_path):
+        self.asset = image_asset.as_asset(image_path)
+        self.report_path = report_path_for(self.asset.path)
+        self.partial_path = _partial_path(self.report_path)
+        self._file = None
+        self._page = None
+        self._pending = ""
+
+    def open(self):
+        self._page = _report_page(self.asset)
+        self._file = open(self.partial_path, 'w', encoding='utf-8')
+        self._file.write(self._page[0] + '<div class="report-text">')
+        self._file.flush()
+
+    def feed(self, text):
+        self._pending += text
+        lines, newline, self._pending = self._pending.rpartition('\n')
+        if not newline:
+            return
+        self._file.write("".join(_line_to_html(line) for line in lines.split('\n')))
+        self._file.flush()
+        if lines.strip():
+            pipeline_metrics.mark_first_content()
+
+    def close(self, final_report_text_raw):
+        """寫出正式報告，回傳報告路徑"""
+        self._file.close()
+        head, tail = self._page
+        _write_atomic(self.report_path, head + text_to_html(final_report_text_raw.replace("**", "")) + tail)
+        pipeline_metrics.mark_first_content()
+        os.remove(self.partial_path)
+        print(f"HTML 報告已儲存至: {self.report_path}")
+        return self.report_path
+
+    def abort(self):
+        """生成失敗時關閉並刪除 partial 檔"""
+        if self._file is not None:
+            self._file.close()
+        try:
+            os.remove(self.partial_path)
+        except OSError:
+            pass
+
+def write_reports(image_path, final_report_text_raw, duplicates=()):
+    """寫出代表圖片的報告，並為同組的重複圖片寫出沿用同一分析結果的報告；回傳代表圖片的報告路徑"""
+    report_path = write_report(image_path, final_report_text_raw)
+    write_duplicate_reports(image_path, final_report_text_raw, duplicates)
+    return report_path
+
+def write_duplicate_reports(image_path, final_report_text_raw, duplicates):
+    leader = image_asset.as_asset(image_path).filename
+    for duplicate in duplicates:
+        note = f"（此圖片與「{leader}」為重複或近似影像，沿用其分析結果。）\n"
+        write_report(duplicate, note + final_report_text_raw)
+
+def _close_streamed(writer, final_report_text_raw, duplicates):
+    with pipeline_metrics.stage('html'):
+        report_path = writer.close(final_report_text_raw)
+    write_duplicate_reports(writer.asset, final_report_text_raw, duplicates)
+    return report_path
+
+def generate_and_write(asset, duplicates=(), **report_kwargs):
+    """步驟 3+4: 生成報告並寫成 HTML；STREAM_REPORTS 時邊生成邊寫入 partial 檔"""
+    if not STREAM_REPORTS:
+        final_report_text_raw = gemma_report.generate_gemma_report(image_path=asset, **report_kwargs)
+        return write_reports(asset, final_report_text_raw, duplicates)
+    writer = StreamingReportWriter(asset)
+    with pipeline_metrics.stage('html'):
+        writer.open()
+    try:
+        final_report_text_raw = gemma_report.generate_gemma_report(
+            image_path=asset, on_chunk=writer.feed, **report_kwargs)
+    except BaseException:
+        writer.abort()
+        raise
+    return _close_streamed(writer, final_report_text_raw, duplicates)
+
+async def generate_and_write_async(asset, client, duplicates=(), **report_kwargs):
+    """generate_and_write 的非同步版本；開檔、換檔與重複圖片的報告移到執行緒，避免阻塞事件迴圈"""
+    if not STREAM_REPORTS:
+        final_report_text_raw = await gemma_report.generate_gemma_report_async(
+            image_path=asset, client=client, **report_kwargs)
+        return await asyncio.to_thread(write_reports, asset, final_report_text_raw, duplicates)
+    writer = StreamingReportWriter(asset)
+    with pipeline_metrics.stage('html'):
+        await asyncio.to_thread(writer.open)
+    try:
+        final_report_text_raw = await gemma_report.generate_gemma_report_async(
+            image_path=asset, client=client, on_chunk=writer.feed, **report_kwargs)
+    except BaseException:
+        writer.abort()
+        raise
+    return await asyncio.to_thread(_close_streamed, writer, final_report_text_raw, duplicates)
+
+def process_image(image_path, judgment_first=False, combined=False, duplicates=(), features=None):
+    """
+    同步處理單張圖片，成功時回傳報告路徑，否則回傳 None。
+    duplicates 為與此圖片重複的其他圖片，會直接沿用此圖片的報告內容。
+    features 為已由批次萃取取得的特徵 (不可與 judgment_first、combined 併用)。
+    judgment_first=True 時先取得 VLM 初步意見；若已判定非目標犬種 (情況 A)，
+    報告不會用到特徵與 PNN 結果，因此直接略過特徵萃取與分類。
+    combined=True 時以一次 VLM 呼叫同時取得特徵與初步意見。
+    """
+    asset = image_asset.as_asset(image_path)
+    filename = asset.filename
+    
+    print(f"\n{'='*50}")
+    print(f"處理中: {asset.path}") 
+    print(f"{'='*50}")
+
+    prelim_judgment = None
+    if combined:
+        combined_result = vlm_numeric.get_features_and_judgment(asset)
+        if combined_result is None:
+            print(f"無法從 {filename} 提取特徵，跳過此圖片。")
+            return None
+        features = combined_result['features']
+        prelim_judgment = combined_result['prelim_judgment']
+    elif judgment_first:
+        prelim_judgment = gemma_report.get_preliminary_judgment(asset)
+
+    judgment_stage = 'combined' if combined else 'judgment'
+    escalated = False
+    if prelim_judgment is not None and not gemma_report.is_target_breed(prelim_judgment):
+        # 情況 A 不會再經過 PNN 比對，先確認小模型的初步意見可以對應到明確的分類
+        upgraded = gemma_report.escalate_judgment(asset, prelim_judgment, stage=judgment_stage)
+        if upgraded is not None:
+            prelim_judgment, escalated = upgraded, True
+
+    if prelim_judgment is not None and not gemma_report.is_target_breed(prelim_judgment):
+        # 情況 A：報告不使用特徵與 PNN 結果
+        if features is None:
+            print(f"初步意見 '{prelim_judgment}' 非目標犬種，略過特徵萃取與 PNN。")
+            RUN_STATS['feature_stage_skipped'] += 1
+        return generate_and_write(
+            asset, duplicates,
+            image_filename=filename,
+            features=None,
+            classification_result=None,
+            prelim_judgment=prelim_judgment
+        )
+    
+    # 步驟 1: VLM 提取特徵 (不變)
+    if features is None:
+        features = vlm_numeric.get_features_from_vlm(asset)
+    
+    if features is None:
+        print(f"無法從 {filename} 提取特徵，跳過此圖片。")
+        return None
         
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(final_html_content)
-            
-        print(f"HTML 報告已儲存至: {report_path}")
+    # 步驟 2: PNN 進行分類 (不變)
+    classification_result = classify(features)
 
+    # 初步意見不明確或與 PNN 不一致時，改用升級模型重新鑑定
+    if prelim_judgment is not None and not escalated:
+        prelim_judgment = gemma_report.escalate_judgment(
+            asset, prelim_judgment, classification_result, stage=judgment_stage) or prelim_judgment
+    
+    # 步驟 3: Gemma 生成報告；步驟 4: 格式化與打包
+    return generate_and_write(
+        asset, duplicates,
+        image_filename=filename, 
+        features=features, 
+        classification_result=classification_result, 
+        prelim_judgment=prelim_judgment
+    )
+
+def describe_options(judgment_first=False, combined=False, feature_batch=1):
+    """將啟用的流程選項轉成摘要用的文字"""
+    options = []
+    if feature_batch > 1 and not (judgment_first or combined):
+        options.append(f"批次萃取 x{feature_batch}")
+    if combined:
+        options.append("合併萃取")
+    if judgment_first:
+        options.append("初判先行")
+    if STREAM_REPORTS:
+        options.append("串流報告")
+    if HTML_LAYOUT != "inline":
+        options.append(f"{HTML_LAYOUT} 版面")
+    return f" [{'、'.join(options)}]" if options else ""
+
+def print_run_summary(mode, image_paths, report_paths, elapsed, profile_summary=None):
+    """列印本次執行的吞吐量摘要 (profile_summary 為 pipeline_metrics 的各階段統計)"""
+    succeeded = sum(1 for path in report_paths if path is not None)
     print(f"\n{'='*50}")
     print("所有圖片處理完畢。")
+    print(f"模式: {mode}")
+    print(f"圖片總數: {len(image_paths)}，成功: {succeeded}，跳過: {len(image_paths) - succeeded}")
+    if elapsed > 0:
+        print(f"總耗時: {elapsed:.1f} 秒，吞吐量: {len(image_paths) / elapsed:.3f} 張/秒"
+              f" (平均 {elapsed / max(len(image_paths), 1):.1f} 秒/張)")
+    if RUN_STATS['manifest_skipped']:
+        print(f"增量執行：{RUN_STATS['manifest_skipped']} 張圖片已完成且未變更，未重新處理")
+    if RUN_STATS['dedup_duplicates']:
+        print(f"去重：{RUN_STATS['dedup_duplicates']} 張重複或近似圖片沿用同組結果，"
+              f"省下 {RUN_STATS['dedup_calls_saved']} 次 Ollama 呼叫")
+    if RUN_STATS['feature_stage_skipped']:
+        print(f"初判先行：{RUN_STATS['feature_stage_skipped']} 張圖片略過特徵萃取與 PNN")
+    prep = image_preprocess.PREPROCESS_STATS
+    if prep["images"]:
+        print(f"縮圖前處理 ({image_preprocess.signature()}): {prep['resized']}/{prep['images']} 張重新編碼"
+              f" (磁碟快取命中 {prep['cache_hits']})，"
+              f"傳送量 {prep['bytes_in'] / 1e6:.1f} MB → {prep['bytes_out'] / 1e6:.1f} MB")
+    for name, cache in vlm_cache.SHARED_CACHES.items():
+        cache_stats = cache.stats()
+        print(f"{name}快取 ({cache_stats['mode']}): 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']}"
+              f" (命中率 {cache_stats['hit_rate']:.0%})，淘汰 {cache_stats['evictions']} 筆")
+    batch_stats = vlm_numeric.BATCH_STATS
+    if batch_stats["batches"]:
+        print(f"批次特徵萃取: {batch_stats['batches']} 次請求涵蓋 {batch_stats['images']} 張 "
+              f"(平均 {batch_stats['images'] / batch_stats['batches']:.1f} 張/次)，"
+              f"格式錯誤整批重做 {batch_stats['malformed']} 次，逐張補做 {batch_stats['fallback_images']} 張")
+    parse = vlm_numeric.PARSE_STATS
+    if parse["calls"]:
+        print(f"VLM 輸出解析: 直接成功 {parse['clean']}、修補 {parse['repaired']}、補問 {parse['retried']}、"
+              f"作廢 {parse['wasted']} (作廢率 {parse['wasted'] / parse['calls']:.1%})")
+    report_stats = gemma_report.REPORT_STATS
+    if report_stats["hybrid"] or report_stats["template"] or report_stats["cached"]:
+        print(f"報告產生方式 ({gemma_report.REPORT_MODE}): 模型撰寫 {report_stats['llm']}、"
+              f"模板+外觀描述 {report_stats['hybrid']}、純模板 {report_stats['template']}、"
+              f"快取 {report_stats['cached']}")
+    if report_stats["truncated"]:
+        print(f"警告：{report_stats['truncated']} 份報告達到生成 token 上限而被截斷 (已在報告末尾標註，未寫入快取)")
+    prompt_stats = gemma_report.PROMPT_STATS
+    if prompt_stats["prompts"]:
+        count = prompt_stats["prompts"]
+        print(f"情況 B2 報告 Prompt: {count} 次，平均估計 {prompt_stats['tokens'] / count:.0f} tokens "
+              f"(其中固定前綴 {gemma_report.STATIC_PROMPT_TOKENS} 可重用 KV 快取)，"
+              f"列出全部犬種時為 {prompt_stats['full_tokens'] / count:.0f} tokens；"
+              f"預算 {gemma_report.REPORT_PROMPT_TOKENS or '不限'}，超出 {prompt_stats['over_budget']} 次")
+        if prompt_stats["measured"]:
+            # 伺服器實際評估的 token 數含圖片，且不含 KV 快取命中的前綴
+            print(f"  伺服器回報 prompt_eval_count: 平均 "
+                  f"{prompt_stats['prompt_eval_tokens'] / prompt_stats['measured']:.0f} tokens "
+                  f"({prompt_stats['measured']} 次，含圖片、不含 KV 快取命中的前綴)")
+    model_calls = ollama_pool.pool.model_calls
+    if model_calls:
+        print("各模型呼叫數: " + "，".join(f"{model} {count} 次" for model, count in model_calls.most_common()))
+    if model_routing.ESCALATIONS:
+        print("升級至 " + model_routing.ESCALATION_MODEL + ": "
+              + "，".join(f"{key} {count} 次" for key, count in sorted(model_routing.ESCALATIONS.items())))
+    policy = call_policy.POLICY_STATS
+    if policy['timeouts'] or policy['retries'] or policy['hedges'] or policy['budget_exhausted']:
+        print(f"呼叫策略 ({call_policy.describe()}): 逾時 {policy['timeouts']} 次、重試 {policy['retries']} 次、"
+              f"預算用盡 {policy['budget_exhausted']} 次、對沖 {policy['hedges']} 次 (對沖先回 {policy['hedge_wins']} 次)")
+    host_stats = ollama_pool.pool.stats()
+    if len(host_stats) > 1:
+        for host in host_stats:
+            print(f"Ollama 主機 {host['host']}: {host['requests']} 次請求，失敗 {host['failures']}，"
+                  f"累計忙碌 {host['busy_s']:.1f} 秒{'' if host['healthy'] else ' (目前不健康)'}")
+    if profile_summary:
+        stages = profile_summary["stages"].values()
+        load_s = sum(stats["load_s"] for stats in stages)
+        cold_loads = sum(stats["cold_loads"] for stats in stages)
+        inference_s = sum(stats["inference_s"] for stats in stages)
+        print(f"模型載入: 暖機 {RUN_STATS['warmup_load_s']:.1f} 秒 (等待 {RUN_STATS['warmup_s']:.1f} 秒)，"
+              f"批次中 {load_s:.1f} 秒 (冷啟動 {cold_loads} 次)；推論 {inference_s:.1f} 秒")
+        print(f"各階段耗時 (完整紀錄: {pipeline_metrics.PROFILE_PATH}):")
+        pipeline_metrics.print_summary(profile_summary)
     print(f"{'='*50}")
 
+def open_manifest(judgment_first=False, combined=False):
+    """以目前的流程選項建立 manifest；初步意見流程與 HTML 版面都會改變報告，因此列入指紋"""
+    flow = 'combined' if combined else 'judgment_first' if judgment_first else 'features'
+    fingerprint = run_manifest.current_fingerprint(flow=flow, html_layout=HTML_LAYOUT)
+    return run_manifest.RunManifest(fingerprint=fingerprint)
+
+def select_pending(image_paths, manifest, force=False):
+    """依 manifest 篩出需要處理的圖片 (新增、內容變更或流程設定變更者)"""
+    if force:
+        return list(image_paths)
+    pending = [path for path in image_paths if not manifest.is_done(path)]
+    RUN_STATS['manifest_skipped'] = len(image_paths) - len(pending)
+    if RUN_STATS['manifest_skipped']:
+        print(f"manifest 顯示 {RUN_STATS['manifest_skipped']} 張圖片已完成且未變更，略過。")
+    return pending
+
+def warm_up_models():
+    """步驟 0: 在處理第一張圖片前，於每台主機預先載入各階段使用的模型"""
+    models = model_routing.all_models()
+    print(f"預先載入模型 (keep_alive={ollama_pool.KEEP_ALIVE}): {', '.join(models)}...")
+    start_time = time.perf_counter()
+    loaded = ollama_pool.warm_up(models)
+    RUN_STATS['warmup_s'] += time.perf_counter() - start_time
+    for host, load_times in loaded.items():
+        for model, load_s in load_times.items():
+            RUN_STATS['warmup_load_s'] += load_s
+            print(f"  {host}: {model} 載入 {load_s:.1f} 秒")
+
+def group_pending(image_paths, dedup_distance=image_dedup.DEDUP_DISTANCE, digests=None):
+    """
+    將待處理圖片分組：內容完全相同的檔案一組；dedup_distance >= 0 時另以感知雜湊合併近似圖片，
+    為負值時每張各自一組。digests 若為 dict，會填入分組時算出的 SHA-256 (供 record_group 沿用)
+    """
+    groups = image_dedup.group_duplicates(image_paths, dedup_distance, digests)
+    for leader, duplicates in groups:
+        if duplicates:
+            RUN_STATS['dedup_duplicates'] += len(duplicates)
+            print(f"重複圖片: {', '.join(duplicates)} 將沿用 {leader} 的分析結果")
+    return groups
+
+def record_group(manifest, asset, duplicates, report_path, profile_record, digests=None):
+    """
+    將一組圖片寫入 manifest，並累計重複圖片省下的 Ollama 呼叫數。
+    代表圖片沿用 asset 已算好的雜湊，重複圖片沿用分組時的 digests，不再重新讀檔計算。
+    """
+    digests = digests or {}
+    leader = asset.path
+    result = profile_record.get("result")
+    manifest.record(leader, report_path, sha256=asset.sha256, result=result)
+    for duplicate in duplicates:
+        manifest.record(duplicate, report_path_for(duplicate), sha256=digests.get(duplicate),
+                        result=dict(result or {}, duplicate_of=leader))
+    calls = sum(stage.get("calls", 0) for stage in profile_record["stages"].values())
+    RUN_STATS['dedup_calls_saved'] += calls * len(duplicates)
+
+def extract_group_features(groups, batch_size, judgment_first=False, combined=False):
+    """
+    批次萃取模式下，先以每次 batch_size 張的請求取得這些組代表圖片的特徵，回傳 {代表圖片: 特徵}。
+    judgment_first / combined 模式的特徵需求依初步意見而定，不使用批次萃取 (回傳 None)。
+    """
+    if batch_size <= 1 or judgment_first or combined:
+        return None
+    leaders = [leader for leader, _ in groups]
+    return dict(zip(leaders, vlm_numeric.get_features_batch(leaders, batch_size)))
+
+def process_all_images(judgment_first=False, combined=False, force=False, warm_up=True,
+                       dedup_distance=image_dedup.DEDUP_DISTANCE, feature_batch=1):
+    """feature_batch > 1 時每 feature_batch 張圖片以一次 VLM 請求萃取特徵，再逐張完成其餘流程"""
+    image_paths_to_process = collect_image_paths()
+    if not image_paths_to_process:
+        return
+
+    RUN_STATS.clear()
+    manifest = open_manifest(judgment_first=judgment_first, combined=combined)
+    image_paths_to_process = select_pending(image_paths_to_process, manifest, force=force)
+
+    print(f"找到 {len(image_paths_to_process)} 張待處理圖片，開始處理...")
+    digests = {}
+    groups = group_pending(image_paths_to_process, dedup_distance, digests)
+    if warm_up and image_paths_to_process:
+        warm_up_models()
+
+    pipeline_metrics.start_run()
+    start_time = time.perf_counter()
+    results = {}
+    # 批次萃取時一次只取一批的特徵，處理完再取下一批，中斷時已完成的圖片仍會寫入 manifest
+    chunk_size = feature_batch if feature_batch > 1 else max(1, len(groups))
+    for offset in range(0, len(groups), chunk_size):
+        chunk = groups[offset:offset + chunk_size]
+        batch_features = extract_group_features(chunk, feature_batch, judgment_first, combined)
+        for image_path, duplicates in chunk:
+            if batch_features is not None and batch_features[image_path] is None:
+                print(f"無法從 {image_path} 提取特徵，跳過此圖片。")
+                results[image_path] = None
+                continue
+            asset = image_asset.ImageAsset(image_path)
+            with pipeline_metrics.image(image_path) as profile_record:
+                report_path = process_image(asset, judgment_first=judgment_first, combined=combined,
+                                            duplicates=duplicates,
+                                            features=batch_features and batch_features[image_path])
+            # 報告已寫出，釋放圖片內容 (雜湊仍保留，供 manifest 使用)
+            asset.release()
+            if report_path is not None:
+                # 每完成一張即寫入 manifest，中斷後重跑會從下一張接續
+                record_group(manifest, asset, duplicates, report_path, profile_record, digests)
+                results.update((duplicate, report_path_for(duplicate)) for duplicate in duplicates)
+            results[image_path] = report_path
+    report_paths = [results.get(path) for path in image_paths_to_process]
+    elapsed = time.perf_counter() - start_time
+    manifest.compact()
+    write_index(manifest)
+    profile_summary = pipeline_metrics.finish_run()
+    mode = "同步" + describe_options(judgment_first=judgment_first, combined=combined,
+                                     feature_batch=feature_batch)
+    print_run_summary(mode, image_paths_to_process, report_paths, elapsed, profile_summary)
+
+# --- 非同步 (管線化) 模式 ---
+async def process_image_async(image_path, client, judgment_first=False, combined=False, duplicates=(),
+                              features=None):
+    """
+    duplicates 為與此圖片重複的其他圖片，會直接沿用此圖片的報告內容。
+    features 為已由批次萃取取得的特徵 (不可與 judgment_first、combined 併用)。
+    非同步處理單張圖片。特徵萃取與初步意見互不相依，因此同時送出；
+    不同圖片的各階段則由事件迴圈交錯執行 (第 N+1 張萃取時第 N 張可在生成報告)。
+    judgment_first=True 時改為先取得初步意見，情況 A 直接略過特徵萃取與 PNN；
+    combined=True 時以一次 VLM 呼叫同時取得特徵與初步意見。
+    """
+    asset = image_asset.as_asset(image_path)
+    filename = asset.filename
+    print(f"開始處理: {asset.path}")
+
+    prelim_judgment = None
+    if combined:
+        combined_result = await vlm_numeric.get_features_and_judgment_async(asset, client)
+        if combined_result is None:
+            print(f"無法從 {filename} 提取特徵，跳過此圖片。")
+            return None
+        features = combined_result['features']
+        prelim_judgment = combined_result['prelim_judgment']
+    elif judgment_first or features is not None:
+        prelim_judgment = await gemma_report.get_preliminary_judgment_async(asset, client)
+    else:
+        features, prelim_judgment = await asyncio.gather(
+            vlm_numeric.get_features_from_vlm_async(asset, client),
+            gemma_report.get_preliminary_judgment_async(asset, client),
+        )
+
+    judgment_stage = 'combined' if combined else 'judgment'
+    escalated = False
+    if judgment_first or combined:
+        if not gemma_report.is_target_breed(prelim_judgment):
+            # 情況 A 不會再經過 PNN 比對，先確認小模型的初步意見可以對應到明確的分類
+            upgraded = await gemma_report.escalate_judgment_async(asset, prelim_judgment, client,
+                                                                  stage=judgment_stage)
+            if upgraded is not None:
+                prelim_judgment, escalated = upgraded, True
+        if not gemma_report.is_target_breed(prelim_judgment):
+            # 情況 A：報告不使用特徵與 PNN 結果
+            if features is None:
+                print(f"初步意見 '{prelim_judgment}' 非目標犬種，略過特徵萃取與 PNN: {filename}")
+                RUN_STATS['feature_stage_skipped'] += 1
+            return await generate_and_write_async(
+                asset, client, duplicates,
+                image_filename=filename,
+                features=None,
+                classification_result=None,
+                prelim_judgment=prelim_judgment,
+            )
+        if features is None:
+            features = await vlm_numeric.get_features_from_vlm_async(asset, client)
+
+    if features is None:
+        print(f"無法從 {filename} 提取特徵，跳過此圖片。")
+        return None
+
+    classification_result = classify(features)
+
+    # 初步意見不明確或與 PNN 不一致時，改用升級模型重新鑑定
+    if not escalated:
+        prelim_judgment = await gemma_report.escalate_judgment_async(
+            asset, prelim_judgment, client, classification_result, stage=judgment_stage) or prelim_judgment
+
+    # HTML 轉換與寫檔移到執行緒，避免阻塞事件迴圈
+    return await generate_and_write_async(
+        asset, client, duplicates,
+        image_filename=filename,
+        features=features,
+        classification_result=classification_result,
+        prelim_judgment=prelim_judgment,
+    )
+
+async def process_all_images_async(concurrency=None, judgment_first=False,
+                                   combined=False, force=False, warm_up=True,
+                                   dedup_distance=image_dedup.DEDUP_DISTANCE, feature_batch=1):
+    """
+    透過 ollama_pool 的多主機連線池並行處理所有圖片。
+    concurrency 限制同時送往 Ollama 的請求數 (預設為 DEFAULT_CONCURRENCY × 主機數)；同時在途的圖片數為其兩倍，以免一次載入全部圖片。
+    報告檔名由圖片路徑決定，結果依輸入順序彙整，因此輸出與同步模式一致。
+    feature_batch > 1 時每 feature_batch 張圖片以一次 VLM 請求萃取特徵，各批次彼此並行。
+    """
+    image_paths_to_process = collect_image_paths()
+    if not image_paths_to_process:
+        return
+
+    RUN_STATS.clear()
+    manifest = open_manifest(judgment_first=judgment_first, combined=combined)
+    image_paths_to_process = select_pending(image_paths_to_process, manifest, force=force)
+
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY * len(ollama_pool.pool.hosts)
+    print(f"找到 {len(image_paths_to_process)} 張待處理圖片，以非同步模式處理 (並行上限 {concurrency})...")
+    digests = {}
+    groups = await asyncio.to_thread(group_pending, image_paths_to_process, dedup_distance, digests)
+
+    if warm_up and image_paths_to_process:
+        await asyncio.to_thread(warm_up_models)
+
+    client = ollama_pool.BoundedAsyncClient(ollama_pool.async_client(), concurrency)
+    image_slots = asyncio.Semaphore(concurrency * 2)
+
+    async def run_one(image_path, duplicates, features=None):
+        async with image_slots:
+            asset = image_asset.ImageAsset(image_path)
+            try:
+                with pipeline_metrics.image(image_path) as profile_record:
+                    report_path = await process_image_async(asset, client,
+                                                            judgment_first=judgment_first,
+                                                            combined=combined,
+                                                            duplicates=duplicates,
+                                                            features=features)
+            except Exception as e:
+                print(f"處理 {image_path} 時發生錯誤: {e}")
+                return None
+            finally:
+                asset.release()
+            if report_path is not None:
+                await asyncio.to_thread(record_group, manifest, asset, duplicates, report_path,
+                                        profile_record, digests)
+            return report_path
+
+    # 同時在萃取中的批次數，使在途圖片數與逐張模式相近
+    batch_slots = asyncio.Semaphore(max(1, concurrency * 2 // max(1, feature_batch)))
+
+    async def run_batch(chunk):
+        async with batch_slots:
+            batch_features = await vlm_numeric.get_features_batch_async(
+                [leader for leader, _ in chunk], client, feature_batch)
+        reports = []
+        for (image_path, duplicates), features in zip(chunk, batch_features):
+            if features is None:
+                print(f"無法從 {image_path} 提取特徵，跳過此圖片。")
+                reports.append(asyncio.sleep(0, result=None))
+            else:
+                reports.append(run_one(image_path, duplicates, features))
+        return await asyncio.gather(*reports)
+
+    pipeline_metrics.start_run()
+    start_time = time.perf_counter()
+    if feature_batch > 1 and not (judgment_first or combined):
+        chunks = [groups[i:i + feature_batch] for i in range(0, len(groups), feature_batch)]
+        leader_reports = [report for reports in await asyncio.gather(*(run_batch(chunk) for chunk in chunks))
+                          for report in reports]
+    else:
+        leader_reports = await asyncio.gather(*(run_one(path, duplicates) for path, duplicates in groups))
+    results = {}
+    for (image_path, duplicates), report_path in zip(groups, leader_reports):
+        results[image_path] = report_path
+        if report_path is not None:
+            results.update((duplicate, report_path_for(duplicate)) for duplicate in duplicates)
+    report_paths = [results.get(path) for path in image_paths_to_process]
+    elapsed = time.perf_counter() - start_time
+    manifest.compact()
+    await asyncio.to_thread(write_index, manifest)
+    profile_summary = pipeline_metrics.finish_run()
+
+    for image_path, report_path in zip(image_paths_to_process, report_paths):
+        print(f"{image_path} -> {report_path if report_path else '(跳過)'}")
+    mode = f"非同步 (並行上限 {concurrency})" + describe_options(judgment_first=judgment_first,
+                                                              combined=combined,
+                                                              feature_batch=feature_batch)
+    print_run_summary(mode, image_paths_to_process, report_paths, elapsed, profile_summary)
+
+async def watch_images_async(poll_interval=watch_folder.POLL_INTERVAL_S, concurrency=None,
+                             judgment_first=False, combined=False, warm_up=True):
+    """
+    常駐服務模式：持續監看 IMAGE_DIR，新圖片一寫完就送入處理佇列，模型全程保持載入。
+    收到 SIGTERM / SIGINT 時停止收件、完成處理中的圖片後結束；尚未開始的圖片留待下次啟動
+    (manifest 會略過已完成者)。此模式逐張處理，不做跨圖片的去重分組。
+    """
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    if not os.path.exists(IMAGE_DIR):
+        os.makedirs(IMAGE_DIR)
+
+    RUN_STATS.clear()
+    manifest = open_manifest(judgment_first=judgment_first, combined=combined)
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY * len(ollama_pool.pool.hosts)
+    if warm_up:
+        await asyncio.to_thread(warm_up_models)
+
+    client = ollama_pool.BoundedAsyncClient(ollama_pool.async_client(), concurrency)
+    queue = asyncio.Queue()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stopping.set)
+        except (NotImplementedError, RuntimeError):  # Windows 不支援，只能以 Ctrl+C 中斷
+            pass
+
+    processed, report_paths, latencies = [], [], []
+    in_flight = set()
+    failed = []  # 處理失敗、待下一輪掃描前交給 scanner.forget 重試的圖片
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            image_path, uploaded_at = item
+            in_flight.add(image_path)
+            asset = image_asset.ImageAsset(image_path)
+            try:
+                with pipeline_metrics.image(image_path) as profile_record:
+                    report_path = await process_image_async(asset, client,
+                                                            judgment_first=judgment_first,
+                                                            combined=combined)
+            except Exception as e:
+                print(f"處理 {image_path} 時發生錯誤: {e}")
+                report_path = None
+            asset.release()
+            if report_path is not None:
+                await asyncio.to_thread(manifest.record, image_path, report_path, sha256=asset.sha256,
+                                        result=profile_record.get("result"))
+                # 由檔案 mtime (上傳完成時間) 起算到報告寫出為止
+                latency = time.time() - uploaded_at
+                latencies.append(latency)
+                print(f"{image_path} -> {report_path} (上傳後 {latency:.1f} 秒)")
+            else:
+                failed.append(image_path)
+            in_flight.discard(image_path)
+            processed.append(image_path)
+            report_paths.append(report_path)
+
+    scanner = watch_folder.FolderScanner(IMAGE_DIR, SUPPORTED_FORMATS)
+    print(f"監看 '{IMAGE_DIR}' 中 ({scanner.mode}，並行上限 {concurrency})，按 Ctrl+C 或送 SIGTERM 結束...")
+    pipeline_metrics.start_run()
+    start_time = time.perf_counter()
+    started_at = time.time()
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency * 2)]
+    found = scanner.scan(force=True)
+    indexed = -1
+    try:
+        while not stopping.is_set():
+            for image_path, uploaded_at in found:
+                try:
+                    if manifest.is_done(image_path):
+                        RUN_STATS['manifest_skipped'] += 1
+                        continue
+                except OSError:  # 檔案在掃描後被移走
+                    continue
+                # 啟動前就已存在的圖片從啟動時間起算
+                queue.put_nowait((image_path, max(uploaded_at, started_at)))
+            if len(processed) != indexed:
+                # 每輪掃描最多重寫一次索引，而不是每完成一張就重寫
+                indexed = len(processed)
+                await asyncio.to_thread(write_index, manifest)
+            while failed:
+                # 在掃描之間 (不在執行緒中) 更新 scanner 狀態
+                image_path = failed.pop()
+                if scanner.forget(image_path):
+                    print(f"{image_path} 處理失敗，下一輪掃描時重試")
+                else:
+                    print(f"{image_path} 已失敗 {scanner.max_attempts} 次，檔案變更前不再重試")
+            found = await asyncio.to_thread(scanner.poll, poll_interval)
+    finally:
+        abandoned = 0
+        while not queue.empty():
+            queue.get_nowait()
+            abandoned += 1
+        if abandoned:
+            print(f"停止收件：{abandoned} 張尚未開始的圖片留待下次啟動處理")
+        if in_flight:
+            print(f"等待處理中的 {len(in_flight)} 張圖片完成...")
+        for _ in workers:
+            queue.put_nowait(None)
+        await asyncio.gather(*workers)
+        scanner.close()
+
+    elapsed = time.perf_counter() - start_time
+    manifest.compact()
+    await asyncio.to_thread(write_index, manifest)
+    profile_summary = pipeline_metrics.finish_run()
+    if latencies:
+        print(f"上傳至報告完成: p50 {pipeline_metrics.percentile(latencies, 50):.1f} 秒，"
+              f"p95 {pipeline_metrics.percentile(latencies, 95):.1f} 秒，最長 {max(latencies):.1f} 秒"
+              f" (掃描 {scanner.scans} 次，列出資料夾 {scanner.listed_dirs} 次)")
+    mode = f"監看資料夾 (並行上限 {concurrency})" + describe_options(judgment_first=judgment_first,
+                                                                 combined=combined)
+    print_run_summary(mode, processed, report_paths, elapsed, profile_summary)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="批次執行 VLM → PNN → Gemma 犬種鑑定流程")
+    parser.add_argument('--cache', choices=vlm_cache.CACHE_MODES, default=vlm_cache.CACHE_MODE,
+                        help="VLM 快取 (特徵、初步意見、報告原文) 模式：on 正常使用、off 停用、refresh 重新呼叫並覆寫")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="開始前清空所有 VLM 快取")
+    parser.add_argument('--rebuild-html', action='store_true',
+                        help="修改 HTML 模板後重新產生所有報告頁面：等同 --force 且不預先載入模型，"
+                             "已快取的圖片不會呼叫模型")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="使用非同步 client (ollama_pool 連線池) 並行、管線化處理多張圖片")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="非同步模式下同時送往 Ollama 的請求上限 (預設為 OLLAMA_NUM_PARALLEL 或 4，乘上主機數)")
+    parser.add_argument('--hosts', default=None,
+                        help="以逗號分隔的 Ollama 主機清單 (預設取 OLLAMA_HOSTS 或 OLLAMA_HOST)")
+    parser.add_argument('--judgment-first', action='store_true',
+                        help="先取得 VLM 初步意見，非目標犬種直接略過特徵萃取與 PNN")
+    parser.add_argument('--combined', action='store_true',
+                        help="以一次 VLM 呼叫 (JSON Schema) 同時取得特徵分數與初步意見")
+    parser.add_argument('--feature-batch', type=int, default=vlm_numeric.FEATURE_BATCH_SIZE,
+                        help="每次 VLM 請求送出的圖片數，回傳同數量的特徵 (1 = 逐張；不適用 --judgment-first/--combined)")
+    parser.add_argument('--max-side', type=int, default=image_preprocess.MAX_SIDE,
+                        help="送往 VLM 前將圖片最長邊縮到此像素 (0 = 傳送原始檔)")
+    parser.add_argument('--jpeg-quality', type=int, default=image_preprocess.JPEG_QUALITY,
+                        help="縮圖重新編碼時的 JPEG 品質")
+    parser.add_argument('--resize-cache', action='store_true',
+                        help=f"將縮圖結果快取於 {os.path.join(OUTPUT_DIR, 'resized')}，重跑時不再重新縮圖")
+    parser.add_argument('--stage-model', action='append', default=[], metavar='STAGE=MODEL',
+                        help=f"指定某階段使用的模型，可重複 (階段: {', '.join(model_routing.STAGES)})；"
+                             f"預設 {model_routing.DEFAULT_MODEL}")
+    parser.add_argument('--escalation-model', default=None,
+                        help=f"小模型結果不確定或與 PNN 不一致時改用的模型 (預設 {model_routing.ESCALATION_MODEL})")
+    parser.add_argument('--report-mode', choices=gemma_report.REPORT_MODES, default=gemma_report.REPORT_MODE,
+                        help="報告產生方式：llm 全部由模型撰寫；hybrid 情況 A/B1 以模板產生、只請模型寫外觀描述；"
+                             "template 情況 A/B1 完全不呼叫模型")
+    parser.add_argument('--report-prompt-tokens', type=int, default=gemma_report.REPORT_PROMPT_TOKENS,
+                        help="情況 B2 報告 Prompt 的估計 token 預算，超過時刪減知識庫中距離最遠的犬種 (0 為不限)")
+    parser.add_argument('--report-competitors', type=int, default=gemma_report.REPORT_COMPETITORS,
+                        help="情況 B2 報告知識庫除 PNN 結論外最多列出幾個距離最近的易混淆犬種")
+    parser.add_argument('--timeout', action='append', default=[], metavar='STAGE=SECONDS',
+                        help="指定某階段單次呼叫的逾時秒數 (0 為不限)，可重複，例如 --timeout report=180 "
+                             "(另可指定 features_batch 多圖批次與 followup 缺欄位補問)")
+    parser.add_argument('--num-predict', action='append', default=[], metavar='STAGE=TOKENS',
+                        help="指定某階段的生成 token 數上限 (0 為不限)，可重複，例如 --num-predict report=1500")
+    parser.add_argument('--max-retries', type=int, default=call_policy.MAX_RETRIES,
+                        help="逾時或伺服器錯誤時的最多重試次數 (指數退避)")
+    parser.add_argument('--retry-budget', type=float, default=call_policy.RETRY_BUDGET_RATIO,
+                        help="全域重試預算：重試與對沖請求總數佔呼叫數的比例上限")
+    parser.add_argument('--hedge', action='store_true',
+                        help=f"呼叫超過該階段近期 p{call_policy.HEDGE_PERCENTILE} 延遲時再送一份相同請求，取先回來的結果"
+                             "；同步模式無法取消輸掉的請求，會在 GPU 上多跑一份到完成或逾時，建議搭配 --async")
+    parser.add_argument('--keep-alive', default=None,
+                        help=f"每次請求帶入的模型常駐時間，例如 30m、1h、-1 (預設 {ollama_pool.KEEP_ALIVE})")
+    parser.add_argument('--no-warmup', action='store_true',
+                        help="開始時不預先載入模型")
+    parser.add_argument('--dedup-distance', type=int, default=image_dedup.DEDUP_DISTANCE,
+                        help="預設只合併內容完全相同的檔案；指定 >= 0 時，與代表圖片的感知雜湊漢明距離不超過此值的"
+                             "近似圖片也沿用其報告 (含管制結論，請確認不會是不同犬隻)；負值完全停用去重")
+    parser.add_argument('--watch', action='store_true',
+                        help=f"常駐服務模式：持續監看 '{IMAGE_DIR}'，新圖片寫完即處理 (使用非同步連線池)；"
+                             "未指定 --keep-alive 時模型常駐不卸載")
+    parser.add_argument('--poll-interval', type=float, default=watch_folder.POLL_INTERVAL_S,
+                        help="監看模式的掃描間隔秒數 (有 inotify 時為事件等待上限)")
+    parser.add_argument('--html-layout', choices=HTML_LAYOUTS, default=HTML_LAYOUT,
+                        help="報告頁面版面：inline 內嵌原圖與樣式 (單檔可攜)；compact 改用縮圖連結原圖、"
+                             f"共用 {STYLESHEET_NAME}，並產生批次索引 {report_index.INDEX_NAME} (可搭配 --rebuild-html 轉換既有報告)")
+    parser.add_argument('--stream', action='store_true',
+                        help="以串流方式生成報告，邊生成邊寫入 <報告>.partial.html，完成後原子地換上正式報告")
+    parser.add_argument('--force', action='store_true',
+                        help="忽略 manifest，重新處理所有圖片")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    process_all_images()
+    args = parse_args()
+    vlm_cache.set_mode(args.cache)
+    image_preprocess.configure(
+        max_side=args.max_side,
+        jpeg_quality=args.jpeg_quality,
+        cache_dir=os.path.join(OUTPUT_DIR, 'resized') if args.resize_cache else "",
+    )
+    if args.clear_cache:
+        for cache in vlm_cache.SHARED_CACHES.values():
+            cache.clear()
+    if args.rebuild_html:
+        args.force = True
+        args.no_warmup = True
+    gemma_report.set_report_mode(args.report_mode)
+    gemma_report.set_prompt_budget(args.report_prompt_tokens, args.report_competitors)
+    vlm_numeric.set_feature_batch(args.feature_batch)
+    STREAM_REPORTS = args.stream
+    HTML_LAYOUT = args.html_layout
+    model_routing.configure(args.stage_model, escalation=args.escalation_model)
+    call_policy.configure(timeouts=args.timeout, num_predict=args.num_predict, max_retries=args.max_retries,
+                          retry_budget=args.retry_budget, hedge=args.hedge)
+    if args.watch and args.keep_alive is None:
+        # 常駐服務兩張圖片之間可能閒置很久，讓模型一直留在記憶體中
+        args.keep_alive = "-1"
+    ollama_pool.configure(hosts=args.hosts.split(',') if args.hosts is not None else None,
+                          keep_alive=args.keep_alive)
+    if len(ollama_pool.pool.hosts) > 1:
+        healthy = ollama_pool.pool.check_health()
+        print(f"Ollama 連線池: {healthy}/{len(ollama_pool.pool.hosts)} 台主機可用")
+    if args.watch:
+        asyncio.run(watch_images_async(poll_interval=args.poll_interval,
+                                       concurrency=args.concurrency and max(1, args.concurrency),
+                                       judgment_first=args.judgment_first,
+                                       combined=args.combined,
+                                       warm_up=not args.no_warmup))
+    elif args.use_async:
+        asyncio.run(process_all_images_async(concurrency=args.concurrency and max(1, args.concurrency),
+                                             judgment_first=args.judgment_first,
+                                             combined=args.combined,
+                                             force=args.force,
+                                             warm_up=not args.no_warmup,
+                                             dedup_distance=args.dedup_distance,
+                                             feature_batch=vlm_numeric.FEATURE_BATCH_SIZE))
+    else:
+        process_all_images(judgment_first=args.judgment_first, combined=args.combined,
+                           force=args.force, warm_up=not args.no_warmup,
+                           dedup_distance=args.dedup_distance,
+                           feature_batch=vlm_numeric.FEATURE_BATCH_SIZE)
@@ -0,0 +1,307 @@
+# bench_pipeline.py (以 fake_ollama 模擬伺服器量測整條管線的吞吐量)
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import fake_ollama
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+# 模式名稱 -> batch_numeric.py 的命令列參數
+MODES = {
+    "sync": [],
+    "async": ["--async"],
+    "async-judgment-first": ["--async", "--judgment-first"],
+    "async-combined": ["--async", "--combined"],
+    "async-batch4": ["--async", "--feature-batch", "4"],
+    "async-hedge": ["--async", "--hedge"],
+}
+
+
+def make_synthetic_images(image_dir, count, size=(640, 480), seed=0):
+    """產生 count 張內容各不相同的合成 JPEG (分散到數個子資料夾)"""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        subdir = os.path.join(image_dir, f"batch{i % 4}")
+        os.makedirs(subdir, exist_ok=True)
+        pixels = rng.integers(0, 256, size=(size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize(size)
+        image.save(os.path.join(subdir, f"dog_{i:05d}.jpg"), quality=90)
+
+
+def run_worker(workdir, mode_args, hosts):
+    """在子行程中執行一次 batch_numeric (hosts 為模擬伺服器網址清單)，回傳 (牆鐘時間, 峰值 RSS MB)"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "batch_numeric.py")
+    env = dict(os.environ, OLLAMA_HOSTS=",".join(hosts), VLM_CACHE="off")
+    cmd = [sys.executable, script, "--force", *mode_args]
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=workdir, env=env,
+                                stdout=subprocess.DEVNULL, stderr=stderr_file)
+        # 以 wait4 取得該子行程自己的資源用量 (含峰值 RSS)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", "replace")
+            raise RuntimeError(f"batch_numeric 失敗 ({' '.join(mode_args)}):\n{stderr}")
+    # Linux 的 ru_maxrss 單位為 KB
+    return elapsed, rusage.ru_maxrss / 1024
+
+
+def bench_pipeline(sizes, modes, config, nodes=1):
+    """nodes > 1 時啟動多台模擬伺服器，量測 ollama_pool 多主機分流的效果"""
+    servers = [fake_ollama.start_fake_ollama(config) for _ in range(nodes)]
+    hosts = [server.host for server in servers]
+    results = []
+    print(f"{'圖片數':>8}  {'模式':<20}{'牆鐘時間':>10}{'吞吐量':>12}{'峰值 RSS':>11}{'呼叫數':>9}")
+    try:
+        for size in sizes:
+            workdir = tempfile.mkdtemp(prefix=f"bench_{size}_")
+            try:
+                make_synthetic_images(os.path.join(workdir, "images"), size)
+                for mode in modes:
+                    before = sum(server.stats["requests"] for server in servers)
+                    elapsed, peak_rss = run_worker(workdir, MODES[mode], hosts)
+                    calls = sum(server.stats["requests"] for server in servers) - before
+                    results.append({
+                        "images": size,
+                        "mode": mode,
+                        "nodes": nodes,
+                        "wall_s": elapsed,
+                        "images_per_s": size / elapsed,
+                        "peak_rss_mb": peak_rss,
+                        "ollama_calls": calls,
+                    })
+                    print(f"{size:>6} 張  {mode:<22}{elapsed:>9.2f} s{size / elapsed:>10.2f} 張/s"
+                          f"{peak_rss:>10.1f} MB{calls:>8} 次呼叫")
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        for server in servers:
+            server.shutdown()
+    return results
+
+
+def bench_feature_batching(count, batch_sizes, config):
+    """
+    多圖批次特徵萃取的微基準：同一組合成圖片以不同批次大小 K 萃取，
+    比較每張圖片的平均耗時，以及相對 K=1 (逐張) 的特徵偏移與 PNN 分類一致率。
+    """
+    import ollama_pool
+    import pnn_model
+    import vlm_cache
+    import vlm_numeric
+
+    server = fake_ollama.start_fake_ollama(config)
+    workdir = tempfile.mkdtemp(prefix="bench_batch_")
+    ollama_pool.configure(hosts=[server.host])
+    vlm_cache.set_mode("off")
+    results = []
+    try:
+        make_synthetic_images(workdir, count)
+        paths = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(workdir) for name in names)
+        batch_sizes = [1] + [k for k in batch_sizes if k != 1]
+        baseline = None
+        print(f"{'K':>4}{'每張耗時':>12}{'呼叫數':>9}{'平均偏移':>11}{'最大偏移':>11}{'PNN 一致率':>12}")
+        for k in batch_sizes:
+            vlm_numeric.BATCH_STATS.clear()
+            before = server.stats["requests"]
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                features = vlm_numeric.get_features_batch(paths, k)
+                elapsed = time.perf_counter() - start
+            calls = server.stats["requests"] - before
+            valid = [f is not None for f in features]
+            matrix = pnn_model.features_to_matrix([f for f in features if f is not None])
+            breeds = pnn_model.classify_breeds(matrix)["breed"] if len(matrix) else np.array([])
+            if baseline is None:
+                baseline = (matrix, breeds)
+            drift = np.abs(matrix - baseline[0]) if matrix.shape == baseline[0].shape else np.full(1, np.nan)
+            agreement = float(np.mean(breeds == baseline[1])) if len(breeds) == len(baseline[1]) else float("nan")
+            result = {
+                "batch_size": k,
+                "images": count,
+                "extracted": int(sum(valid)),
+                "per_image_s": elapsed / count,
+                "ollama_calls": calls,
+                "fallback_images": vlm_numeric.BATCH_STATS["fallback_images"],
+                "mean_abs_drift": float(np.mean(drift)),
+                "max_abs_drift": float(np.max(drift)),
+                "pnn_agreement": agreement,
+            }
+            results.append(result)
+            print(f"{k:>4}{result['per_image_s'] * 1000:>10.1f} ms{calls:>8} 次{result['mean_abs_drift']:>11.4f}"
+                  f"{result['max_abs_drift']:>11.4f}{agreement:>11.1%}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def _measure_prompt_tokens(client, model, content, nonce):
+    """
+    以實際的報告模型評估一則情況 B2 Prompt，回傳伺服器的 prompt_eval_count (即模型 tokenizer 的真實 token 數)。
+    system 訊息開頭加上 nonce 讓每次都完整評估，不被前一次的 KV 快取抵銷；只生成 1 個 token。
+    """
+    import gemma_report
+
+    response = client.chat(model=model, options={'num_predict': 1},
+                           messages=[{'role': 'system', 'content': f"[{nonce}]\n{gemma_report.REPORT_SYSTEM_PROMPT}"},
+                                     {'role': 'user', 'content': content}])
+    return response.get('prompt_eval_count') or 0
+
+
+def bench_report_prompt(count, seed=0, host=None):
+    """
+    情況 B2 報告 Prompt 的 token 數：以隨機特徵組出 Prompt，比較列出全部犬種 (不限預算)
+    與目前的預算設定，並列出各段的平均估計 token 數 (static 為可重用 KV 快取的固定前綴)。
+    指定 host 時另將每則 Prompt (不含圖片) 送到該 Ollama 主機，以回應的 prompt_eval_count 取得實際的前後數字。
+    """
+    import gemma_report
+    import model_routing
+    import ollama
+    import pnn_model
+
+    rng = np.random.default_rng(seed)
+    matrix = rng.random((count, len(pnn_model.FEATURE_ORDER)))
+    result = pnn_model.classify_breeds(matrix)
+    cases = [({k: float(v) for k, v in zip(pnn_model.FEATURE_ORDER, row)},
+              {"breed": str(breed), "status": str(status)})
+             for row, breed, vetoed, status in zip(matrix, result["breed"], result["vetoed"], result["status"])
+             if not vetoed]
+    client = ollama.Client(host=host) if host else None
+    model = model_routing.model_for('report')
+    budget = (gemma_report.REPORT_PROMPT_TOKENS, gemma_report.REPORT_COMPETITORS)
+    settings = {"全部犬種": (0, len(pnn_model.BREED_NAMES)), "預算": budget}
+    results = {}
+    print(f"{'設定':<10}{'總計':>8}{'逐張':>8}" + "".join(f"{name:>11}" for name in
+                                                      ("static", "data", "features", "vectors", "knowledge"))
+          + (f"{'實測':>8}" if client else ""))
+    try:
+        for label, (tokens, competitors) in settings.items():
+            gemma_report.set_prompt_budget(tokens, competitors)
+            totals = collections.Counter()
+            measured = 0
+            for i, (features, classification) in enumerate(cases):
+                content, prompt_budget = gemma_report.build_b2_data_prompt("dog.jpg", features, classification,
+                                                                           classification["breed"])
+                totals.update(prompt_budget["sections"])
+                if client is not None:
+                    measured += _measure_prompt_tokens(client, model, content, f"{label}-{i}")
+            average = {name: value / max(1, len(cases)) for name, value in totals.items()}
+            total = sum(average.values())
+            results[label] = {"cases": len(cases), "tokens": total,
+                              "per_image_tokens": total - average.get("static", 0), "sections": average}
+            if client is not None:
+                results[label]["prompt_eval_count"] = measured / max(1, len(cases))
+            print(f"{label:<10}{total:>8.0f}{total - average.get('static', 0):>8.0f}"
+                  + "".join(f"{average.get(name, 0):>11.0f}"
+                            for name in ("static", "data", "features", "vectors", "knowledge"))
+                  + (f"{results[label]['prompt_eval_count']:>8.0f}" if client else ""))
+    finally:
+        gemma_report.set_prompt_budget(*budget)
+    return results
+
+
+def bench_classifier(n_scalar=20000, n_batch=200000, seed=0):
+    """pnn_model.classify_breed (逐筆) 與 classify_breeds (向量化) 的微基準"""
+    import pnn_model
+
+    rng = random.Random(seed)
+    records = [{k: rng.random() for k in pnn_model.FEATURE_ORDER} for _ in range(n_scalar)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for record in records:
+            pnn_model.classify_breed(record)
+        scalar_s = time.perf_counter() - start
+
+    matrix = np.random.default_rng(seed).random((n_batch, len(pnn_model.FEATURE_ORDER)))
+    start = time.perf_counter()
+    pnn_model.classify_breeds(matrix)
+    batch_s = time.perf_counter() - start
+
+    results = {
+        "classify_breed_us_per_call": scalar_s / n_scalar * 1e6,
+        "classify_breeds_us_per_row": batch_s / n_batch * 1e6,
+        "classify_breeds_rows_per_s": n_batch / batch_s,
+    }
+    print(f"classify_breed  : {results['classify_breed_us_per_call']:.1f} µs/筆 ({n_scalar} 筆)")
+    print(f"classify_breeds : {results['classify_breeds_us_per_row']:.3f} µs/筆 "
+          f"({results['classify_breeds_rows_per_s']:,.0f} 筆/s，{n_batch} 筆)")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="以模擬 Ollama 伺服器量測管線吞吐量")
+    parser.add_argument('--sizes', default=",".join(map(str, DEFAULT_SIZES)),
+                        help="以逗號分隔的合成圖片數量")
+    parser.add_argument('--modes', default=",".join(MODES),
+                        help=f"以逗號分隔的執行模式 (可用: {', '.join(MODES)})")
+    parser.add_argument('--latency', type=float, default=0.01, help="模擬伺服器每次請求的固定延遲 (秒)")
+    parser.add_argument('--prompt-tps', type=float, default=50000.0, help="模擬 prompt-eval tokens/sec")
+    parser.add_argument('--eval-tps', type=float, default=20000.0, help="模擬生成 tokens/sec")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="模擬 HTTP 500 的機率")
+    parser.add_argument('--other-ratio', type=float, default=0.5, help="初步意見為「其他犬種」的比例")
+    parser.add_argument('--parallel', type=int, default=4, help="模擬伺服器的 OLLAMA_NUM_PARALLEL")
+    parser.add_argument('--load-duration', type=float, default=0.0, help="模擬模型冷啟動載入時間 (秒)")
+    parser.add_argument('--nodes', type=int, default=1, help="啟動的模擬伺服器數量 (多主機連線池)")
+    parser.add_argument('--feature-batches', default="",
+                        help="以逗號分隔的批次萃取大小 (例如 1,2,4,8)，量測每張耗時與相對逐張萃取的特徵偏移")
+    parser.add_argument('--batch-images', type=int, default=64, help="批次萃取基準使用的合成圖片數")
+    parser.add_argument('--batch-drift', type=float, default=0.0,
+                        help="模擬伺服器在批次萃取時每多一張圖片加入的分數雜訊標準差")
+    parser.add_argument('--batch-malformed-rate', type=float, default=0.0,
+                        help="模擬伺服器回傳錯誤長度陣列的機率 (測試逐張補做)")
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help="模擬伺服器請求卡住的機率 (量測逾時、重試與對沖對長尾延遲的效果)")
+    parser.add_argument('--stall-latency', type=float, default=5.0, help="卡住的請求額外花費的秒數")
+    parser.add_argument('--report-prompts', type=int, default=0,
+                        help="以多少組隨機特徵量測情況 B2 報告 Prompt 的估計 token 數 (0 為不量測)")
+    parser.add_argument('--report-prompt-host',
+                        help="另將這些 Prompt 送到此 Ollama 主機，以 prompt_eval_count 實測 token 數 (需可載入報告模型)")
+    parser.add_argument('--skip-pipeline', action='store_true', help="只執行 PNN 微基準")
+    parser.add_argument('--json', dest='json_path', help="將結果另存為 JSON")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = fake_ollama.FakeOllamaConfig(
+        latency=args.latency, prompt_tokens_per_s=args.prompt_tps, eval_tokens_per_s=args.eval_tps,
+        failure_rate=args.failure_rate, other_breed_ratio=args.other_ratio, parallel=args.parallel,
+        load_duration=args.load_duration, batch_drift=args.batch_drift,
+        batch_malformed_rate=args.batch_malformed_rate, stall_rate=args.stall_rate,
+        stall_latency=args.stall_latency,
+    )
+    report = {"classifier": bench_classifier()}
+    if args.feature_batches:
+        batch_sizes = [int(k) for k in args.feature_batches.split(",") if k]
+        report["feature_batching"] = bench_feature_batching(args.batch_images, batch_sizes, config)
+    if args.report_prompts:
+        report["report_prompt"] = bench_report_prompt(args.report_prompts, host=args.report_prompt_host)
+    if not args.skip_pipeline:
+        sizes = [int(s) for s in args.sizes.split(",") if s]
+        modes = [m for m in args.modes.split(",") if m]
+        unknown = [m for m in modes if m not in MODES]
+        if unknown:
+            sys.exit(f"未知的模式: {', '.join(unknown)}")
+        report["pipeline"] = bench_pipeline(sizes, modes, config, nodes=max(1, args.nodes))
+    if args.json_path:
+        with open(args.json_path, "w", encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,288 @@
+# call_policy.py (各階段 Ollama 呼叫的逾時、生成長度上限、重試預算與對沖請求)
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import random
+import threading
+import time
+
+import httpx
+import ollama
+
+import model_routing
+import pipeline_metrics
+
+# 除了管線階段之外，多圖批次特徵萃取 (耗時約為單張的 K 倍) 與缺欄位補問 (只輸出少數欄位) 另有自己的鍵，
+# 各自有逾時、生成上限與對沖用的延遲視窗，不會拉高單張呼叫的 p95 而讓對沖失效
+POLICY_STAGES = model_routing.STAGES + ('features_batch', 'followup')
+
+# 各階段單次呼叫的逾時秒數，可用 VLM_TIMEOUT_<階段> 環境變數調整；0 代表不限
+# (報告可能是數百字的長文，其餘階段只輸出短 JSON 或一句話)
+DEFAULT_TIMEOUTS = {'features': 120.0, 'combined': 120.0, 'judgment': 60.0, 'report': 300.0,
+                    'features_batch': 480.0, 'followup': 120.0}
+STAGE_TIMEOUTS = {stage: float(os.environ.get(f'VLM_TIMEOUT_{stage.upper()}', DEFAULT_TIMEOUTS[stage]))
+                  for stage in POLICY_STAGES}
+
+# 各階段生成 token 數上限 (options.num_predict)，避免模型不輸出結束符號時無止盡地生成；
+# 呼叫端已自行指定者 (例如外觀描述) 不覆寫。0 代表不限。報告的上限遠高於一般中文報告的長度，
+# 真的達到上限 (done_reason 為 length) 時 gemma_report 會在報告末尾標註截斷且不寫入快取
+DEFAULT_NUM_PREDICT = {'features': 1024, 'combined': 1024, 'judgment': 256, 'report': 8192,
+                       'features_batch': 4096, 'followup': 256}
+STAGE_NUM_PREDICT = {stage: int(os.environ.get(f'VLM_NUM_PREDICT_{stage.upper()}', DEFAULT_NUM_PREDICT[stage]))
+                     for stage in POLICY_STAGES}
+
+# 逾時、伺服器錯誤 (5xx / 429) 與所有主機都連不上時的重試：指數退避加隨機抖動
+MAX_RETRIES = 2
+BACKOFF_BASE_S = 0.5
+BACKOFF_MAX_S = 8.0
+
+# 全域重試預算：重試與對沖請求的總數不超過「呼叫數 × RETRY_BUDGET_RATIO + RETRY_BUDGET_MIN」，
+# 伺服器過載時不會因為每個呼叫都重試而把負載放大數倍
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MIN = 10
+
+# 對沖請求：呼叫超過該階段近期延遲的 HEDGE_PERCENTILE 百分位仍未回應時，再送一份相同請求
+# (連線池會派給較空閒的主機或空位)，取先回來的結果；樣本不足 HEDGE_MIN_SAMPLES 前不對沖。
+# 非同步模式會取消輸掉的請求；同步模式的阻塞呼叫無法中途取消，輸掉的請求仍會在 GPU 上跑到完成或逾時，
+# 因此同步模式每次對沖都會多佔一個推論位置 (重試預算同時限制了對沖次數)，建議搭配 --async 使用
+HEDGE = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_S = 0.05
+LATENCY_WINDOW = 200
+
+# 本行程的累計次數，供執行摘要使用
+POLICY_STATS = collections.Counter()
+
+_lock = threading.Lock()
+_latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+# 同步模式的對沖需要在另一個執行緒送出請求 (無法取消的一方會跑到逾時或完成為止)
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+class CallTimeout(TimeoutError):
+    """單次請求超過 timeout；主機仍在生成，不代表故障，因此連線池不會將主機標記為不健康"""
+
+
+class RetryBudget:
+    """依呼叫數累積的重試額度"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.calls = 0
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def try_spend(self):
+        """還有額度時扣一次並回傳 True"""
+        with self._lock:
+            if self.spent >= self.minimum + self.calls * self.ratio:
+                return False
+            self.spent += 1
+            return True
+
+
+budget = RetryBudget()
+
+
+def _parse_stage_values(items, cast):
+    """將 "階段=值" 字串清單 (或 {階段: 值}) 轉成字典並檢查階段名稱"""
+    if isinstance(items, (list, tuple)):
+        items = dict(item.split('=', 1) for item in items)
+    values = {}
+    for stage, value in (items or {}).items():
+        stage = stage.strip()
+        if stage not in POLICY_STAGES:
+            raise ValueError(f"未知的管線階段: {stage} (可用: {', '.join(POLICY_STAGES)})")
+        values[stage] = cast(value)
+    return values
+
+
+def configure(timeouts=None, num_predict=None, max_retries=None, retry_budget=None, hedge=None):
+    """
+    timeouts / num_predict 為 {階段: 值} 或 "階段=值" 字串的清單，未指定的階段維持原設定；
+    retry_budget 為重試預算佔呼叫數的比例。
+    """
+    global MAX_RETRIES, HEDGE, budget
+    STAGE_TIMEOUTS.update(_parse_stage_values(timeouts, float))
+    STAGE_NUM_PREDICT.update(_parse_stage_values(num_predict, int))
+    if max_retries is not None:
+        MAX_RETRIES = max(0, max_retries)
+    if retry_budget is not None:
+        budget = RetryBudget(ratio=retry_budget)
+    if hedge is not None:
+        HEDGE = hedge
+
+
+def describe():
+    """目前設定的摘要字串"""
+    timeouts = "、".join(f"{stage} {STAGE_TIMEOUTS[stage]:g}s" for stage in POLICY_STAGES)
+    hedge = f"，對沖 p{HEDGE_PERCENTILE}" if HEDGE else ""
+    return f"逾時 {timeouts}；重試最多 {MAX_RETRIES} 次 (預算 {budget.ratio:.0%}){hedge}"
+
+
+def prepare(stage, kwargs):
+    """套用階段的 timeout 與 num_predict (呼叫端已指定者優先)，回傳新的 kwargs"""
+    kwargs = dict(kwargs)
+    timeout = STAGE_TIMEOUTS.get(stage)
+    if timeout and 'timeout' not in kwargs:
+        kwargs['timeout'] = timeout
+    num_predict = STAGE_NUM_PREDICT.get(stage)
+    if num_predict:
+        options = dict(kwargs.get('options') or {})
+        options.setdefault('num_predict', num_predict)
+        kwargs['options'] = options
+    return kwargs
+
+
+def hedge_delay(stage):
+    """該階段應在多久後送出對沖請求；未啟用或樣本不足時回傳 None"""
+    if not HEDGE:
+        return None
+    with _lock:
+        samples = list(_latencies[stage])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(HEDGE_MIN_DELAY_S, pipeline_metrics.percentile(samples, HEDGE_PERCENTILE))
+
+
+def _record_latency(stage, elapsed):
+    with _lock:
+        _latencies[stage].append(elapsed)
+
+
+def _is_retryable(error):
+    if isinstance(error, (CallTimeout, ConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    return isinstance(error, ollama.ResponseError) and status is not None and (status >= 500 or status == 429)
+
+
+def start_call():
+    """每個邏輯呼叫 (不含重試) 計一次，累積重試預算"""
+    budget.record_call()
+    POLICY_STATS['calls'] += 1
+
+
+def retry_delay(stage, error, attempt, allowed=True):
+    """
+    決定第 attempt 次失敗後是否重試 (會扣重試預算)，需要重試時回傳退避秒數，否則回傳 None。
+    allowed=False 用於已輸出部分內容、無法重來的串流，只計入統計。
+    """
+    if isinstance(error, CallTimeout):
+        POLICY_STATS['timeouts'] += 1
+    if not allowed or not _is_retryable(error) or attempt >= MAX_RETRIES:
+        return None
+    if not budget.try_spend():
+        POLICY_STATS['budget_exhausted'] += 1
+        print(f"重試預算已用盡，{stage} 呼叫不再重試: {error}")
+        return None
+    POLICY_STATS['retries'] += 1
+    delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt) * random.uniform(0.5, 1.0)
+    print(f"{stage} 呼叫失敗 ({error})，{delay:.1f} 秒後重試 (第 {attempt + 1} 次)")
+    return delay
+
+
+def _first_success(futures, primary):
+    """同步對沖：回傳最先成功的結果；兩邊都失敗時拋出主請求的錯誤"""
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    POLICY_STATS['hedge_wins'] += 1
+                return future.result()
+    return primary.result()
+
+
+def _hedged(stage, chat, kwargs, delay):
+    """同步對沖：輸掉的一方無法取消，會在背景執行緒跑到完成或逾時為止 (結果直接丟棄)"""
+    primary = _hedge_executor.submit(chat, **kwargs)
+    try:
+        return primary.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+        pass
+    if not budget.try_spend():
+        POLICY_STATS['budget_exhausted'] += 1
+        return primary.result()
+    POLICY_STATS['hedges'] += 1
+    hedge = _hedge_executor.submit(chat, **kwargs)
+    return _first_success([primary, hedge], primary)
+
+
+async def _hedged_async(stage, chat, kwargs, delay):
+    primary = asyncio.ensure_future(chat(**kwargs))
+    tasks = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return primary.result()
+        if not budget.try_spend():
+            POLICY_STATS['budget_exhausted'] += 1
+            return await primary
+        POLICY_STATS['hedges'] += 1
+        tasks.append(asyncio.ensure_future(chat(**kwargs)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        POLICY_STATS['hedge_wins'] += 1
+                    return task.result()
+        return primary.result()
+    finally:
+        # 輸掉的請求直接取消 (連線中斷後 Ollama 會停止生成)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def call(stage, chat, kwargs):
+    """依 stage 的設定呼叫 chat(**kwargs)：套用逾時與 num_predict，必要時對沖與重試"""
+    kwargs = prepare(stage, kwargs)
+    start_call()
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            delay = hedge_delay(stage)
+            response = chat(**kwargs) if delay is None else _hedged(stage, chat, kwargs, delay)
+        except Exception as e:
+            backoff = retry_delay(stage, e, attempt)
+            if backoff is None:
+                raise
+            attempt += 1
+            time.sleep(backoff)
+            continue
+        _record_latency(stage, time.perf_counter() - start)
+        return response
+
+
+async def call_async(stage, chat, kwargs):
+    """call 的非同步版本 (chat 為協程函式)"""
+    kwargs = prepare(stage, kwargs)
+    start_call()
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            delay = hedge_delay(stage)
+            response = await (chat(**kwargs) if delay is None else _hedged_async(stage, chat, kwargs, delay))
+        except Exception as e:
+            backoff = retry_delay(stage, e, attempt)
+            if backoff is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(backoff)
+            continue
+        _record_latency(stage, time.perf_counter() - start)
+        return response
@@ -0,0 +1,320 @@
+# fake_ollama.py (本機模擬 Ollama /api/chat 的 HTTP 伺服器，供基準測試與離線驗證)
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pipeline_metrics
+
+CANNED_FEATURES = {
+    "ShoulderHeight_norm": 0.40, "BodyWeight_norm": 0.73, "MuzzleHeadRatio": 0.40,
+    "BlackNoseRequired": 1.00, "BlueEyesForbidden": 1.00, "ChestWidthDepth": 0.80,
+    "BodySquareness": 0.65, "HeadBreadthIndex": 0.70,
+}
+TARGET_JUDGMENT = "史大佛夏牛頭犬 (SBT)"
+OTHER_JUDGMENT = "其他犬種"
+CANNED_REPORT = """### 圖片 '{image}' 分析報告 ###
+一、綜合評估
+- 最終鑑定結論為「**史大佛夏牛頭犬 (SBT)**」，屬於「非管制犬種」。
+二、VLM 特徵分數
+- MuzzleHeadRatio: 0.40
+- HeadBreadthIndex: 0.70
+三、PNN 鑑定依據
+如照片所示，此犬隻的吻部較短、頭骨寬闊，與 PNN 計算結果一致。
+四、免責聲明
+本報告僅為基於提供之照片與分析指南的初步AI評估，不具法律效力。
+"""
+CANNED_APPEARANCE = "照片中的犬隻吻部較長、頭型窄，被毛蓬鬆，與比特型犬種短吻、寬頭、短毛的特徵明顯不同。"
+
+
+class FakeOllamaConfig:
+    """模擬伺服器的行為參數"""
+
+    def __init__(self, latency=0.01, prompt_tokens_per_s=50000.0, eval_tokens_per_s=20000.0,
+                 image_tokens=256, failure_rate=0.0, other_breed_ratio=0.5, parallel=4,
+                 load_duration=0.0, keep_alive=300.0, batch_drift=0.0, batch_malformed_rate=0.0,
+                 stall_rate=0.0, stall_latency=5.0, seed=0):
+        self.latency = latency                        # 每次請求的固定延遲 (秒)
+        self.prompt_tokens_per_s = prompt_tokens_per_s
+        self.eval_tokens_per_s = eval_tokens_per_s
+        self.image_tokens = image_tokens              # 每張圖片計入的 prompt token 數
+        self.failure_rate = failure_rate              # 回傳 HTTP 500 的機率
+        self.other_breed_ratio = other_breed_ratio    # 初步意見為「其他犬種」的圖片比例
+        self.parallel = parallel                      # 模擬 OLLAMA_NUM_PARALLEL
+        self.load_duration = load_duration            # 模型未載入 (冷啟動) 時額外的載入時間
+        self.keep_alive = keep_alive                  # 請求未指定 keep_alive 時模型閒置多久後卸載 (秒)
+        self.batch_drift = batch_drift                # 多圖批次萃取時每多一張圖片，分數額外加入的雜訊標準差
+        self.batch_malformed_rate = batch_malformed_rate  # 批次萃取回傳錯誤長度陣列的機率
+        self.stall_rate = stall_rate                  # 請求卡住 (模擬長尾延遲或不停生成) 的機率
+        self.stall_latency = stall_latency            # 卡住的請求額外花費的秒數
+        self.seed = seed
+
+
+def parse_keep_alive(value, default):
+    """將 keep_alive ("30m"、"90s"、600、-1 等) 轉為秒數；負值代表永久常駐"""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        text = str(value).strip()
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        unit = next((u for u in ("ms", "s", "m", "h") if text.endswith(u)), "")
+        seconds = float(text[:-len(unit)] if unit else text) * units.get(unit, 1)
+    return float("inf") if seconds < 0 else seconds
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, FakeOllamaHandler)
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.stats = {"requests": 0, "failures": 0, "stalls": 0, "features": 0, "combined": 0,
+                      "features_batch": 0, "judgment": 0, "report": 0, "appearance": 0, "other": 0}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(config.parallel)
+        self.loaded_models = {}   # 模型 -> 卸載時間 (time.monotonic())
+
+    @property
+    def host(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def classify_request(self, body):
+        """依提示詞內容判斷是哪一個管線階段的請求"""
+        messages = body.get("messages") or []
+        prompt = "\n".join(str(m.get("content", "")) for m in messages)
+        if "PreliminaryJudgment" in prompt:
+            return "combined"
+        if "ShoulderHeight_norm" in prompt and "JSON" in prompt and "報告" not in prompt:
+            schema = body.get("format")
+            if isinstance(schema, dict) and "images" in schema.get("properties", {}):
+                return "features_batch"
+            return "features"
+        if "外觀描述" in prompt:
+            return "appearance"
+        if "第一直覺" in prompt:
+            return "judgment"
+        if "報告" in prompt:
+            return "report"
+        return "other"
+
+    def judgment_for(self, body):
+        """依圖片內容決定初步意見，讓同一張圖片每次得到相同答案"""
+        images = [img for m in body.get("messages") or [] for img in (m.get("images") or [])]
+        digest = hashlib.sha256("".join(images).encode()).digest()
+        return OTHER_JUDGMENT if digest[0] / 256 < self.config.other_breed_ratio else TARGET_JUDGMENT
+
+    def batch_features(self, body):
+        """多圖批次萃取：每張圖片一組特徵，依 batch_drift 加入隨批次大小增加的雜訊"""
+        count = sum(len(m.get("images") or []) for m in body.get("messages") or [])
+        sigma = self.config.batch_drift * (count - 1)
+        with self.lock:
+            if self.random.random() < self.config.batch_malformed_rate:
+                count -= 1
+            noise = [[self.random.gauss(0.0, sigma) if sigma else 0.0 for _ in CANNED_FEATURES]
+                     for _ in range(count)]
+        images = [{key: round(min(1.0, max(0.0, value + delta)), 3)
+                   for (key, value), delta in zip(CANNED_FEATURES.items(), row)} for row in noise]
+        return json.dumps({"images": images})
+
+    def build_content(self, kind, body):
+        if kind == "features":
+            return json.dumps(CANNED_FEATURES)
+        if kind == "features_batch":
+            return self.batch_features(body)
+        if kind == "combined":
+            return json.dumps({**CANNED_FEATURES, "PreliminaryJudgment": self.judgment_for(body)},
+                              ensure_ascii=False)
+        if kind == "judgment":
+            return self.judgment_for(body)
+        if kind == "appearance":
+            return CANNED_APPEARANCE
+        if kind == "report":
+            return CANNED_REPORT.format(image="fake")
+        return "OK"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path in ("/", "/api/version"):
+            self._send_json(200, {"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            # 假伺服器接受任何模型名稱；只列出曾被呼叫過的模型
+            with self.server.lock:
+                models = sorted(self.server.loaded_models)
+            self._send_json(200, {"models": [{"name": name, "model": name} for name in models]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/api/chat":
+            self._send_json(404, {"error": f"unsupported endpoint {self.path}"})
+            return
+        try:
+            self.handle_chat(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 用戶端已逾時或取消 (例如對沖請求的另一份先回來了)
+
+    def handle_chat(self, body):
+        server = self.server
+        config = server.config
+        kind = server.classify_request(body)
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats[kind] += 1
+            fail = server.random.random() < config.failure_rate
+            stall_s = config.stall_latency if server.random.random() < config.stall_rate else 0.0
+            if stall_s:
+                server.stats["stalls"] += 1
+            model = body.get("model", "")
+            now = time.monotonic()
+            cold = server.loaded_models.get(model, 0.0) <= now
+            keep_alive = parse_keep_alive(body.get("keep_alive"), config.keep_alive)
+            server.loaded_models[model] = now + keep_alive
+
+        with server.slots:
+            if fail:
+                time.sleep(config.latency)
+                with server.lock:
+                    server.stats["failures"] += 1
+                self._send_json(500, {"error": "fake ollama: injected failure"})
+                return
+
+            messages = body.get("messages") or []
+            if not messages:
+                # 不帶訊息的請求只載入模型 (Ollama 的 preload 行為)
+                load_s = config.load_duration if cold else 0.0
+                time.sleep(load_s)
+                self._send_json(200, {"model": model, "message": {"role": "assistant", "content": ""},
+                                      "done": True, "done_reason": "load",
+                                      "load_duration": int(load_s * 1e9)})
+                return
+
+            content = server.build_content(kind, body)
+            n_images = sum(len(m.get("images") or []) for m in messages)
+            prompt_tokens = sum(pipeline_metrics.estimate_tokens(str(m.get("content", ""))) for m in messages) \
+                + n_images * config.image_tokens
+            eval_tokens = pipeline_metrics.estimate_tokens(content)
+            done_reason = "stop"
+            num_predict = (body.get("options") or {}).get("num_predict") or 0
+            if 0 < num_predict < eval_tokens:
+                # 同 Ollama：達到 num_predict 即停止生成
+                content = content[:max(1, len(content) * num_predict // eval_tokens)]
+                eval_tokens, done_reason = num_predict, "length"
+            load_s = config.load_duration if cold else 0.0
+            prompt_s = prompt_tokens / config.prompt_tokens_per_s
+            eval_s = eval_tokens / config.eval_tokens_per_s
+            if body.get("stream"):
+                time.sleep(config.latency + stall_s + load_s + prompt_s)
+                self._stream_content(model, content, eval_s)
+            else:
+                time.sleep(config.latency + stall_s + load_s + prompt_s + eval_s)
+
+        total_s = config.latency + stall_s + load_s + prompt_s + eval_s
+        final = {
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": "" if body.get("stream") else content},
+            "done": True,
+            "done_reason": done_reason,
+            "total_duration": int(total_s * 1e9),
+            "load_duration": int(load_s * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_s * 1e9),
+            "eval_count": eval_tokens,
+            "eval_duration": int(eval_s * 1e9),
+        }
+        if body.get("stream"):
+            self._write_chunk(json.dumps(final, ensure_ascii=False).encode("utf-8") + b"\n")
+            self._write_chunk(b"")
+        else:
+            self._send_json(200, final)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_content(self, model, content, eval_s):
+        """以 NDJSON 逐行送出 content (同 Ollama 的 stream=True)，生成時間依各行長度分攤"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = content.splitlines(keepends=True) or [content]
+        for piece in pieces:
+            time.sleep(eval_s * len(piece) / max(1, len(content)))
+            part = {"model": model, "message": {"role": "assistant", "content": piece}, "done": False}
+            self._write_chunk(json.dumps(part, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+def start_fake_ollama(config=None, host="127.0.0.1", port=0):
+    """於背景執行緒啟動模擬伺服器，回傳 server (以 server.host 取得網址、server.shutdown() 停止)"""
+    server = FakeOllamaServer((host, port), config or FakeOllamaConfig())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="模擬 Ollama /api/chat 的本機伺服器")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--latency', type=float, default=0.01, help="每次請求的固定延遲 (秒)")
+    parser.add_argument('--prompt-tps', type=float, default=50000.0, help="prompt-eval tokens/sec")
+    parser.add_argument('--eval-tps', type=float, default=20000.0, help="生成 tokens/sec")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="回傳 HTTP 500 的機率")
+    parser.add_argument('--other-ratio', type=float, default=0.5, help="初步意見為「其他犬種」的比例")
+    parser.add_argument('--parallel', type=int, default=4, help="同時處理的請求數 (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument('--load-duration', type=float, default=0.0, help="冷啟動載入時間 (秒)")
+    parser.add_argument('--keep-alive', type=float, default=300.0, help="請求未指定時模型的常駐時間 (秒)")
+    parser.add_argument('--batch-drift', type=float, default=0.0,
+                        help="批次萃取時每多一張圖片，特徵分數額外加入的雜訊標準差")
+    parser.add_argument('--batch-malformed-rate', type=float, default=0.0,
+                        help="批次萃取回傳錯誤長度陣列的機率")
+    parser.add_argument('--stall-rate', type=float, default=0.0, help="請求卡住 (長尾延遲) 的機率")
+    parser.add_argument('--stall-latency', type=float, default=5.0, help="卡住的請求額外花費的秒數")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = FakeOllamaConfig(latency=args.latency, prompt_tokens_per_s=args.prompt_tps,
+                              eval_tokens_per_s=args.eval_tps, failure_rate=args.failure_rate,
+                              other_breed_ratio=args.other_ratio, parallel=args.parallel,
+                              load_duration=args.load_duration, keep_alive=args.keep_alive,
+                              batch_drift=args.batch_drift, batch_malformed_rate=args.batch_malformed_rate,
+                              stall_rate=args.stall_rate, stall_latency=args.stall_latency)
+    server = FakeOllamaServer((args.host, args.port), config)
+    print(f"模擬 Ollama 伺服器已啟動: {server.host}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"請求統計: {server.stats}")
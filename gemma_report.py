@@ -1,8 +1,17 @@
 # gemma_report.py
 
-import ollama
-import base64
+import collections
+import json
 import os
+
+import image_asset
+import image_preprocess
+import model_routing
+import ollama_pool
+import pipeline_metrics
+import pnn_model
+import vlm_cache
+import vlm_numeric
 # --- 1. 新增：從 pnn_model 導入 IDEAL_VECTORS ---
 # 這樣我們就可以在 Prompt 中使用 PNN 的理想值
 try:
@@ -14,23 +23,10 @@ except ImportError:
 # --- 結束新增 ---
 
 
-# --- 2. 圖片轉 Base64 輔助函式  ---
-def image_to_base64(image_path):
-    """讀取圖片檔並回傳 Base64 編碼的字串"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-# --- 3. 「二次鑑定」函式  ---
-def get_preliminary_judgment(image_path):
-    """
-    第二次呼叫 VLM，只為了獲取它的「初步專家意見」。
-    """
-    if not os.path.exists(image_path):
-        return "無法讀取圖片"
+# 修改 build_report_prompt 中的報告模板時請遞增，讓批次 manifest 與快取知道舊報告已過期
+REPORT_PROMPT_VERSION = 2
 
-    b64_image = image_to_base64(image_path)
-    
-    prompt = """
+JUDGMENT_PROMPT = """
     你是一位頂尖的犬隻品種鑑定專家。
     請只看這張圖片，憑你的第一直覺，判斷這隻狗最接近以下哪個分類？
 
@@ -49,27 +45,180 @@ def get_preliminary_judgment(image_path):
     請一律歸類為「其他犬種」。
 
     請只回傳你選擇的「一個」分類名稱，不要有任何其他文字或解釋。
+"""
+
+# 四種比特犬各自的中英文名稱與縮寫 (小寫)，is_target_breed 與 judgment_label 共用
+BREED_ALIASES = {
+    "美國比特鬥牛犬 (APBT)": ("美國比特鬥牛犬", "american pit bull terrier", "apbt"),
+    "美國史大佛夏牛頭犬 (AmStaff)": ("美國史大佛夏牛頭犬", "american staffordshire terrier", "amstaff"),
+    "史大佛夏牛頭犬 (SBT)": ("史大佛夏牛頭犬", "staffordshire bull terrier", "sbt"),
+    "美國惡霸犬 (American Bully)": ("美國惡霸犬", "american bully", "bully"),
+}
+
+# 初步意見中出現以下任一關鍵字，即視為「四種比特犬之一」
+TARGET_BREEDS_CHECK = [alias for aliases in BREED_ALIASES.values() for alias in aliases]
+
+
+# --- 2. 圖片轉 Base64 輔助函式  ---
+def image_to_base64(image_path):
+    """讀取圖片檔並回傳 Base64 編碼的字串 (image_path 可為路徑或 ImageAsset)"""
+    return image_asset.as_asset(image_path).b64
+
+def is_target_breed(prelim_judgment):
+    """初步意見是否落在四種比特型犬種之內"""
+    judgment_lower = prelim_judgment.lower()
+    return any(target in judgment_lower for target in TARGET_BREEDS_CHECK)
+
+def _judgment_messages(b64_image):
+    return [
+        {
+            'role': 'user',
+            'content': JUDGMENT_PROMPT,
+            'images': [b64_image]
+        }
+    ]
+
+def _clean_judgment(response):
+    return response['message']['content'].strip().replace("\"", "")
+
+# --- 3. 「二次鑑定」函式  ---
+def _judgment_cache_key(asset, model):
+    return vlm_cache.VLMCache.make_key_from_digest(
+        asset.sha256, f"{model}|{image_preprocess.signature()}", JUDGMENT_PROMPT)
+
+def _cached_judgment(asset, cache_key):
+    judgment = vlm_cache.judgment_cache.get(cache_key)
+    if judgment is not None:
+        print(f"快取命中，略過 VLM 初步意見鑑定: {asset.filename} -> {judgment}")
+        pipeline_metrics.annotate('judgment', cache_hit=True)
+    return judgment
+
+def _call_judgment(asset, model):
+    cache_key = _judgment_cache_key(asset, model)
+    cached = _cached_judgment(asset, cache_key)
+    if cached is not None:
+        return cached
+    print(f"正在呼叫 VLM ({model}) 進行「初步專家意見」鑑定: {asset.filename}...")
+    response = pipeline_metrics.timed_chat(
+        'judgment', ollama_pool.chat,
+        model=model, # 使用 VLM 模型
+        messages=_judgment_messages(asset.model_b64)
+    )
+    judgment = _clean_judgment(response)
+    print(f"VLM 初步意見為: {judgment} ({asset.filename})")
+    vlm_cache.judgment_cache.put(cache_key, judgment)
+    return judgment
+
+async def _call_judgment_async(asset, model, client):
+    cache_key = _judgment_cache_key(asset, model)
+    cached = _cached_judgment(asset, cache_key)
+    if cached is not None:
+        return cached
+    print(f"正在呼叫 VLM ({model}) 進行「初步專家意見」鑑定: {asset.filename}...")
+    response = await pipeline_metrics.timed_chat_async(
+        'judgment', client.chat,
+        model=model,
+        messages=_judgment_messages(asset.model_b64)
+    )
+    judgment = _clean_judgment(response)
+    print(f"VLM 初步意見為: {judgment} ({asset.filename})")
+    vlm_cache.judgment_cache.put(cache_key, judgment)
+    return judgment
+
+def get_preliminary_judgment(image_path, model=None):
     """
-    
+    第二次呼叫 VLM，只為了獲取它的「初步專家意見」。
+    image_path 可為路徑字串或 ImageAsset (與其他階段共用同一份編碼)；
+    model 預設為 judgment 階段設定的模型。
+    """
+    asset = image_asset.as_asset(image_path)
+    if not asset.exists():
+        return "無法讀取圖片"
+
     try:
-        print("正在呼叫 VLM 進行「初步專家意見」鑑定...")
-        response = ollama.chat(
-            model='gemma3:27b-it-qat', # 使用 VLM 模型
-            messages=[
-                {
-                    'role': 'user',
-                    'content': prompt,
-                    'images': [b64_image]
-                }
-            ]
-        )
-        judgment = response['message']['content'].strip().replace("\"", "")
-        print(f"VLM 初步意見為: {judgment}")
-        return judgment
+        return _call_judgment(asset, model or model_routing.model_for('judgment'))
+    except Exception as e:
+        print(f"獲取 VLM 初步意見時發生錯誤: {e}")
+        return "鑑定失敗"
+
+async def get_preliminary_judgment_async(image_path, client, model=None):
+    """get_preliminary_judgment 的非同步版本，使用傳入的 ollama.AsyncClient"""
+    asset = image_asset.as_asset(image_path)
+    if not asset.exists():
+        return "無法讀取圖片"
+
+    try:
+        return await _call_judgment_async(asset, model or model_routing.model_for('judgment'), client)
     except Exception as e:
         print(f"獲取 VLM 初步意見時發生錯誤: {e}")
         return "鑑定失敗"
 
+# --- 小模型 → 大模型升級 ---
+def judgment_label(prelim_judgment):
+    """
+    將初步意見對應到唯一的分類標籤 (與 is_target_breed 使用同一份 BREED_ALIASES，中英文名稱與縮寫皆可)；
+    無法對應或同時符合多個分類時回傳 None
+    """
+    text = prelim_judgment.strip().lower()
+    aliases = dict(BREED_ALIASES)
+    for label in vlm_numeric.BREED_LABELS:
+        aliases.setdefault(label, (label.lower(),))
+    matched = [(label, alias) for label, names in aliases.items() for alias in names if alias in text]
+    # 「美國史大佛夏牛頭犬」包含「史大佛夏牛頭犬」，不同分類的名稱互相包含時只保留較長的名稱
+    labels = {label for label, alias in matched
+              if not any(other_label != label and alias in other and alias != other
+                         for other_label, other in matched)}
+    return labels.pop() if len(labels) == 1 else None
+
+def escalation_reason(prelim_judgment, classification_result=None, stage='judgment'):
+    """
+    初步意見是否需要改用升級模型重新鑑定：
+    'uncertain' 為回傳內容無法對應到單一分類；'disagree' 為與 PNN 的分類結果不一致。
+    該階段已使用升級模型時一律回傳 None。
+    """
+    if not model_routing.can_escalate(stage):
+        return None
+    label = judgment_label(prelim_judgment)
+    if label is None:
+        return "uncertain"
+    if classification_result is not None:
+        pnn_breed = classification_result.get('breed')
+        if pnn_breed in vlm_numeric.BREED_LABELS and pnn_breed != label:
+            return "disagree"
+    return None
+
+def escalate_judgment(image_path, prelim_judgment, classification_result=None, stage='judgment'):
+    """
+    需要升級時以 ESCALATION_MODEL 重新取得初步意見並回傳；不需要 (或重跑失敗) 時回傳 None。
+    stage 為產生原初步意見的階段 ('judgment' 或 'combined')。
+    """
+    reason = escalation_reason(prelim_judgment, classification_result, stage)
+    if reason is None:
+        return None
+    asset = image_asset.as_asset(image_path)
+    print(f"初步意見 '{prelim_judgment}' 需要確認 ({reason})，改用 {model_routing.ESCALATION_MODEL} 重新鑑定...")
+    model_routing.record_escalation(stage, reason)
+    try:
+        return _call_judgment(asset, model_routing.ESCALATION_MODEL)
+    except Exception as e:
+        print(f"升級模型鑑定時發生錯誤，沿用原初步意見: {e}")
+        return None
+
+async def escalate_judgment_async(image_path, prelim_judgment, client, classification_result=None,
+                                  stage='judgment'):
+    """escalate_judgment 的非同步版本"""
+    reason = escalation_reason(prelim_judgment, classification_result, stage)
+    if reason is None:
+        return None
+    asset = image_asset.as_asset(image_path)
+    print(f"初步意見 '{prelim_judgment}' 需要確認 ({reason})，改用 {model_routing.ESCALATION_MODEL} 重新鑑定: {asset.filename}")
+    model_routing.record_escalation(stage, reason)
+    try:
+        return await _call_judgment_async(asset, model_routing.ESCALATION_MODEL, client)
+    except Exception as e:
+        print(f"升級模型鑑定時發生錯誤，沿用原初步意見: {e}")
+        return None
+
 # 知識庫 (您的版本)
 PDF_KNOWLEDGE = {
     "美國比特鬥牛犬 (APBT)": "管制犬種。特徵：頭呈楔形（長三角柱型），兩耳之間顱骨寬平或略圓，吻部與頭顱長度比例約為2:3。高耳位。眼睛可為除了藍色以外的所有顏色，中等大小，圓形。鼻子大且鼻孔寬，鼻子可以是任何顏色。胸腔寬度不超過其深度",
@@ -90,53 +239,162 @@ def format_features_for_report(features):
     return "\n".join(report_lines)
 
 # --- 4. 新增：將 IDEAL_VECTORS 轉換為字串的輔助函式 ---
-def format_vectors_for_prompt():
-    """將 PNN 的理想值轉換為給 VLM 看的字串"""
+# 我們只挑選幾個最關鍵的特徵放入 Prompt，避免太長
+PROMPT_VECTOR_KEYS = ("MuzzleHeadRatio", "HeadBreadthIndex", "BodySquareness", "BlackNoseRequired")
+
+def format_vectors_for_prompt(ranked=None):
+    """
+    將 PNN 的理想值轉換為給 VLM 看的字串 (每個犬種一行)。
+    ranked 為 [(犬種, PNN 距離), ...]，只列出這些犬種並附上距離；為 None 時列出全部犬種。
+    """
+    if ranked is None:
+        ranked = [(breed, None) for breed in IDEAL_VECTORS]
     lines = []
-    for breed, features in IDEAL_VECTORS.items():
-        # 我們只挑選幾個最關鍵的特徵放入 Prompt，避免太長
-        line = (
-            f"- {breed}:\n"
-            f"  - MuzzleHeadRatio (理想值): {features['MuzzleHeadRatio']:.2f}\n"
-            f"  - HeadBreadthIndex (理想值): {features['HeadBreadthIndex']:.2f}\n"
-            f"  - BodySquareness (理想值): {features['BodySquareness']:.2f}\n"
-            f"  - BlackNoseRequired (理想值): {features['BlackNoseRequired']:.2f}"
-        )
-        lines.append(line)
+    for breed, distance in ranked:
+        features = IDEAL_VECTORS[breed]
+        values = "、".join(f"{key} {features[key]:.2f}" for key in PROMPT_VECTOR_KEYS)
+        label = breed if distance is None else f"{breed} (PNN 距離 {distance:.4f})"
+        lines.append(f"- {label}: {values}")
     return "\n".join(lines)
 # --- 結束新增 ---
 
-# --- 主函式：已升級 VLM 否決權優先邏輯 ---
-def generate_gemma_report(image_filename, features, classification_result, image_path):
+# --- 情況 B2 報告 Prompt 的 token 預算 ---
+# 撰寫要求等不含逐張圖片資料的內容集中在 REPORT_SYSTEM_PROMPT，以 system 訊息送在最前面且逐位元組固定，
+# Ollama 可在不同圖片之間重用這段前綴的 KV 快取；逐張圖片的資料與知識庫放在其後附圖片的 user 訊息。
+# 知識庫只列出 PNN 結論與距離最近的 REPORT_COMPETITORS 個易混淆犬種；估計的 token 數 (含靜態前綴)
+# 超過 REPORT_PROMPT_TOKENS 時由距離最遠的犬種開始刪減 (至少保留 PNN 結論)，0 代表不限
+REPORT_COMPETITORS = int(os.environ.get('REPORT_COMPETITORS', 2))
+REPORT_PROMPT_TOKENS = int(os.environ.get('REPORT_PROMPT_TOKENS', 1200))
+
+# 本次執行情況 B2 報告 Prompt 的估計 token 數累計 (full_tokens 為列出全部犬種時的數量)
+PROMPT_STATS = collections.Counter()
+
+REPORT_SYSTEM_PROMPT = """你是一位專業的犬隻品種鑑定報告撰寫員。
+你會看到一張照片，同時拿到 VLM 模組的「初步意見」、PNN 模組的「客觀計算」結果，以及兩份知識庫 (只列出 PNN 結論與距離最近的易混淆犬種)。
+
+報告撰寫要求:
+1. 以「### 圖片 '<圖片名稱>' 分析報告 ###」作為標題。
+2. **一、綜合評估**: 明確指出「最終鑑定結論」與「最終管制狀態」，並說明「系統判斷」所述 VLM 與 PNN 結果一致或衝突的情形 (衝突時以 PNN 的計算結果為最終結論)。
+3. **二、VLM 特徵分數**: 逐項列出「VLM 特徵分數」中的原始分數。
+4. **三、PNN 鑑定依據**: **請看著你眼前的照片**，將它的**實際外觀**與 PNN 的計算結果和特徵分數進行交叉比對。例如：「如照片所示，此犬隻的吻部確實較短、頭骨寬闊... 這與 PNN 計算出的低 MuzzleHeadRatio 分數和高 HeadBreadthIndex 分數一致。」
+5. **四、品種比較分析**: **請繼續看著照片**，將此犬隻與知識庫中列出的其他易混淆犬種進行**客觀的特徵比對**，找出**關鍵的差異點**，說明 PNN 為何做出此判定。
+   - **[強制規則]** 你**必須**使用「VLM 特徵分數」中的**具體數值**，並將其與「知識庫 1 (PNN 理想值)」中的**理想值**進行**正確的數學比較**。
+   - 如果某個特徵**相符**（例如鼻子都是黑色），**請先誠實地指出這一點**，然後**再強調其他不相符的特徵**。
+   - **[範例]**：「...與 APBT 進行比較：此犬隻的 MuzzleHeadRatio 分數為 0.40，這**遠低於** APBT 的理想值 (0.70)，這是一個關鍵差異點。」
+6. **五、免責聲明**: 加入「本報告僅為基於提供之照片與分析指南的初步AI評估，不具法律效力。最終品種認定應由專業獸醫師或相關權責單位進行。」
+"""
+
+# 固定前綴的估計 token 數；送出前的預算判斷只能用估計值，實際數字見 PROMPT_STATS["prompt_eval_tokens"]
+STATIC_PROMPT_TOKENS = pipeline_metrics.estimate_tokens(REPORT_SYSTEM_PROMPT)
+
+def set_prompt_budget(tokens=None, competitors=None):
+    global REPORT_PROMPT_TOKENS, REPORT_COMPETITORS
+    if tokens is not None:
+        REPORT_PROMPT_TOKENS = max(0, tokens)
+    if competitors is not None:
+        REPORT_COMPETITORS = max(0, competitors)
+
+def _breed_distances(features, classification_result):
     """
-    使用 Gemma 生成包含「PNN計算」與「VLM初判」對比的詳細分析報告。
+    PNN 各犬種距離 [(犬種, 距離), ...]：取自產生 classification_result 的那次分類 (classify_breed 回傳的
+    distances)，報告中的距離才會與結論一致；舊格式的結果沒有距離時才以目前參數與預設開關重新計算
     """
-    
-    prelim_judgment = get_preliminary_judgment(image_path)
-    
-    target_breeds_check = [
-        "american pit bull terrier", "apbt",
-        "american staffordshire terrier", "amstaff",
-        "staffordshire bull terrier", "sbt",
-        "american bully", "bully"
-    ]
-    
-    is_target_breed = False
-    for target in target_breeds_check:
-        if target in prelim_judgment.lower():
-            is_target_breed = True
+    distances = (classification_result or {}).get('distances')
+    if distances:
+        return [(breed, float(distances[breed])) for breed in pnn_model.BREED_NAMES if breed in distances]
+    result = pnn_model.classify_breeds(pnn_model.features_to_matrix([features]))
+    return [(breed, float(distance)) for breed, distance in zip(pnn_model.BREED_NAMES, result["distances"][0])]
+
+def _ranked_breeds(features, classification_result):
+    """PNN 結論排第一，其餘犬種依距離由近到遠排列"""
+    final_breed = classification_result['breed']
+    distances = _breed_distances(features, classification_result)
+    return sorted(distances, key=lambda item: (item[0] != final_breed, item[1]))
+
+def _b2_sections(image_filename, features, classification_result, prelim_judgment, ranked):
+    """情況 B2 逐張圖片的各段內容 (分段以便各自估計 token 數)"""
+    final_breed = classification_result['breed']
+    if judgment_label(prelim_judgment) == final_breed:
+        consistency_note = f"系統判斷一致：VLM 初步專家意見 ({prelim_judgment}) 與 PNN 嚴格計算結果 ({final_breed}) 均指向同一犬種。"
+    else:
+        consistency_note = f"**系統判斷衝突**：VLM 初步專家意見為「{prelim_judgment}」，但 PNN 模組的嚴格特徵計算結果為「{final_breed}」。本報告將以 PNN 的計算結果為最終結論。"
+    knowledge = "\n".join(f"- {breed}: {PDF_KNOWLEDGE[breed]}" for breed, _ in ranked if breed in PDF_KNOWLEDGE)
+    return {
+        "data": (f"**分析數據:**\n"
+                 f"- **圖片名稱:** {image_filename}\n"
+                 f"- **VLM 初步專家意見:** {prelim_judgment}\n"
+                 f"- **PNN 計算結果:** {final_breed}\n"
+                 f"- **最終鑑定結論:** {final_breed}\n"
+                 f"- **最終管制狀態:** {classification_result['status']}\n"
+                 f"- **系統判斷:** {consistency_note}\n"),
+        "features": f"**VLM 特徵分數:**\n{format_features_for_report(features)}\n",
+        "vectors": f"**知識庫 1 (PNN 理想值，依 PNN 距離排序):**\n{format_vectors_for_prompt(ranked)}\n",
+        "knowledge": f"**知識庫 2 (PDF 文字描述):**\n{knowledge}\n",
+    }
+
+def build_b2_data_prompt(image_filename, features, classification_result, prelim_judgment):
+    """
+    情況 B2 附圖片的 user 訊息內容 (接在 REPORT_SYSTEM_PROMPT 之後)，依 token 預算刪減知識庫中的犬種。
+    回傳 (內容, 預算資訊)；預算資訊含各段估計 token 數 sections (含 static)、送出的估計總數 tokens、
+    列出全部犬種時的估計總數 full_tokens 與保留的犬種數 breeds。只組 Prompt，不更新任何統計。
+    """
+    ranked = [item for item in _ranked_breeds(features, classification_result)
+              if item[0] in IDEAL_VECTORS]
+    keep = min(len(ranked), 1 + REPORT_COMPETITORS)
+    while True:
+        sections = _b2_sections(image_filename, features, classification_result, prelim_judgment, ranked[:keep])
+        tokens = {name: pipeline_metrics.estimate_tokens(text) for name, text in sections.items()}
+        total = STATIC_PROMPT_TOKENS + sum(tokens.values())
+        if not REPORT_PROMPT_TOKENS or total <= REPORT_PROMPT_TOKENS or keep <= 1:
             break
-            
+        keep -= 1
+
+    full = _b2_sections(image_filename, features, classification_result, prelim_judgment, ranked)
+    tokens["static"] = STATIC_PROMPT_TOKENS
+    budget = {
+        "sections": tokens,
+        "tokens": total,
+        "full_tokens": STATIC_PROMPT_TOKENS + sum(pipeline_metrics.estimate_tokens(text) for text in full.values()),
+        "breeds": keep,
+    }
+    return "".join(sections.values()), budget
+
+def _record_prompt_budget(budget):
+    """實際送出的情況 B2 報告請求才計入 PROMPT_STATS (僅供顯示或基準測試組出的 Prompt 不計)"""
+    PROMPT_STATS["prompts"] += 1
+    PROMPT_STATS["tokens"] += budget["tokens"]
+    PROMPT_STATS["full_tokens"] += budget["full_tokens"]
+    PROMPT_STATS["over_budget"] += bool(REPORT_PROMPT_TOKENS) and budget["tokens"] > REPORT_PROMPT_TOKENS
+    pipeline_metrics.annotate('report', prompt_tokens_est=budget["tokens"], prompt_breeds=budget["breeds"])
+
+def _record_prompt_eval(response):
+    """以回應的 prompt_eval_count (伺服器實際評估的 token 數，含圖片；KV 快取命中的前綴不計) 對照估計值"""
+    count = response.get('prompt_eval_count')
+    if count:
+        PROMPT_STATS["measured"] += 1
+        PROMPT_STATS["prompt_eval_tokens"] += count
+
+def build_report_messages(image_filename, features, classification_result, prelim_judgment, images):
+    """
+    組出報告請求的 messages：情況 B2 拆成固定的 system 前綴與附圖片的 user 訊息，
+    其餘情況沿用 build_report_prompt 的單一 user 訊息。只在實際送出請求前呼叫，B2 的預算統計在此記錄。
+    """
+    if report_case(prelim_judgment, classification_result) == "B2":
+        content, budget = build_b2_data_prompt(image_filename, features, classification_result, prelim_judgment)
+        _record_prompt_budget(budget)
+        return [{'role': 'system', 'content': REPORT_SYSTEM_PROMPT},
+                {'role': 'user', 'content': content, 'images': images}]
+    prompt = build_report_prompt(image_filename, features, classification_result, prelim_judgment)
+    return [{'role': 'user', 'content': prompt, 'images': images}]
+
+# --- 報告 Prompt 組裝：已升級 VLM 否決權優先邏輯 ---
+def build_report_prompt(image_filename, features, classification_result, prelim_judgment):
+    """
+    依「VLM 初判」與「PNN 計算」結果組出最終報告的 Prompt。
+    """
     prompt = "" 
 
-    try:
-        b64_image_for_report = image_to_base64(image_path)
-        image_list_for_report = [b64_image_for_report]
-    except Exception as e:
-        print(f"錯誤：無法編碼圖片 {image_path} 以用於最終報告: {e}")
-        image_list_for_report = [] 
-    
-    if not is_target_breed:
+    if not is_target_breed(prelim_judgment):
         #
         # --- 情況 A：VLM 判斷為「其他犬種」(例如 "黃金獵犬") ---
         # (此區塊不變)
@@ -211,82 +469,329 @@ def generate_gemma_report(image_filename, features, classification_result, image
         else:
             #
             # --- 子情況 B2: VLM 和 PNN 都認為是「四種比特犬之一」 ---
+            # (實際呼叫時由 build_report_messages 拆成 system / user 兩則訊息，這裡合併成單一字串)
             #
-            consistency_note = ""
-            if final_breed.lower().split(" ")[-1].strip("()") in prelim_judgment.lower():
-                 consistency_note = f"系統判斷一致：VLM 初步專家意見 ({prelim_judgment}) 與 PNN 嚴格計算結果 ({final_breed}) 均指向同一犬種。"
-            else:
-                 consistency_note = f"**系統判斷衝突**：VLM 初步專家意見為「{prelim_judgment}」，但 PNN 模組的嚴格特徵計算結果為「{final_breed}」。本報告將以 PNN 的計算結果為最終結論。"
-
-            # --- *** 這裡是您要求的修改 *** ---
-            
-            # 獲取 PNN 理想值小抄
-            pnn_vectors_str = format_vectors_for_prompt()
-            
-            prompt = f"""
-            你是一位專業的犬隻品種鑑定報告撰寫員。
-            **你現在正在查看一張照片**，同時你手上有 VLM 模組的「初步意見」和 PNN 模組的「客觀計算」結果。
+            content, _ = build_b2_data_prompt(image_filename, features, classification_result, prelim_judgment)
+            prompt = REPORT_SYSTEM_PROMPT + "\n---\n" + content
+    # --- 結束邏輯 ---
+    return prompt
 
-            ---
-            **分析數據:**
-            - **圖片名稱:** {image_filename}
-            - **VLM 初步專家意見:** {prelim_judgment}
-            - **PNN 計算結果:** {pnn_breed}
-            - **最終鑑定結論:** {final_breed}
-            - **最終管制狀態:** {final_status}
+def _report_images(image_path):
+    try:
+        return [image_asset.as_asset(image_path).model_b64]
+    except Exception as e:
+        print(f"錯誤：無法編碼圖片 {image_path} 以用於最終報告: {e}")
+        return []
 
-            ---
-            **知識庫 1 (PNN 理想值小抄):**
-            (這是在 pnn_model.py 中定義的理想分數)
-            {pnn_vectors_str}
-            
-            **知識庫 2 (PDF 文字描述):**
-            - APBT: {PDF_KNOWLEDGE["美國比特鬥牛犬 (APBT)"]}
-            - AmStaff: {PDF_KNOWLEDGE["美國史大佛夏牛頭犬 (AmStaff)"]}
-            - SBT: {PDF_KNOWLEDGE["史大佛夏牛頭犬 (SBT)"]}
-            - American Bully: {PDF_KNOWLEDGE["美國惡霸犬 (American Bully)"]}
+# --- 快速報告：情況 A / B1 的內容幾乎完全由規則決定，改以本地模板產生 ---
+# llm: 全部交給模型撰寫；hybrid: 模板 + 只請模型寫一段外觀描述；template: 情況 A / B1 完全不呼叫模型
+REPORT_MODES = ("llm", "hybrid", "template")
+REPORT_MODE = os.environ.get('REPORT_MODE', 'llm')
+
+# 本次執行各種方式產生的報告數 (llm / hybrid / template)
+REPORT_STATS = collections.Counter()
+
+DISCLAIMER = "本報告僅為基於提供之照片與分析指南的初步AI評估，不具法律效力。最終品種認定應由專業獸醫師或相關權責單位進行。"
+
+APPEARANCE_PROMPT = """
+    你是一位犬隻品種鑑定報告撰寫員，請看著這張照片進行外觀描述。
+    請用 2~3 句話描述此犬隻的實際外觀（例如吻部長度、頭型、毛髮、體型），
+    並說明它與比特型犬種典型特徵（短吻、寬頭、短毛、壯碩身軀）{relation}。
+    只回傳描述文字本身，不要標題、條列或其他說明。
+"""
+
+# hybrid 模式外觀描述的生成長度上限 (tokens)
+APPEARANCE_MAX_TOKENS = 200
+
+def set_report_mode(mode):
+    global REPORT_MODE
+    if mode not in REPORT_MODES:
+        raise ValueError(f"未知的報告模式: {mode} (可用: {', '.join(REPORT_MODES)})")
+    REPORT_MODE = mode
+
+def report_case(prelim_judgment, classification_result):
+    """回傳報告屬於哪一種情況：'A' (VLM 判定非目標犬種)、'B1' (PNN 否決) 或 'B2'"""
+    if not is_target_breed(prelim_judgment):
+        return "A"
+    if classification_result and classification_result.get('breed') == "其他犬種":
+        return "B1"
+    return "B2"
+
+def uses_template(prelim_judgment, classification_result):
+    return REPORT_MODE != "llm" and report_case(prelim_judgment, classification_result) != "B2"
+
+def _appearance_messages(asset, case):
+    relation = "有哪些不符之處" if case == "A" else "的相符與不符之處"
+    return [
+        {
+            'role': 'user',
+            'content': APPEARANCE_PROMPT.format(relation=relation),
+            'images': _report_images(asset)
+        }
+    ]
+
+def _distance_lines(features, classification_result):
+    """PNN 各犬種距離的條列，供 B1 模板使用"""
+    distances = _breed_distances(features, classification_result)
+    nearest, min_distance = min(distances, key=lambda item: item[1])
+    lines = [f"- 與「{breed}」理想向量的(加權)距離: {distance:.4f}" for breed, distance in distances]
+    return min_distance, nearest, "\n".join(lines)
+
+def render_template_report(image_filename, features, classification_result, prelim_judgment,
+                           appearance=None):
+    """
+    以固定模板產生情況 A / B1 的報告 (章節與用語對應 build_report_prompt 中的撰寫要求)。
+    appearance 為模型撰寫的外觀描述；為 None 時改用固定說明。
+    """
+    case = report_case(prelim_judgment, classification_result)
+    lines = [f"### 圖片 '{image_filename}' 分析報告 ###", "一、綜合評估"]
+
+    if case == "A":
+        lines += [
+            "- 最終鑑定結論為「其他犬種」，屬於「非管制犬種」。",
+            f"- 理由：VLM 的初步專家意見判定此犬隻為「{prelim_judgment}」，此非農業部定義的四種比特型犬種。",
+            "二、鑑定依據",
+            appearance or "VLM 依整體外觀判定此犬隻不具比特型犬種的典型特徵（短吻、寬頭、短毛、壯碩身軀），"
+                          "因此本報告不進行 PNN 特徵比對。",
+            "三、免責聲明",
+            DISCLAIMER,
+        ]
+    elif case == "B1":
+        final_breed = classification_result['breed']
+        final_status = classification_result['status']
+        min_distance, nearest, distance_lines = _distance_lines(features, classification_result)
+        lines += [
+            f"- 最終鑑定結論為「{final_breed}」，屬於「{final_status}」。",
+            f"- 系統判斷衝突：VLM 初步專家意見為「{prelim_judgment}」，但 PNN 模組基於特徵分數的嚴格計算判定其不符合"
+            f"任何已知標準（距離超過閾值）。本報告將以 PNN 的計算結果為最終結論。",
+            "二、VLM 特徵分數",
+            format_features_for_report(features),
+            "三、鑑定依據",
+            f"- PNN 計算出的最小(加權)距離為 {min_distance:.4f}（最接近「{nearest}」），"
+            f"超過 {pnn_model.DISTANCE_THRESHOLD} 的閾值，因此判定為「{final_breed}」。",
+            distance_lines,
+        ]
+        if appearance:
+            lines.append(appearance)
+        lines += ["四、免責聲明", DISCLAIMER]
+    else:
+        raise ValueError("情況 B2 需由模型撰寫報告，無法使用模板")
+
+    return "\n".join(lines) + "\n"
+
+def _fast_report(asset, image_filename, features, classification_result, prelim_judgment, cache_key):
+    case = report_case(prelim_judgment, classification_result)
+    appearance = None
+    if REPORT_MODE == "hybrid":
+        try:
+            print(f"快速報告 (情況 {case})：只請模型撰寫外觀描述: {image_filename}...")
+            response = pipeline_metrics.timed_chat(
+                'report', ollama_pool.chat,
+                model=model_routing.model_for('report'),
+                messages=_appearance_messages(asset, case),
+                options={'num_predict': APPEARANCE_MAX_TOKENS}
+            )
+            appearance = response['message']['content'].strip()
+        except Exception as e:
+            print(f"外觀描述生成失敗，改用固定說明: {e}")
+    with pipeline_metrics.stage('report'):
+        report = render_template_report(image_filename, features, classification_result,
+                                        prelim_judgment, appearance)
+    REPORT_STATS["hybrid" if appearance else "template"] += 1
+    pipeline_metrics.annotate('report', template=case)
+    if appearance or REPORT_MODE == "template":
+        # hybrid 模式外觀描述失敗時的固定說明不寫入快取，下次仍會再請模型撰寫
+        vlm_cache.report_cache.put(cache_key, report)
+    print(f"快速報告 (情況 {case}) 產生完畢: {image_filename}")
+    return report
+
+async def _fast_report_async(asset, image_filename, features, classification_result, prelim_judgment,
+                             cache_key, client):
+    case = report_case(prelim_judgment, classification_result)
+    appearance = None
+    if REPORT_MODE == "hybrid":
+        try:
+            print(f"快速報告 (情況 {case})：只請模型撰寫外觀描述: {image_filename}...")
+            response = await pipeline_metrics.timed_chat_async(
+                'report', client.chat,
+                model=model_routing.model_for('report'),
+                messages=_appearance_messages(asset, case),
+                options={'num_predict': APPEARANCE_MAX_TOKENS}
+            )
+            appearance = response['message']['content'].strip()
+        except Exception as e:
+            print(f"外觀描述生成失敗，改用固定說明: {e}")
+    with pipeline_metrics.stage('report'):
+        report = render_template_report(image_filename, features, classification_result,
+                                        prelim_judgment, appearance)
+    REPORT_STATS["hybrid" if appearance else "template"] += 1
+    pipeline_metrics.annotate('report', template=case)
+    if appearance or REPORT_MODE == "template":
+        # hybrid 模式外觀描述失敗時的固定說明不寫入快取，下次仍會再請模型撰寫
+        vlm_cache.report_cache.put(cache_key, report)
+    print(f"快速報告 (情況 {case}) 產生完畢: {image_filename}")
+    return report
+
+# --- 報告快取：報告原文只取決於以下輸入，重新產生 HTML 時不必再呼叫模型 ---
+def report_cache_key(asset, features, classification_result, prelim_judgment):
+    """以圖片、特徵、PNN 結果、初步意見、報告模板版本與報告模式組出快取鍵"""
+    inputs = json.dumps({
+        "features": features,
+        "classification_result": classification_result,
+        "prelim_judgment": prelim_judgment,
+        "prompt_version": REPORT_PROMPT_VERSION,
+        # 情況 B2 一律由模型撰寫，切換報告模式時仍可沿用
+        "report_mode": REPORT_MODE if uses_template(prelim_judgment, classification_result) else "llm",
+        # 情況 B2 的 Prompt 內容隨 token 預算與列出的犬種數而不同
+        "prompt_budget": ([REPORT_PROMPT_TOKENS, REPORT_COMPETITORS]
+                          if report_case(prelim_judgment, classification_result) == "B2" else None),
+    }, ensure_ascii=False, sort_keys=True, default=str)
+    model_key = f"{model_routing.model_for('report')}|{image_preprocess.signature()}"
+    return vlm_cache.VLMCache.make_key_from_digest(asset.sha256, model_key, inputs)
+
+def _cached_report(asset, cache_key):
+    report = vlm_cache.report_cache.get(cache_key)
+    if report is not None:
+        print(f"報告快取命中，略過報告生成: {asset.filename}")
+        REPORT_STATS["cached"] += 1
+        pipeline_metrics.annotate('report', cache_hit=True)
+    return report
+
+# --- 主函式 ---
+TRUNCATION_NOTE = "(注意：報告長度達到生成 token 上限，以上內容可能不完整；請以 --num-predict report=<tokens> 調高上限後重新產生。)"
+
+def _emit(on_chunk, report):
+    """非串流取得的完整報告 (快取、模板或錯誤訊息) 一次交給 on_chunk"""
+    if on_chunk is not None:
+        on_chunk(report)
+    return report
+
+def _finish_llm_report(response, cache_key, image_filename, on_chunk=None, case=None):
+    """
+    模型撰寫完成的報告：寫入快取並回傳。達到生成上限 (done_reason 為 length) 的報告可能在句子中間被截斷，
+    在末尾加上標註 (串流時也交給 on_chunk) 且不寫入快取，下次重跑會重新產生。
+    case 為 "B2" 時另記錄實際的 prompt_eval_count，與送出前的估計值對照。
+    """
+    report = response['message']['content']
+    REPORT_STATS["llm"] += 1
+    if case == "B2":
+        _record_prompt_eval(response)
+    if response.get('done_reason') == 'length':
+        REPORT_STATS["truncated"] += 1
+        print(f"報告達到生成 token 上限而被截斷，不寫入快取: {image_filename}")
+        note = "\n" + TRUNCATION_NOTE
+        if on_chunk is not None:
+            on_chunk(note)
+        return report + note
+    vlm_cache.report_cache.put(cache_key, report)
+    print(f"Gemma 報告生成完畢: {image_filename}")
+    return report
+
+def _stream_error(streamed, on_chunk, e):
+    """串流中途失敗時，把錯誤訊息接在已輸出的內容之後，回傳與檔案內容一致的報告"""
+    error_msg = f"呼叫 Gemma (VLM 報告模式) 時發生錯誤: {e}"
+    print(error_msg)
+    tail = ("\n" + error_msg) if streamed else error_msg
+    on_chunk(tail)
+    return "".join(streamed) + tail
+
+def generate_gemma_report(image_filename, features, classification_result, image_path,
+                          prelim_judgment=None, on_chunk=None):
+    """
+    使用 Gemma 生成包含「PNN計算」與「VLM初判」對比的詳細分析報告。
+    若呼叫端已取得初步意見，可經由 prelim_judgment 傳入以省去一次 VLM 呼叫。
+    image_path 可為路徑字串或 ImageAsset。
+    on_chunk 不為 None 時以串流方式呼叫模型，每收到一段文字就交給 on_chunk (供逐步寫入 HTML)；
+    快取命中或模板報告則一次交出完整內容。回傳值一律為完整報告。
+    """
+    asset = image_asset.as_asset(image_path)
+    if prelim_judgment is None:
+        prelim_judgment = get_preliminary_judgment(asset)
+        prelim_judgment = escalate_judgment(asset, prelim_judgment, classification_result) or prelim_judgment
+    case = report_case(prelim_judgment, classification_result)
+    pipeline_metrics.set_result(judgment=prelim_judgment, case=case)
+
+    cache_key = report_cache_key(asset, features, classification_result, prelim_judgment)
+    cached = _cached_report(asset, cache_key)
+    if cached is not None:
+        return _emit(on_chunk, cached)
+
+    if uses_template(prelim_judgment, classification_result):
+        return _emit(on_chunk, _fast_report(asset, image_filename, features, classification_result,
+                                            prelim_judgment, cache_key))
+
+    messages = build_report_messages(image_filename, features, classification_result, prelim_judgment,
+                                     _report_images(asset))
+
+    if on_chunk is not None:
+        streamed = []
+        try:
+            print(f"正在以串流呼叫 Gemma (VLM 報告模式) 生成最終報告: {image_filename}...")
+            response = pipeline_metrics.timed_chat_stream(
+                'report', ollama_pool.chat_stream, lambda text: (streamed.append(text), on_chunk(text)),
+                model=model_routing.model_for('report'),
+                messages=messages
+            )
+        except Exception as e:
+            return _stream_error(streamed, on_chunk, e)
+        return _finish_llm_report(response, cache_key, image_filename, on_chunk, case=case)
 
-            ---
-            **報告撰寫要求:**
-            1.  以「### 圖片 '{image_filename}' 分析報告 ###」作為標題。
-            2.  **一、綜合評估**: 
-                - 明確指出最終鑑定結論為：「{final_breed}」，屬於「{final_status}」。
-                - {consistency_note}
-            3.  **二、VLM 特徵分數**: 列出 VLM 模組給出的 8 項原始分數：
-                {features_list_str}
-            4.  **三、PNN 鑑定依據**: 
-                - **請看著你眼前的照片**，將它的**實際外觀**與 PNN 的計算結果（{final_breed}）和特徵分數進行交叉比對。
-                - **舉例說明**：例如，如果 PNN 判斷為 AmStaff，請說明「如照片所示，此犬隻的吻部確實較短、頭骨寬闊... 這與 PNN 計算出的低 MuzzleHeadRatio 分數 ({features.get('MuzzleHeadRatio', 'N/A')}) 和高 HeadBreadthIndex 分數 ({features.get('HeadBreadthIndex', 'N/A')}) 一致。」
-            5.  **四、品種比較分析**: 
-                - **[新指令]** **請繼續看著照片**，將此犬隻（{final_breed}）與其他三種易混淆的犬種進行**客觀的特徵比對**。
-                - **[新指令]** 你的目標是**找出關鍵的差異點**，以說明為何 PNN 判定它為「{final_breed}」。
-                - **[強制規則]** 你**必須**使用「二、VLM 特徵分數」中的**具體數值**，並將其與「知識庫 1 (PNN 理想值小抄)」中的**理想值**進行**正確的數學比較**。
-                - **[新指令]** 如果某個特徵**相符**（例如鼻子都是黑色），**請先誠實地指出這一點**，然後**再強調其他不相符的特徵**。
-                - **[範例]**：「...與 APBT 進行比較：此犬隻的 MuzzleHeadRatio 分數為 {features.get('MuzzleHeadRatio', 'N/A')}，這**遠低於** APBT 的理想值 (0.70)，這是一個關鍵差異點。」
-            6.  **五、免責聲明**: 加入「本報告僅為基於提供之照片與分析指南的初步AI評估，不具法律效力。最終品種認定應由專業獸醫師或相關權責單位進行。」
-            """
-            # --- *** 修改結束 *** ---
-    # --- 結束邏輯 ---
-    
     try:
         print("正在呼叫 Gemma (VLM 報告模式) 生成最終報告...")
-        response = ollama.chat(
-            model='gemma3:27b-it-qat', # 使用 LLM/VLM 模型
-            messages=[
-                {
-                    'role': 'user',
-                    'content': prompt,
-                    'images': image_list_for_report 
-                }
-            ]
+        response = pipeline_metrics.timed_chat(
+            'report', ollama_pool.chat,
+            model=model_routing.model_for('report'), # 使用 LLM/VLM 模型
+            messages=messages
         )
         
-        report = response['message']['content']
-        print("Gemma 報告生成完畢。")
         # --- (回傳值) ---
-        return report # <-- 您的 batch_numeric.py 預期一個回傳值
+        return _finish_llm_report(response, cache_key, image_filename, case=case) # <-- 您的 batch_numeric.py 預期一個回傳值
     except Exception as e:
         error_msg = f"呼叫 Gemma (VLM 報告模式) 時發生錯誤: {e}"
         print(error_msg)
         # --- (回傳值) ---
         return error_msg # <-- 您的 batch_numeric.py 預期一個回傳值
+
+async def generate_gemma_report_async(image_filename, features, classification_result, image_path,
+                                      prelim_judgment, client, on_chunk=None):
+    """generate_gemma_report 的非同步版本；初步意見須由呼叫端先行取得 (串流時 client 須提供 chat_stream)"""
+    asset = image_asset.as_asset(image_path)
+    case = report_case(prelim_judgment, classification_result)
+    pipeline_metrics.set_result(judgment=prelim_judgment, case=case)
+    cache_key = report_cache_key(asset, features, classification_result, prelim_judgment)
+    cached = _cached_report(asset, cache_key)
+    if cached is not None:
+        return _emit(on_chunk, cached)
+
+    if uses_template(prelim_judgment, classification_result):
+        return _emit(on_chunk, await _fast_report_async(asset, image_filename, features, classification_result,
+                                                        prelim_judgment, cache_key, client))
+
+    messages = build_report_messages(image_filename, features, classification_result, prelim_judgment,
+                                     _report_images(image_path))
+
+    if on_chunk is not None:
+        streamed = []
+        try:
+            print(f"正在以串流呼叫 Gemma (VLM 報告模式) 生成最終報告: {image_filename}...")
+            response = await pipeline_metrics.timed_chat_stream_async(
+                'report', client.chat_stream, lambda text: (streamed.append(text), on_chunk(text)),
+                model=model_routing.model_for('report'),
+                messages=messages
+            )
+        except Exception as e:
+            return _stream_error(streamed, on_chunk, e)
+        return _finish_llm_report(response, cache_key, image_filename, on_chunk, case=case)
+
+    try:
+        print(f"正在呼叫 Gemma (VLM 報告模式) 生成最終報告: {image_filename}...")
+        response = await pipeline_metrics.timed_chat_async(
+            'report', client.chat,
+            model=model_routing.model_for('report'),
+            messages=messages
+        )
+        return _finish_llm_report(response, cache_key, image_filename, case=case)
+    except Exception as e:
+        error_msg = f"呼叫 Gemma (VLM 報告模式) 時發生錯誤: {e}"
+        print(error_msg)
+        return error_msg
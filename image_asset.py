@@ -0,0 +1,91 @@
+# image_asset.py (單張圖片的共用載入物件：讀檔一次、Base64 只編碼一次)
+
+import base64
+import hashlib
+import os
+
+import image_preprocess
+import pipeline_metrics
+
+
+class ImageAsset:
+    """
+    包裝一張圖片，讓 vlm_numeric、gemma_report 與 batch_numeric 共用同一份資料。
+    原始位元組只讀取一次；Base64 字串在第一次需要時才編碼，之後重複使用。
+    model_b64 (送給 VLM 的縮圖) 之後仍保留原始位元組，直到報告寫出時編碼 b64 (或產生縮圖) 為止，
+    讀檔始終只有一次；b64 編碼完成後才釋放原始位元組。處理完畢後呼叫 release() 釋放全部內容。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self._data = None
+        self._sha256 = None
+        self._b64 = None
+        self._model_b64 = None
+        self._memory = None
+
+    @classmethod
+    def from_bytes(cls, data, filename="upload"):
+        """以記憶體中的圖片內容建立 (例如 HTTP 上傳)，不落地；filename 只用於顯示與紀錄"""
+        asset = cls(filename)
+        asset._memory = bytes(data)
+        return asset
+
+    def exists(self):
+        return self._memory is not None or os.path.exists(self.path)
+
+    @property
+    def data(self):
+        """圖片原始位元組 (若已釋放則重新讀檔)"""
+        if self._data is None:
+            if self._memory is not None:
+                return self._memory
+            with open(self.path, "rb") as image_file:
+                self._data = image_file.read()
+        return self._data
+
+    @property
+    def sha256(self):
+        """圖片內容的 SHA-256 (供快取鍵使用)"""
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    @property
+    def b64(self):
+        """Base64 編碼字串，只編碼一次"""
+        if self._b64 is None:
+            data = self.data
+            if self._sha256 is None:
+                self._sha256 = hashlib.sha256(data).hexdigest()
+            self._b64 = base64.b64encode(data).decode('utf-8')
+            self._data = None
+        return self._b64
+
+    @property
+    def model_b64(self):
+        """縮到模型輸入解析度後的 Base64 字串 (送給 Ollama 用)，只處理一次"""
+        if self._model_b64 is None:
+            with pipeline_metrics.stage('image_prep'):
+                data = self.data
+                derived = image_preprocess.prepare_for_model(data, self.sha256)
+                self._model_b64 = base64.b64encode(derived).decode('utf-8')
+        return self._model_b64
+
+    def release(self):
+        """處理完畢後釋放所有快取的內容"""
+        self._data = None
+        self._b64 = None
+        self._model_b64 = None
+        self._memory = None
+
+    def __repr__(self):
+        return f"ImageAsset({self.path!r})"
+
+
+def as_asset(image):
+    """接受圖片路徑或 ImageAsset，一律回傳 ImageAsset"""
+    if isinstance(image, ImageAsset):
+        return image
+    return ImageAsset(image)
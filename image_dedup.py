@@ -0,0 +1,90 @@
+# image_dedup.py (以感知雜湊找出重複或近似的圖片，讓每組只跑一次 VLM 流程)
+
+import os
+
+import numpy as np
+
+import run_manifest
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安裝 Pillow 時只能找出內容完全相同的檔案
+    Image = None
+    ImageOps = None
+
+# 兩張圖片 dHash 的漢明距離 (64 位元中不同的位元數) 不超過此值即視為同一組。
+# 近似圖片可能是不同犬隻 (例如連拍)，沿用報告會連同管制結論一起沿用，因此預設為 None：
+# 只合併內容完全相同的檔案；>= 0 時才另以感知雜湊合併近似圖片；負值代表完全停用去重
+DEDUP_DISTANCE = None
+HASH_SIZE = 8
+
+
+def dhash(image_path):
+    """
+    計算 64 位元的差異雜湊 (dHash)：灰階縮成 9x8 後比較左右相鄰像素的亮度。
+    重新存檔、縮放或輕微壓縮的同一張照片會得到相同或極接近的雜湊。無法讀取時回傳 None。
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(image_path) as image:
+            # JPEG 可直接以縮小的比例解碼，大圖時可省下大部分解碼時間
+            image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            image = ImageOps.exif_transpose(image).convert('L')
+            image = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+            pixels = np.asarray(image, dtype=np.int16)
+    except Exception as e:
+        print(f"無法計算 {image_path} 的感知雜湊，視為獨立圖片: {e}")
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distances(hash_value, hashes):
+    """hash_value 與 hashes (uint64 陣列) 中每個雜湊的漢明距離"""
+    diff = np.bitwise_xor(hashes, np.uint64(hash_value))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def group_duplicates(image_paths, max_distance=DEDUP_DISTANCE, digests=None):
+    """
+    將 image_paths 分組，回傳 [(代表圖片, [同組的其他圖片]), ...]，順序依代表圖片在輸入中的位置。
+    內容完全相同的檔案一定同組；max_distance >= 0 時，其餘圖片與各組代表圖片的 dHash 漢明距離
+    <= max_distance 者併入距離最近的一組 (只與代表圖片比較，不會經由中間的圖片串連)。
+    代表圖片為組內檔案最大者 (通常解析度最高)，同大小時取排序在前者；max_distance 為負值時每張各自一組。
+    digests 若為 dict，會填入各圖片的 SHA-256 ({路徑: 雜湊})，供呼叫端沿用而不必重新讀檔。
+    """
+    paths = list(image_paths)
+    if max_distance is not None and max_distance < 0:
+        return [(path, []) for path in paths]
+    perceptual = max_distance is not None and Image is not None
+    sizes = [os.path.getsize(path) for path in paths]
+
+    # 由大到小處理，先出現的 (最大的) 圖片成為代表，之後的圖片只與代表比較
+    group_of = {}
+    seen = {}
+    leaders, leader_hashes = [], []
+    for i in sorted(range(len(paths)), key=lambda i: (-sizes[i], i)):
+        digest = run_manifest.file_sha256(paths[i])
+        if digests is not None:
+            digests[paths[i]] = digest
+        if digest in seen:
+            group_of[i] = group_of[seen[digest]]
+            continue
+        seen[digest] = i
+        hash_value = dhash(paths[i]) if perceptual else None
+        if hash_value is not None and leader_hashes:
+            distances = hamming_distances(hash_value, np.array(leader_hashes, dtype=np.uint64))
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= max_distance:
+                group_of[i] = group_of[leaders[nearest]]
+                continue
+        group_of[i] = i
+        if hash_value is not None:
+            leaders.append(i)
+            leader_hashes.append(hash_value)
+
+    members = {}
+    for i in range(len(paths)):
+        members.setdefault(group_of[i], []).append(i)
+    return [(paths[leader], [paths[i] for i in members[leader] if i != leader]) for leader in sorted(members)]
@@ -0,0 +1,146 @@
+# image_preprocess.py (送往 Ollama 前先將圖片縮到模型的輸入解析度)
+
+import io
+import os
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安裝 Pillow 時退回傳送原始檔案
+    Image = None
+    ImageOps = None
+
+# Gemma 3 的視覺編碼器固定將圖片縮放到 896x896，超過此尺寸的像素只會增加傳輸與解碼成本
+MAX_SIDE = 896          # 0 代表停用縮圖，直接傳送原始檔
+JPEG_QUALITY = 85
+# 縮圖結果的磁碟快取目錄 (None 代表不快取)
+DERIVATIVE_CACHE_DIR = None
+
+# 不需重新編碼即可直接送出的格式 (尺寸已在上限內時)
+PASSTHROUGH_FORMATS = ("JPEG", "PNG")
+EXIF_ORIENTATION = 0x0112
+
+PREPROCESS_STATS = {"images": 0, "resized": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+_stats_lock = threading.Lock()
+_warned_missing_pillow = False
+
+
+def configure(max_side=None, jpeg_quality=None, cache_dir=None):
+    """調整縮圖參數；cache_dir 為空字串時停用磁碟快取"""
+    global MAX_SIDE, JPEG_QUALITY, DERIVATIVE_CACHE_DIR
+    if max_side is not None:
+        MAX_SIDE = max_side
+    if jpeg_quality is not None:
+        JPEG_QUALITY = jpeg_quality
+    if cache_dir is not None:
+        DERIVATIVE_CACHE_DIR = cache_dir or None
+
+
+def enabled():
+    return MAX_SIDE > 0 and Image is not None
+
+
+def signature():
+    """目前縮圖設定的識別字串，會併入 VLM 快取鍵，確保不同設定的結果不會混用"""
+    if not enabled():
+        return "original"
+    return f"max{MAX_SIDE}-q{JPEG_QUALITY}"
+
+
+def _record(bytes_in, bytes_out, resized=False, cache_hit=False):
+    with _stats_lock:
+        PREPROCESS_STATS["images"] += 1
+        PREPROCESS_STATS["bytes_in"] += bytes_in
+        PREPROCESS_STATS["bytes_out"] += bytes_out
+        PREPROCESS_STATS["resized"] += int(resized)
+        PREPROCESS_STATS["cache_hits"] += int(cache_hit)
+
+
+def _derivative_path(sha256):
+    return os.path.join(DERIVATIVE_CACHE_DIR, f"{sha256}_{signature()}.jpg")
+
+
+def _encode_for_model(data):
+    """回傳 (送給模型的位元組, 是否重新編碼)"""
+    with Image.open(io.BytesIO(data)) as image:
+        image_format = image.format
+        # GIF 等多影格格式只取第一格
+        image.seek(0)
+        orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        if max(image.size) <= MAX_SIDE and image_format in PASSTHROUGH_FORMATS \
+                and orientation == 1:
+            return data, False
+
+        return _to_jpeg(image, MAX_SIDE, JPEG_QUALITY), True
+
+
+def _to_jpeg(image, max_side, quality):
+    """轉正、去除透明背景並縮到 max_side 以內，回傳 JPEG 位元組"""
+    # 依 EXIF 方向轉正，避免模型看到橫躺的狗
+    frame = ImageOps.exif_transpose(image)
+    if frame.mode in ("RGBA", "LA", "P"):
+        frame = frame.convert("RGBA")
+        background = Image.new("RGB", frame.size, (255, 255, 255))
+        background.paste(frame, mask=frame.split()[-1])
+        frame = background
+    elif frame.mode != "RGB":
+        frame = frame.convert("RGB")
+
+    frame.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    frame.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def make_thumbnail(data, max_side, quality=80):
+    """產生 HTML 報告用的 JPEG 縮圖；未安裝 Pillow 或無法解碼時回傳 None"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.seek(0)
+            return _to_jpeg(image, max_side, quality)
+    except Exception as e:
+        print(f"警告：無法產生縮圖。錯誤：{e}")
+        return None
+
+
+def prepare_for_model(data, sha256):
+    """
+    將原始圖片位元組轉成要送給 VLM 的版本：
+    最長邊縮到 MAX_SIDE 以內、非 JPEG/PNG 或過大的圖片重新編碼為 JPEG、GIF 只取第一格。
+    失敗或未安裝 Pillow 時回傳原始位元組。
+    """
+    global _warned_missing_pillow
+    if MAX_SIDE <= 0:
+        return data
+    if Image is None:
+        if not _warned_missing_pillow:
+            print("警告：未安裝 Pillow，將直接傳送原始圖片 (pip install pillow 以啟用縮圖)。")
+            _warned_missing_pillow = True
+        return data
+
+    if DERIVATIVE_CACHE_DIR:
+        cached_path = _derivative_path(sha256)
+        if os.path.exists(cached_path):
+            with open(cached_path, "rb") as cached_file:
+                derived = cached_file.read()
+            _record(len(data), len(derived), resized=True, cache_hit=True)
+            return derived
+
+    try:
+        derived, resized = _encode_for_model(data)
+    except Exception as e:
+        print(f"警告：縮圖失敗，改傳原始圖片。錯誤：{e}")
+        _record(len(data), len(data))
+        return data
+
+    if resized and DERIVATIVE_CACHE_DIR:
+        os.makedirs(DERIVATIVE_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{_derivative_path(sha256)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as cached_file:
+            cached_file.write(derived)
+        os.replace(tmp_path, _derivative_path(sha256))
+
+    _record(len(data), len(derived), resized=resized)
+    return derived
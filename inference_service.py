@@ -0,0 +1,429 @@
+# inference_service.py (本機 HTTP 推論服務：/features、/classify、/report，模型與連線常駐)
+
+import argparse
+import asyncio
+import base64
+import binascii
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import call_policy
+import gemma_report
+import image_asset
+import model_routing
+import ollama_pool
+import pipeline_metrics
+import pnn_model
+import vlm_cache
+import vlm_numeric
+
+# 同時在處理中的請求數 (每個請求一張圖片)；同時送往 Ollama 的請求數另由 OLLAMA_CONCURRENCY 限制
+MAX_ACTIVE = 8
+OLLAMA_CONCURRENCY = 4
+# 排隊中的請求超過此數時直接回 503，避免延遲無限增加
+MAX_QUEUED = 64
+# VLM 特徵萃取微批次：--feature-batch K > 1 時，收集 FEATURE_BATCH_WAIT_S 內到達的 /features 請求
+# (最多 K 張) 以一次多圖請求萃取；單次 VLM 呼叫以秒計，等候數十毫秒換取較少的呼叫數
+FEATURE_BATCH_WAIT_S = 0.05
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+ENDPOINTS = ("/features", "/classify", "/report")
+
+
+class ServiceError(Exception):
+    """回給呼叫端的錯誤 (附 HTTP 狀態碼)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    將 max_wait_s 內陸續到達的單筆請求合併成一次 await fn(items) 呼叫 (最多 max_batch 筆)。
+    fn 為協程函式，接受清單並回傳等長的結果清單；每個 submit() 取得自己那一筆的結果。
+    各批次在自己的 task 中執行，前一批尚未完成時仍會繼續收集下一批。
+    """
+
+    def __init__(self, fn, max_batch, max_wait_s=FEATURE_BATCH_WAIT_S):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait_s = max_wait_s
+        self.batches = 0
+        self.items = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        # 在沒有圖片量測紀錄的 context 中建立，避免批次工作沿用第一個請求的 contextvars
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            self.items += len(batch)
+            asyncio.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        try:
+            results = await self.fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+def classify_batch(feature_dicts):
+    """以一次 pnn_model.classify_breeds 分類多筆特徵，回傳可直接序列化的結果"""
+    result = pnn_model.classify_breeds(pnn_model.features_to_matrix(feature_dicts))
+    return [{
+        "breed": str(result["breed"][i]),
+        "status": str(result["status"][i]),
+        "min_distance": float(result["min_distance"][i]),
+        "vetoed": bool(result["vetoed"][i]),
+        "distances": {breed: float(d) for breed, d in zip(pnn_model.BREED_NAMES, result["distances"][i])},
+    } for i in range(len(feature_dicts))]
+
+
+def validate_features(features):
+    """呼叫端直接提供特徵時，檢查鍵與數值範圍"""
+    if not isinstance(features, dict) or sorted(features) != pnn_model.FEATURE_ORDER:
+        raise ServiceError(400, f"features 必須剛好包含: {', '.join(pnn_model.FEATURE_ORDER)}")
+    try:
+        values = {k: float(v) for k, v in features.items()}
+    except (TypeError, ValueError):
+        raise ServiceError(400, "features 的值必須是數字")
+    if any(not 0.0 <= v <= 1.0 for v in values.values()):
+        raise ServiceError(400, "features 的值必須介於 0 與 1 之間")
+    return values
+
+
+class InferenceService:
+    """
+    在單一事件迴圈上執行所有請求：MAX_ACTIVE 限制同時處理的圖片數，其餘在佇列中等候；
+    VLM 呼叫經 ollama_pool 連線池並受 OLLAMA_CONCURRENCY 限制。feature_batch > 1 時，
+    同時到達的特徵萃取以 MicroBatcher 合併成多圖請求；PNN 只需數微秒，直接逐筆計算。
+    """
+
+    def __init__(self, max_active=MAX_ACTIVE, ollama_concurrency=OLLAMA_CONCURRENCY, max_queued=MAX_QUEUED,
+                 feature_batch=1):
+        self.max_active = max_active
+        self.ollama_concurrency = ollama_concurrency
+        self.max_queued = max_queued
+        self.feature_batch = feature_batch
+        self.loop = asyncio.new_event_loop()
+        self.stats = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self.queued = 0
+        self._thread = threading.Thread(target=self.loop.run_forever, name="inference-loop", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+
+    async def _setup(self):
+        # Semaphore 與 AsyncClient 都綁定事件迴圈，必須在迴圈內建立
+        self.slots = asyncio.Semaphore(self.max_active)
+        self.client = ollama_pool.BoundedAsyncClient(ollama_pool.async_client(), self.ollama_concurrency)
+        self.features = None
+        if self.feature_batch > 1:
+            self.features = MicroBatcher(self._extract_batch, self.feature_batch)
+            self.features.start()
+
+    async def _extract_batch(self, assets):
+        return await vlm_numeric.get_features_batch_async(assets, self.client, self.feature_batch)
+
+    def submit(self, endpoint, asset=None, features=None):
+        """由 HTTP 執行緒呼叫：排入事件迴圈並等待結果，回傳 (結果, 量測紀錄)"""
+        return asyncio.run_coroutine_threadsafe(self.handle(endpoint, asset, features), self.loop).result()
+
+    async def handle(self, endpoint, asset, features):
+        if self.queued >= self.max_queued:
+            self.stats["rejected"] += 1
+            raise ServiceError(503, f"佇列已滿 ({self.max_queued})，請稍後再試")
+        self.queued += 1
+        enqueued = time.perf_counter()
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        queue_s = time.perf_counter() - enqueued
+        try:
+            with pipeline_metrics.image(asset.filename if asset else endpoint) as record:
+                if endpoint == "/features":
+                    result = {"features": await self._features(asset)}
+                elif endpoint == "/classify":
+                    result = await self._classify(asset, features)
+                else:
+                    result = await self._report(asset, features)
+        except BaseException:
+            self.stats[f"{endpoint}:error"] += 1
+            raise
+        finally:
+            self.slots.release()
+            if asset is not None:
+                asset.release()
+        record["queue_s"] = queue_s
+        self.stats[endpoint] += 1
+        self.latencies[endpoint].append(queue_s + record["wall_s"])
+        return result, record
+
+    async def _features(self, asset):
+        if asset is None:
+            raise ServiceError(400, "需要上傳圖片")
+        if self.features is not None:
+            with pipeline_metrics.stage('features'):
+                features = await self.features.submit(asset)
+        else:
+            features = await vlm_numeric.get_features_from_vlm_async(asset, self.client)
+        if features is None:
+            raise ServiceError(422, f"無法從 {asset.filename} 萃取特徵")
+        return features
+
+    async def _classify(self, asset, features):
+        if features is None:
+            features = await self._features(asset)
+        with pipeline_metrics.stage('pnn'):
+            classification = classify_batch([features])[0]
+        return {"features": features, "classification": classification}
+
+    async def _report(self, asset, features):
+        """與 batch_numeric 的預設非同步流程相同：特徵與初步意見並行 → PNN → 必要時升級 → 報告"""
+        if asset is None:
+            raise ServiceError(400, "需要上傳圖片")
+        if features is None:
+            features, prelim_judgment = await asyncio.gather(
+                self._features(asset),
+                gemma_report.get_preliminary_judgment_async(asset, self.client),
+            )
+        else:
+            prelim_judgment = await gemma_report.get_preliminary_judgment_async(asset, self.client)
+        with pipeline_metrics.stage('pnn'):
+            classification = classify_batch([features])[0]
+        summary = {"breed": classification["breed"], "status": classification["status"],
+                   "distances": classification["distances"]}
+        prelim_judgment = await gemma_report.escalate_judgment_async(
+            asset, prelim_judgment, self.client, summary) or prelim_judgment
+        is_target = gemma_report.is_target_breed(prelim_judgment)
+        report = await gemma_report.generate_gemma_report_async(
+            image_filename=asset.filename,
+            features=features if is_target else None,
+            classification_result=summary if is_target else None,
+            image_path=asset,
+            prelim_judgment=prelim_judgment,
+            client=self.client,
+        )
+        return {"features": features, "classification": classification,
+                "prelim_judgment": prelim_judgment, "report": report}
+
+    def snapshot(self):
+        """/stats 回傳的內容"""
+        latency = {endpoint: {"count": len(values),
+                              "p50_s": pipeline_metrics.percentile(list(values), 50),
+                              "p95_s": pipeline_metrics.percentile(list(values), 95),
+                              "p99_s": pipeline_metrics.percentile(list(values), 99)}
+                   for endpoint, values in self.latencies.items()}
+        return {
+            "requests": dict(self.stats),
+            "queued": self.queued,
+            "latency": latency,
+            "feature_batches": ({"batches": self.features.batches, "items": self.features.items}
+                                if self.features is not None else None),
+            "caches": {name: cache.stats() for name, cache in vlm_cache.SHARED_CACHES.items()},
+            "models": dict(model_routing.STAGE_MODELS),
+            "model_calls": dict(ollama_pool.pool.model_calls),
+            "hosts": ollama_pool.pool.stats(),
+            "call_policy": dict(call_policy.POLICY_STATS),
+            "report_prompt": dict(gemma_report.PROMPT_STATS),
+        }
+
+
+def server_timing(record):
+    """將量測紀錄轉為 Server-Timing 標頭 (毫秒)"""
+    parts = [f"queue;dur={record['queue_s'] * 1000:.1f}"]
+    parts += [f"{name};dur={stage['wall_s'] * 1000:.1f}" for name, stage in record["stages"].items()]
+    parts.append(f"total;dur={(record['queue_s'] + record['wall_s']) * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    POST 本體可為圖片原始位元組 (Content-Type: image/*，檔名以 ?filename= 指定)，
+    或 JSON {"image": Base64, "filename": ..., "features": {...}}；
+    /classify 與 /report 提供 features 時略過 VLM 特徵萃取。
+    """
+    server_version = "PitbullInference/1.0"
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse_request(self, path):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            raise ServiceError(400, "請求本體為空")
+        if length > MAX_UPLOAD_BYTES:
+            raise ServiceError(413, f"上傳內容超過 {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+        body = self.rfile.read(length)
+        query = parse_qs(urlparse(self.path).query)
+        filename = query.get("filename", ["upload"])[0]
+        features = None
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                payload = json.loads(body)
+                image_b64 = payload.get("image")
+                data = base64.b64decode(image_b64, validate=True) if image_b64 else None
+            except (ValueError, binascii.Error, AttributeError) as e:
+                raise ServiceError(400, f"無法解析 JSON 請求: {e}")
+            filename = payload.get("filename", filename)
+            if payload.get("features") is not None:
+                if path == "/features":
+                    raise ServiceError(400, "/features 不接受 features 欄位")
+                features = validate_features(payload["features"])
+        else:
+            data = body
+        asset = image_asset.ImageAsset.from_bytes(data, filename) if data else None
+        return asset, features
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path not in ENDPOINTS:
+            self._send_json(404, {"error": f"未知的端點: {path} (可用: {', '.join(ENDPOINTS)})"})
+            return
+        start = time.perf_counter()
+        try:
+            asset, features = self._parse_request(path)
+            result, record = self.server.service.submit(path, asset, features)
+        except ServiceError as e:
+            self._send_json(e.status, {"error": str(e)})
+            return
+        except Exception as e:
+            print(f"{path} 處理失敗: {e}")
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, result, headers={
+            "Server-Timing": server_timing(record),
+            "X-Queue-Time-Ms": f"{record['queue_s'] * 1000:.1f}",
+            "X-Process-Time-Ms": f"{record['wall_s'] * 1000:.1f}",
+            "X-Total-Time-Ms": f"{(time.perf_counter() - start) * 1000:.1f}",
+        })
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, {"status": "ok", "hosts": ollama_pool.pool.stats()})
+        elif path == "/stats":
+            self._send_json(200, self.server.service.snapshot())
+        else:
+            self._send_json(404, {"error": f"未知的端點: {path}"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 預設 backlog 只有 5，多個呼叫端同時上傳時會被重設連線；真正的流量控制由 MAX_QUEUED 負責
+    request_queue_size = 128
+
+    def __init__(self, address, service):
+        super().__init__(address, ServiceHandler)
+        self.service = service
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="犬種鑑定流程的本機 HTTP 推論服務")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-active', type=int, default=MAX_ACTIVE, help="同時處理的請求 (圖片) 數")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="同時送往 Ollama 的請求上限 (預設為每台主機 OLLAMA_CONCURRENCY 個)")
+    parser.add_argument('--feature-batch', type=int, default=vlm_numeric.FEATURE_BATCH_SIZE,
+                        help=f"同時到達的特徵萃取請求 ({FEATURE_BATCH_WAIT_S * 1000:.0f} ms 內) 最多幾張合併成一次多圖 "
+                             "VLM 請求 (1 為逐張)")
+    parser.add_argument('--max-queued', type=int, default=MAX_QUEUED, help="排隊請求上限，超過回 503")
+    parser.add_argument('--hosts', default=None,
+                        help="以逗號分隔的 Ollama 主機清單 (預設取 OLLAMA_HOSTS 或 OLLAMA_HOST)；"
+                             "測試時可指向 fake_ollama.py")
+    parser.add_argument('--stage-model', action='append', default=[], metavar='STAGE=MODEL',
+                        help=f"指定某階段使用的模型，可重複 (階段: {', '.join(model_routing.STAGES)})")
+    parser.add_argument('--escalation-model', default=None, help="小模型結果不確定時改用的模型")
+    parser.add_argument('--report-mode', choices=gemma_report.REPORT_MODES, default=gemma_report.REPORT_MODE,
+                        help="報告產生方式 (同 batch_numeric.py)")
+    parser.add_argument('--report-prompt-tokens', type=int, default=gemma_report.REPORT_PROMPT_TOKENS,
+                        help="情況 B2 報告 Prompt 的估計 token 預算 (同 batch_numeric.py)")
+    parser.add_argument('--report-competitors', type=int, default=gemma_report.REPORT_COMPETITORS,
+                        help="情況 B2 報告知識庫列出的易混淆犬種數 (同 batch_numeric.py)")
+    parser.add_argument('--cache', choices=vlm_cache.CACHE_MODES, default=vlm_cache.CACHE_MODE,
+                        help="VLM 快取模式")
+    parser.add_argument('--timeout', action='append', default=[], metavar='STAGE=SECONDS',
+                        help="指定某階段單次呼叫的逾時秒數 (同 batch_numeric.py)")
+    parser.add_argument('--num-predict', action='append', default=[], metavar='STAGE=TOKENS',
+                        help="指定某階段的生成 token 數上限 (同 batch_numeric.py)")
+    parser.add_argument('--hedge', action='store_true', help="呼叫超過該階段近期 p95 延遲時送出對沖請求")
+    parser.add_argument('--keep-alive', default="-1", help="模型常駐時間 (服務模式預設 -1：不卸載)")
+    parser.add_argument('--no-warmup', action='store_true', help="啟動時不預先載入模型")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    vlm_cache.set_mode(args.cache)
+    gemma_report.set_report_mode(args.report_mode)
+    gemma_report.set_prompt_budget(args.report_prompt_tokens, args.report_competitors)
+    model_routing.configure(args.stage_model, escalation=args.escalation_model)
+    call_policy.configure(timeouts=args.timeout, num_predict=args.num_predict, hedge=args.hedge)
+    ollama_pool.configure(hosts=args.hosts.split(',') if args.hosts is not None else None,
+                          keep_alive=args.keep_alive)
+    if not args.no_warmup:
+        print(f"預先載入模型: {', '.join(model_routing.all_models())}...")
+        for host, load_times in ollama_pool.warm_up(model_routing.all_models()).items():
+            for model, load_s in load_times.items():
+                print(f"  {host}: {model} 載入 {load_s:.1f} 秒")
+
+    concurrency = args.concurrency or OLLAMA_CONCURRENCY * len(ollama_pool.pool.hosts)
+    service = InferenceService(max_active=max(1, args.max_active), ollama_concurrency=max(1, concurrency),
+                               max_queued=max(1, args.max_queued), feature_batch=max(1, args.feature_batch))
+    service.start()
+    server = InferenceServer((args.host, args.port), service)
+    print(f"推論服務已啟動: {server.url} (端點: {', '.join(ENDPOINTS)}、GET /health、GET /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
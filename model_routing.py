@@ -0,0 +1,67 @@
+# model_routing.py (各管線階段使用的模型，以及小模型結果不可靠時改用大模型重跑的規則)
+
+import collections
+import os
+import threading
+
+DEFAULT_MODEL = 'gemma3:27b-it-qat'
+
+# 管線階段：features 特徵萃取、combined 合併萃取、judgment 初步意見、report 報告生成
+STAGES = ('features', 'combined', 'judgment', 'report')
+
+# 各階段的模型，可用環境變數個別指定，例如 VLM_MODEL_JUDGMENT=gemma3:4b
+STAGE_MODELS = {stage: os.environ.get(f'VLM_MODEL_{stage.upper()}', DEFAULT_MODEL) for stage in STAGES}
+
+# 小模型的結果不確定或與 PNN 不一致時，改用此模型重跑
+ESCALATION_MODEL = os.environ.get('VLM_MODEL_ESCALATION', DEFAULT_MODEL)
+
+# 本次執行各「階段:升級理由」的次數 (各模型的呼叫數由 ollama_pool 統計)
+ESCALATIONS = collections.Counter()
+_lock = threading.Lock()
+
+
+def model_for(stage):
+    return STAGE_MODELS[stage]
+
+
+def can_escalate(stage):
+    """該階段的模型不是升級用模型時，才有升級的空間"""
+    return STAGE_MODELS[stage] != ESCALATION_MODEL
+
+
+def models_for(stage):
+    """依序嘗試的模型：先用階段模型，必要時再用升級模型"""
+    return [STAGE_MODELS[stage]] + ([ESCALATION_MODEL] if can_escalate(stage) else [])
+
+
+def all_models():
+    """批次會用到的所有模型 (供預先載入)"""
+    return list(dict.fromkeys(list(STAGE_MODELS.values()) + [ESCALATION_MODEL]))
+
+
+def record_escalation(stage, reason):
+    with _lock:
+        ESCALATIONS[f"{stage}:{reason}"] += 1
+
+
+def signature():
+    """各階段模型設定的摘要字串 (併入 manifest 指紋)"""
+    stages = ",".join(f"{stage}={STAGE_MODELS[stage]}" for stage in STAGES)
+    return f"{stages},escalation={ESCALATION_MODEL}"
+
+
+def configure(stage_models=None, escalation=None):
+    """
+    stage_models 為 {階段: 模型} 或 "階段=模型" 字串的清單；escalation 為升級用模型。
+    未指定的階段維持原設定。
+    """
+    global ESCALATION_MODEL
+    if isinstance(stage_models, (list, tuple)):
+        stage_models = dict(item.split('=', 1) for item in stage_models)
+    for stage, model in (stage_models or {}).items():
+        stage = stage.strip()
+        if stage not in STAGE_MODELS:
+            raise ValueError(f"未知的管線階段: {stage} (可用: {', '.join(STAGES)})")
+        STAGE_MODELS[stage] = model.strip()
+    if escalation:
+        ESCALATION_MODEL = escalation
@@ -0,0 +1,411 @@
+# ollama_pool.py (多台 Ollama 主機的共用連線池：每個請求派給進行中請求最少的健康主機)
+
+import asyncio
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import ollama
+
+import call_policy
+
+# 以逗號分隔的主機清單，例如 "http://gpu1:11434,http://gpu2:11434"；未設定時沿用 OLLAMA_HOST / 預設主機
+OLLAMA_HOSTS = [host.strip() for host in
+                os.environ.get('OLLAMA_HOSTS', os.environ.get('OLLAMA_HOST', '')).split(',')
+                if host.strip()]
+
+def _parse_keep_alive(value):
+    """純數字視為秒數，其餘 (例如 "30m"、"-1") 原樣交給 Ollama"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+# 每次請求都明確指定模型常駐時間，避免批次中途停頓超過 Ollama 預設的 5 分鐘後被卸載而重新載入
+KEEP_ALIVE = _parse_keep_alive(os.environ.get('OLLAMA_KEEP_ALIVE', '30m'))
+
+# 主機連線失敗後隔多久再讓它接請求 (秒)，以及健康檢查的逾時
+HEALTH_RECHECK_S = 30.0
+HEALTH_TIMEOUT_S = 3.0
+
+# 視為「主機無法連線」的錯誤；ollama.ResponseError (模型回錯) 不在此列，照常交給呼叫端處理
+_HOST_ERRORS = (ConnectionError, httpx.TransportError)
+# 連上主機後等待回應逾時：模型仍在生成，不代表主機故障 (須先於 _HOST_ERRORS 攔截)
+_READ_TIMEOUTS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.PoolTimeout)
+
+
+class PoolHost:
+    """連線池中的一台主機：持久的 ollama.Client，以及每個事件迴圈各一個 AsyncClient"""
+
+    def __init__(self, host):
+        self.host = host
+        self.client = ollama.Client(host=host)
+        self._timeout_clients = {}
+        # httpx.AsyncClient 綁定建立時的事件迴圈，因此依迴圈分開保存
+        self._async_clients = weakref.WeakKeyDictionary()
+        self.in_flight = 0
+        self.healthy = True
+        self.retry_at = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.busy_s = 0.0
+        self.warmup_load_s = 0.0
+
+    @property
+    def name(self):
+        return self.host or "預設主機"
+
+    def client_for(self, timeout):
+        """同步請求的逾時由 httpx 的讀取逾時實現，因此每種 timeout 各用一個 Client"""
+        if timeout is None:
+            return self.client
+        client = self._timeout_clients.get(timeout)
+        if client is None:
+            client = self._timeout_clients.setdefault(timeout, ollama.Client(host=self.host, timeout=timeout))
+        return client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = ollama.AsyncClient(host=self.host)
+            self._async_clients[loop] = client
+        return client
+
+    def available(self, now):
+        return self.healthy or now >= self.retry_at
+
+
+class OllamaPool:
+    """
+    多主機連線池。每次 chat 挑選進行中請求最少的可用主機 (同數時取累計請求較少者)；
+    主機連線失敗時標記為不健康並改送下一台，HEALTH_RECHECK_S 秒後才再給它機會。
+    """
+
+    def __init__(self, hosts=None):
+        self.hosts = [PoolHost(host) for host in (hosts or [None])]
+        self.model_calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _acquire(self, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [h for h in self.hosts if h not in tried and h.available(now)]
+            if not candidates:
+                # 全部主機都被標記為不健康時，仍嘗試尚未試過的主機，而不是直接放棄
+                candidates = [h for h in self.hosts if h not in tried]
+            if not candidates:
+                return None
+            node = min(candidates, key=lambda h: (h.in_flight, h.requests))
+            if not node.healthy:
+                # 不健康的主機重新開放時只放行一個試探請求，其餘請求仍送往其他主機
+                node.retry_at = now + HEALTH_RECHECK_S
+            node.in_flight += 1
+            node.requests += 1
+            return node
+
+    def _release(self, node, start, error=None, model=None):
+        with self._lock:
+            node.in_flight -= 1
+            node.busy_s += time.perf_counter() - start
+            if model is not None:
+                self.model_calls[model] += 1
+            if error is None:
+                node.healthy = True
+            else:
+                node.failures += 1
+                node.healthy = False
+                node.retry_at = time.monotonic() + HEALTH_RECHECK_S
+
+    def chat(self, stage=None, **kwargs):
+        """
+        同 ollama.chat，但由池中最空閒的主機處理；連線失敗時自動改送其他主機。
+        stage 為管線階段，依 call_policy 套用該階段的逾時、num_predict、重試與對沖請求。
+        """
+        return call_policy.call(stage, self._chat_once, kwargs)
+
+    def _chat_once(self, timeout=None, **kwargs):
+        """timeout 為等待回應的秒數上限 (None 代表不限)，逾時拋出 call_policy.CallTimeout"""
+        kwargs.setdefault('keep_alive', KEEP_ALIVE)
+        tried = set()
+        while True:
+            node = self._acquire(tried)
+            if node is None:
+                raise ConnectionError(f"所有 Ollama 主機皆無法連線: {', '.join(h.name for h in self.hosts)}")
+            tried.add(node)
+            start = time.perf_counter()
+            try:
+                response = node.client_for(timeout).chat(**kwargs)
+            except _READ_TIMEOUTS as e:
+                self._release(node, start)
+                raise call_policy.CallTimeout(f"Ollama 主機 {node.name} 超過 {timeout} 秒未回應") from e
+            except _HOST_ERRORS as e:
+                self._release(node, start, e)
+                print(f"Ollama 主機 {node.name} 連線失敗 ({e})，改送其他主機")
+                continue
+            except BaseException:
+                self._release(node, start)
+                raise
+            self._release(node, start, model=kwargs.get('model'))
+            return response
+
+    async def chat_async(self, stage=None, **kwargs):
+        """chat 的非同步版本 (逾時或對沖輸掉時取消請求，Ollama 會隨連線中斷停止生成)"""
+        return await call_policy.call_async(stage, self._chat_once_async, kwargs)
+
+    async def _chat_once_async(self, timeout=None, **kwargs):
+        kwargs.setdefault('keep_alive', KEEP_ALIVE)
+        tried = set()
+        while True:
+            node = self._acquire(tried)
+            if node is None:
+                raise ConnectionError(f"所有 Ollama 主機皆無法連線: {', '.join(h.name for h in self.hosts)}")
+            tried.add(node)
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(node.async_client().chat(**kwargs), timeout)
+            except (asyncio.TimeoutError, *_READ_TIMEOUTS) as e:
+                self._release(node, start)
+                raise call_policy.CallTimeout(f"Ollama 主機 {node.name} 超過 {timeout} 秒未回應") from e
+            except _HOST_ERRORS as e:
+                self._release(node, start, e)
+                print(f"Ollama 主機 {node.name} 連線失敗 ({e})，改送其他主機")
+                continue
+            except BaseException:
+                self._release(node, start)
+                raise
+            self._release(node, start, model=kwargs.get('model'))
+            return response
+
+    def chat_stream(self, stage=None, **kwargs):
+        """
+        chat 的串流版本 (stream=True)，逐段 yield 回應。整段串流期間都佔用同一台主機；
+        套用 stage 的逾時 (整段串流的時間上限) 與 num_predict。收到第一段之前的失敗
+        依 call_policy 重試 (連線失敗則直接改送其他主機)；已輸出內容後無法重來，也不對沖。
+        """
+        kwargs = call_policy.prepare(stage, kwargs)
+        call_policy.start_call()
+        attempt = 0
+        while True:
+            received = False
+            try:
+                for part in self._chat_stream_once(**kwargs):
+                    received = True
+                    yield part
+                return
+            except Exception as e:
+                delay = call_policy.retry_delay(stage, e, attempt, allowed=not received)
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+
+    async def chat_stream_async(self, stage=None, **kwargs):
+        """chat_stream 的非同步版本 (async generator)"""
+        kwargs = call_policy.prepare(stage, kwargs)
+        call_policy.start_call()
+        attempt = 0
+        while True:
+            received = False
+            try:
+                async for part in self._chat_stream_once_async(**kwargs):
+                    received = True
+                    yield part
+                return
+            except Exception as e:
+                delay = call_policy.retry_delay(stage, e, attempt, allowed=not received)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _chat_stream_once(self, timeout=None, **kwargs):
+        """只有在收到第一段之前連線失敗才改送其他主機；timeout 為整段串流的時間上限"""
+        kwargs.setdefault('keep_alive', KEEP_ALIVE)
+        kwargs['stream'] = True
+        tried = set()
+        while True:
+            node = self._acquire(tried)
+            if node is None:
+                raise ConnectionError(f"所有 Ollama 主機皆無法連線: {', '.join(h.name for h in self.hosts)}")
+            tried.add(node)
+            start = time.perf_counter()
+            received = False
+            try:
+                stream = node.client_for(timeout).chat(**kwargs)
+                for part in stream:
+                    received = True
+                    yield part
+                    if timeout is not None and time.perf_counter() - start > timeout:
+                        stream.close()
+                        raise call_policy.CallTimeout(f"Ollama 主機 {node.name} 的串流超過 {timeout} 秒仍未結束")
+            except call_policy.CallTimeout:
+                self._release(node, start)
+                raise
+            except _READ_TIMEOUTS as e:
+                self._release(node, start)
+                raise call_policy.CallTimeout(f"Ollama 主機 {node.name} 超過 {timeout} 秒未回應") from e
+            except _HOST_ERRORS as e:
+                self._release(node, start, e)
+                if received:
+                    raise
+                print(f"Ollama 主機 {node.name} 連線失敗 ({e})，改送其他主機")
+                continue
+            except BaseException:
+                self._release(node, start)
+                raise
+            self._release(node, start, model=kwargs.get('model'))
+            return
+
+    async def _chat_stream_once_async(self, timeout=None, **kwargs):
+        kwargs.setdefault('keep_alive', KEEP_ALIVE)
+        kwargs['stream'] = True
+        tried = set()
+        while True:
+            node = self._acquire(tried)
+            if node is None:
+                raise ConnectionError(f"所有 Ollama 主機皆無法連線: {', '.join(h.name for h in self.hosts)}")
+            tried.add(node)
+            start = time.perf_counter()
+            received = False
+            try:
+                deadline = None if timeout is None else start + timeout
+                stream = (await asyncio.wait_for(node.async_client().chat(**kwargs), timeout)).__aiter__()
+                while True:
+                    remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+                    try:
+                        part = await asyncio.wait_for(stream.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    received = True
+                    yield part
+            except (asyncio.TimeoutError, *_READ_TIMEOUTS) as e:
+                self._release(node, start)
+                raise call_policy.CallTimeout(f"Ollama 主機 {node.name} 的串流超過 {timeout} 秒仍未結束") from e
+            except _HOST_ERRORS as e:
+                self._release(node, start, e)
+                if received:
+                    raise
+                print(f"Ollama 主機 {node.name} 連線失敗 ({e})，改送其他主機")
+                continue
+            except BaseException:
+                self._release(node, start)
+                raise
+            self._release(node, start, model=kwargs.get('model'))
+            return
+
+    def _warm_up_host(self, node, models):
+        loaded = {}
+        for model in models:
+            try:
+                # 不帶訊息的請求只會載入模型，不進行推論
+                response = node.client.chat(model=model, messages=[], keep_alive=KEEP_ALIVE)
+            except Exception as e:
+                print(f"Ollama 主機 {node.name} 預先載入 {model} 失敗: {e}")
+                continue
+            load_s = (response.get('load_duration') or 0) / 1e9
+            loaded[model] = load_s
+            with self._lock:
+                node.warmup_load_s += load_s
+        return loaded
+
+    def warm_up(self, models):
+        """
+        在批次開始前於每台健康主機上預先載入 models，讓第一張圖片不必等待冷啟動。
+        各主機同時載入；回傳 {主機: {模型: 載入秒數}}。
+        """
+        models = list(dict.fromkeys(models))
+        nodes = [node for node in self.hosts if node.healthy]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(nodes))) as executor:
+            results = executor.map(lambda node: self._warm_up_host(node, models), nodes)
+            return {node.name: loaded for node, loaded in zip(nodes, results)}
+
+    def check_health(self):
+        """主動檢查每台主機 (以公開的 Client.list()，即 GET /api/tags)，回傳健康主機數"""
+        for node in self.hosts:
+            try:
+                node.client_for(HEALTH_TIMEOUT_S).list()
+                healthy = True
+            except (ollama.ResponseError, httpx.HTTPError, ConnectionError) as e:
+                print(f"Ollama 主機 {node.name} 健康檢查失敗: {e}")
+                healthy = False
+            with self._lock:
+                node.healthy = healthy
+                node.retry_at = 0.0 if healthy else time.monotonic() + HEALTH_RECHECK_S
+        return sum(1 for node in self.hosts if node.healthy)
+
+    def stats(self):
+        with self._lock:
+            return [{"host": node.name, "requests": node.requests, "failures": node.failures,
+                     "busy_s": node.busy_s, "healthy": node.healthy,
+                     "warmup_load_s": node.warmup_load_s} for node in self.hosts]
+
+
+class AsyncPoolClient:
+    """提供與 ollama.AsyncClient 相同的 chat 介面，供非同步流程傳入各階段函式"""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def chat(self, **kwargs):
+        return await self._pool.chat_async(**kwargs)
+
+    def chat_stream(self, **kwargs):
+        return self._pool.chat_stream_async(**kwargs)
+
+
+class BoundedAsyncClient:
+    """包裝 AsyncPoolClient (或 ollama.AsyncClient)，以 Semaphore 限制同時進行中的請求數"""
+
+    def __init__(self, client, limit):
+        self._client = client
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def chat(self, **kwargs):
+        async with self._semaphore:
+            return await self._client.chat(**kwargs)
+
+    async def chat_stream(self, **kwargs):
+        """串流回應；整段串流期間都佔用一個名額"""
+        async with self._semaphore:
+            async for part in self._client.chat_stream(**kwargs):
+                yield part
+
+
+pool = OllamaPool(OLLAMA_HOSTS)
+
+
+def configure(hosts=None, keep_alive=None):
+    """
+    hosts 不為 None 時以新的主機清單重建共用連線池 (清單為空時使用預設主機)；
+    keep_alive 不為 None 時更新每次請求帶入的模型常駐時間。
+    """
+    global pool, KEEP_ALIVE
+    if keep_alive is not None:
+        KEEP_ALIVE = _parse_keep_alive(keep_alive)
+    if hosts is not None:
+        pool = OllamaPool([host for host in hosts if host])
+    return pool
+
+
+def chat(**kwargs):
+    """模組層級的 chat，取代 ollama.chat"""
+    return pool.chat(**kwargs)
+
+
+def chat_stream(**kwargs):
+    """模組層級的串流 chat (逐段 yield 回應)"""
+    return pool.chat_stream(**kwargs)
+
+
+def warm_up(models):
+    return pool.warm_up(models)
+
+
+def async_client():
+    return AsyncPoolClient(pool)
@@ -0,0 +1,308 @@
+# pipeline_metrics.py (各階段耗時與 Ollama token 指標；每張圖片一行 JSONL)
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+PROFILE_PATH = os.path.join('out', 'profile.jsonl')
+
+# Ollama 回傳中的時間欄位單位為奈秒
+_OLLAMA_DURATIONS = ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+_OLLAMA_COUNTS = ("prompt_eval_count", "eval_count")
+
+# load_duration 超過此秒數的呼叫視為模型 (重新) 載入的冷啟動
+COLD_LOAD_THRESHOLD_S = 1.0
+
+_current_record = contextvars.ContextVar("pipeline_metrics_record", default=None)
+_current_start = contextvars.ContextVar("pipeline_metrics_start", default=None)
+
+
+def percentile(values, q):
+    """最近排名法百分位數 (q 介於 0~100)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def estimate_tokens(text):
+    """
+    粗略的 token 估計：中文約 1 字 1 token，英數約 4 字元 1 token。
+    只用於送出前的預算判斷 (gemma_report) 與模擬伺服器 (fake_ollama)；實際數字以回應的 prompt_eval_count 為準。
+    """
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def _field(response, name):
+    try:
+        return response[name]
+    except (KeyError, TypeError):
+        return getattr(response, name, None)
+
+
+class RunProfile:
+    """收集一次批次執行的每張圖片紀錄，並於結束時產生各階段摘要"""
+
+    def __init__(self, path=PROFILE_PATH):
+        self.path = path
+        self.records = []
+        self._lock = threading.Lock()
+        self._file = None
+        self.started = time.perf_counter()
+
+    def open(self):
+        profile_dir = os.path.dirname(self.path)
+        if profile_dir and not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+        self._file = open(self.path, "w", encoding='utf-8')
+        return self
+
+    def write_record(self, record):
+        with self._lock:
+            self.records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self._file.flush()
+
+    def summary(self):
+        """各階段的 p50/p95/p99 延遲與 tokens/sec"""
+        stages = {}
+        for record in self.records:
+            for name, stage in record["stages"].items():
+                agg = stages.setdefault(name, {"latencies": [], "calls": 0, "eval_count": 0,
+                                               "eval_s": 0.0, "prompt_eval_count": 0,
+                                               "prompt_eval_s": 0.0, "load_s": 0.0,
+                                               "cold_loads": 0})
+                agg["latencies"].append(stage["wall_s"])
+                agg["calls"] += stage.get("calls", 0)
+                agg["eval_count"] += stage.get("eval_count", 0)
+                agg["eval_s"] += stage.get("eval_duration_s", 0.0)
+                agg["prompt_eval_count"] += stage.get("prompt_eval_count", 0)
+                agg["prompt_eval_s"] += stage.get("prompt_eval_duration_s", 0.0)
+                agg["load_s"] += stage.get("load_duration_s", 0.0)
+                agg["cold_loads"] += stage.get("cold_loads", 0)
+
+        result = {}
+        for name, agg in stages.items():
+            latencies = agg["latencies"]
+            result[name] = {
+                "count": len(latencies),
+                "ollama_calls": agg["calls"],
+                "p50_s": percentile(latencies, 50),
+                "p95_s": percentile(latencies, 95),
+                "p99_s": percentile(latencies, 99),
+                "total_s": sum(latencies),
+                "load_s": agg["load_s"],
+                "cold_loads": agg["cold_loads"],
+                "inference_s": agg["prompt_eval_s"] + agg["eval_s"],
+                "eval_tokens_per_s": (agg["eval_count"] / agg["eval_s"]) if agg["eval_s"] else None,
+                "prompt_tokens_per_s": (agg["prompt_eval_count"] / agg["prompt_eval_s"])
+                                       if agg["prompt_eval_s"] else None,
+            }
+        images = sum(1 for record in self.records if record["type"] == "image")
+        first_content = [record["first_content_s"] for record in self.records if "first_content_s" in record]
+        return {"type": "summary", "images": images,
+                "wall_s": time.perf_counter() - self.started, "stages": result,
+                "first_content": {"count": len(first_content),
+                                  "p50_s": percentile(first_content, 50),
+                                  "p95_s": percentile(first_content, 95)}}
+
+    def close(self):
+        summary = self.summary()
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(summary, ensure_ascii=False) + "\n")
+                self._file.close()
+                self._file = None
+        return summary
+
+
+_active_profile = None
+
+
+def start_run(path=PROFILE_PATH):
+    """開始一次批次執行的量測 (覆寫先前的 profile 檔)"""
+    global _active_profile
+    _active_profile = RunProfile(path).open()
+    return _active_profile
+
+
+def finish_run():
+    """結束量測、寫入摘要行並回傳摘要"""
+    global _active_profile
+    if _active_profile is None:
+        return None
+    summary = _active_profile.close()
+    _active_profile = None
+    return summary
+
+
+@contextlib.contextmanager
+def image(image_path, kind="image"):
+    """量測一張圖片的整體流程；離開時寫出該圖片的 JSONL 紀錄"""
+    record = {"type": kind, "image": str(image_path), "stages": {}}
+    token = _current_record.set(record)
+    start = time.perf_counter()
+    start_token = _current_start.set(start)
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - start
+        _current_start.reset(start_token)
+        _current_record.reset(token)
+        if _active_profile is not None:
+            _active_profile.write_record(record)
+
+
+def batch(name):
+    """量測一次涵蓋多張圖片的呼叫 (例如批次特徵萃取)；紀錄計入各階段統計，但不計入圖片數"""
+    return image(name, kind="batch")
+
+
+def _stage_entry(name):
+    record = _current_record.get()
+    if record is None:
+        return None
+    return record["stages"].setdefault(name, {"wall_s": 0.0, "calls": 0})
+
+
+@contextlib.contextmanager
+def stage(name):
+    """量測本地階段 (縮圖編碼、PNN、HTML 寫檔等) 的耗時"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = _stage_entry(name)
+        if entry is not None:
+            entry["wall_s"] += time.perf_counter() - start
+
+
+def annotate(name, **fields):
+    """在階段紀錄上附加欄位 (例如 cache_hit=True)"""
+    entry = _stage_entry(name)
+    if entry is not None:
+        entry.update(fields)
+
+
+def set_result(**fields):
+    """記錄目前圖片的鑑定結果摘要 (品種、初步意見等)，供 manifest 與批次索引使用"""
+    record = _current_record.get()
+    if record is not None:
+        record.setdefault("result", {}).update(fields)
+
+
+def mark_first_content():
+    """記錄目前圖片的報告內容第一次寫到檔案 (審閱者可看到) 的時間，自圖片開始處理起算；只記第一次"""
+    record = _current_record.get()
+    if record is None or "first_content_s" in record:
+        return
+    record["first_content_s"] = time.perf_counter() - _current_start.get()
+
+
+def record_ollama(name, response, wall_s):
+    """累加一次 ollama.chat 呼叫的耗時與 token 數"""
+    entry = _stage_entry(name)
+    if entry is None:
+        return
+    entry["wall_s"] += wall_s
+    entry["calls"] += 1
+    model = _field(response, "model")
+    if model:
+        entry["model"] = model
+    for key in _OLLAMA_DURATIONS:
+        value = _field(response, key)
+        if value:
+            entry[f"{key}_s"] = entry.get(f"{key}_s", 0.0) + value / 1e9
+    if _field(response, "done_reason") == "length":
+        entry["truncated"] = entry.get("truncated", 0) + 1
+    if (_field(response, "load_duration") or 0) / 1e9 > COLD_LOAD_THRESHOLD_S:
+        entry["cold_loads"] = entry.get("cold_loads", 0) + 1
+    for key in _OLLAMA_COUNTS:
+        value = _field(response, key)
+        if value:
+            entry[key] = entry.get(key, 0) + value
+    if entry.get("eval_duration_s"):
+        entry["eval_tokens_per_s"] = entry.get("eval_count", 0) / entry["eval_duration_s"]
+
+
+def timed_chat(name, chat, policy=None, **kwargs):
+    """
+    呼叫 chat(stage=policy or name, **kwargs) (例如 ollama_pool.chat) 並記錄到目前圖片的 name 階段。
+    連線池依 stage 套用 call_policy 的逾時、重試與對沖設定；記錄的耗時包含重試。
+    policy 用於同一階段中耗時特性不同的呼叫 (例如多圖批次、補問)，讓它們使用自己的策略鍵。
+    """
+    start = time.perf_counter()
+    response = chat(stage=policy or name, **kwargs)
+    record_ollama(name, response, time.perf_counter() - start)
+    return response
+
+
+async def timed_chat_async(name, chat, policy=None, **kwargs):
+    """timed_chat 的非同步版本 (chat 為 AsyncClient.chat 之類的協程函式)"""
+    start = time.perf_counter()
+    response = await chat(stage=policy or name, **kwargs)
+    record_ollama(name, response, time.perf_counter() - start)
+    return response
+
+
+def _finish_stream(name, last, parts, start):
+    """記錄串流的最後一段並換成完整文字；一段都沒收到 (連線中斷等) 時明確報錯，而不是留下 None"""
+    if last is None:
+        raise RuntimeError(f"{name} 串流未收到任何回應")
+    record_ollama(name, last, time.perf_counter() - start)
+    last['message']['content'] = "".join(parts)
+    return last
+
+
+def timed_chat_stream(name, chat_stream, on_chunk, **kwargs):
+    """
+    串流版的 timed_chat：chat_stream(**kwargs) 逐段產生回應，每段文字交給 on_chunk。
+    最後一段 (done) 帶有的耗時與 token 數照常記錄，另記錄第一段文字到達的時間。
+    回傳與 timed_chat 相同格式的回應：最後一段 (含 done_reason 等欄位)，message.content 換成完整文字。
+    """
+    start = time.perf_counter()
+    parts, last = [], None
+    for part in chat_stream(stage=name, **kwargs):
+        last = part
+        text = part['message']['content']
+        if text:
+            if not parts:
+                annotate(name, first_token_s=time.perf_counter() - start)
+            parts.append(text)
+            on_chunk(text)
+    return _finish_stream(name, last, parts, start)
+
+
+async def timed_chat_stream_async(name, chat_stream, on_chunk, **kwargs):
+    """timed_chat_stream 的非同步版本 (chat_stream 回傳 async generator)"""
+    start = time.perf_counter()
+    parts, last = [], None
+    async for part in chat_stream(stage=name, **kwargs):
+        last = part
+        text = part['message']['content']
+        if text:
+            if not parts:
+                annotate(name, first_token_s=time.perf_counter() - start)
+            parts.append(text)
+            on_chunk(text)
+    return _finish_stream(name, last, parts, start)
+
+
+def print_summary(summary):
+    """以表格列印各階段摘要"""
+    if not summary or not summary["stages"]:
+        return
+    print(f"{'階段':<14}{'次數':>6}{'p50(s)':>10}{'p95(s)':>10}{'p99(s)':>10}{'tok/s':>10}")
+    for name, stats in summary["stages"].items():
+        tokens = f"{stats['eval_tokens_per_s']:.1f}" if stats["eval_tokens_per_s"] else "-"
+        print(f"{name:<14}{stats['count']:>6}{stats['p50_s']:>10.3f}{stats['p95_s']:>10.3f}{stats['p99_s']:>10.3f}{tokens:>10}")
+    first_content = summary.get("first_content") or {}
+    if first_content.get("count"):
+        print(f"報告內容首次出現 (自圖片開始處理起算): p50 {first_content['p50_s']:.3f} 秒，"
+              f"p95 {first_content['p95_s']:.3f} 秒 ({first_content['count']} 張)")
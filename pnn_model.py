@@ -1,5 +1,8 @@
 # pnn_model.py (最終版：8特徵 + 加權 + 懲罰 + 調紐 + 閾值)
 
+import hashlib
+import json
+
 import numpy as np
 
 # 您的 8 特徵理想向量
@@ -58,12 +61,116 @@ REGULATED_PENALTY_MULTIPLIER = 1.10
 DISTANCE_THRESHOLD = 2.0 # 可調參數
 
 
+# 調紐 (toggle) 對應的特徵
+TOGGLE_FEATURES = {
+    "eye_toggle": "BlueEyesForbidden",
+    "nose_toggle": "BlackNoseRequired",
+    "clothes_toggle": "BodyWeight_norm",
+}
+
+
+def compile_model():
+    """
+    將 IDEAL_VECTORS / IDEAL_VECTORS_WEIGHTS / 懲罰設定編譯成 NumPy 陣列。
+    模組載入時自動執行一次；若執行期修改了上述常數，請再呼叫一次。
+    """
+    global BREED_NAMES, FEATURE_ORDER, IDEAL_MATRIX, WEIGHT_MATRIX
+    global PENALTY_VECTOR, TOGGLE_INDEX, BREED_LABELS, LABEL_IS_REGULATED
+
+    BREED_NAMES = list(IDEAL_VECTORS.keys())
+    FEATURE_ORDER = sorted(IDEAL_VECTORS[BREED_NAMES[0]].keys())
+    IDEAL_MATRIX = np.array(
+        [[IDEAL_VECTORS[breed][k] for k in FEATURE_ORDER] for breed in BREED_NAMES], dtype=float
+    )
+    WEIGHT_MATRIX = np.array(
+        [[IDEAL_VECTORS_WEIGHTS[breed][k] for k in FEATURE_ORDER] for breed in BREED_NAMES], dtype=float
+    )
+    PENALTY_VECTOR = np.array(
+        [REGULATED_PENALTY_MULTIPLIER if breed in REGULATED_BREEDS else 1.0 for breed in BREED_NAMES]
+    )
+    TOGGLE_INDEX = {name: FEATURE_ORDER.index(k) for name, k in TOGGLE_FEATURES.items()}
+    # 最後一格是否決後的「其他犬種」
+    BREED_LABELS = np.array(BREED_NAMES + ["其他犬種"], dtype=object)
+    LABEL_IS_REGULATED = np.array([label in REGULATED_BREEDS for label in BREED_LABELS])
+
+
+compile_model()
+
+
+def parameter_hash():
+    """目前 PNN 參數 (理想向量、權重、懲罰、閾值) 的 SHA-256，用於判斷舊結果是否過期"""
+    params = {
+        "ideal_vectors": IDEAL_VECTORS,
+        "weights": IDEAL_VECTORS_WEIGHTS,
+        "regulated_breeds": REGULATED_BREEDS,
+        "penalty": REGULATED_PENALTY_MULTIPLIER,
+        "threshold": DISTANCE_THRESHOLD,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def features_to_matrix(feature_dicts):
+    """將多筆特徵字典依 FEATURE_ORDER 排成 (N × 特徵數) 的矩陣"""
+    return np.array([[float(d[k]) for k in FEATURE_ORDER] for d in feature_dicts], dtype=float)
+
+
+def classify_breeds(matrix,
+                    eye_toggle=1.0,
+                    nose_toggle=1.0,
+                    clothes_toggle=1.0):
+    """
+    classify_breed 的向量化版本：一次計算 N 筆特徵 (欄位順序為 FEATURE_ORDER) 與所有理想向量的加權距離。
+    不逐筆列印，回傳：
+        distances   (N × 犬種數) 加權距離 (已含管制犬懲罰)
+        best_index  (N,) 最近犬種在 BREED_NAMES 中的索引
+        min_distance(N,) 最小距離
+        vetoed      (N,) 是否因超過 DISTANCE_THRESHOLD 而被否決
+        breed       (N,) 最終犬種名稱 (否決者為「其他犬種」)
+        regulated   (N,) 是否為管制犬種
+        status      (N,) 「管制犬種」/「非管制犬種」
+    """
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+    if matrix.shape[1] != len(FEATURE_ORDER):
+        raise ValueError(f"特徵矩陣應有 {len(FEATURE_ORDER)} 欄，實際為 {matrix.shape[1]} 欄")
+
+    weights = WEIGHT_MATRIX.copy()
+    toggles = {"eye_toggle": eye_toggle, "nose_toggle": nose_toggle, "clothes_toggle": clothes_toggle}
+    for name, value in toggles.items():
+        weights[:, TOGGLE_INDEX[name]] *= value
+
+    # 依特徵順序逐欄累加，與 classify_breed 的加總順序相同，確保結果逐位元一致
+    weighted_distance_sq = np.zeros((matrix.shape[0], len(BREED_NAMES)))
+    for j in range(len(FEATURE_ORDER)):
+        diff = matrix[:, j:j + 1] - IDEAL_MATRIX[:, j]
+        weighted_distance_sq += (diff ** 2) * weights[:, j]
+
+    distances = np.sqrt(weighted_distance_sq) * PENALTY_VECTOR
+
+    best_index = np.argmin(distances, axis=1)
+    min_distance = distances[np.arange(distances.shape[0]), best_index]
+    # 以「不小於等於閾值」判定否決，NaN 距離也會被否決 (與單筆版的行為一致)
+    vetoed = ~(min_distance <= DISTANCE_THRESHOLD)
+    label_index = np.where(vetoed, len(BREED_NAMES), best_index)
+    regulated = LABEL_IS_REGULATED[label_index]
+
+    return {
+        "distances": distances,
+        "best_index": best_index,
+        "min_distance": min_distance,
+        "vetoed": vetoed,
+        "breed": BREED_LABELS[label_index],
+        "regulated": regulated,
+        "status": np.where(regulated, "管制犬種", "非管制犬種"),
+    }
+
+
 def classify_breed(feature_dict, 
                    eye_toggle=1.0, 
                    nose_toggle=1.0, 
                    clothes_toggle=1.0):
     """
     計算輸入特徵與四種理想向量的「加權」距離，找出最可能的犬種。
+    (單筆版本；內部使用 classify_breeds 計算，並列印每個犬種的距離)
     """
     if not feature_dict:
         return {"breed": "未知", "status": "無法分類"}
@@ -71,59 +178,27 @@ def classify_breed(feature_dict,
     try:
         feature_keys = sorted(feature_dict.keys())
         
-        expected_keys = sorted(IDEAL_VECTORS["美國比特鬥牛犬 (APBT)"].keys())
-        if feature_keys != expected_keys:
-            print(f"錯誤：VLM 回傳的特徵鍵 ({feature_keys}) 與 PNN 預期的鍵 ({expected_keys}) 不符。")
+        if feature_keys != FEATURE_ORDER:
+            print(f"錯誤：VLM 回傳的特徵鍵 ({feature_keys}) 與 PNN 預期的鍵 ({FEATURE_ORDER}) 不符。")
             return {"breed": "未知", "status": "分類失敗 (特徵鍵不匹配)"}
 
-        input_vector_dict = {k: float(feature_dict[k]) for k in feature_keys}
-
-        min_distance = float('inf')
-        best_match_breed = "未知"
-
-        for breed, ideal_feature_dict in IDEAL_VECTORS.items():
-            ideal_vector = ideal_feature_dict
-            ideal_weights = IDEAL_VECTORS_WEIGHTS[breed] 
-            
-            weighted_distance_sq = 0.0 
-
-            for k in feature_keys:
-                input_val = input_vector_dict[k]
-                ideal_val = ideal_vector[k]
-                
-                base_weight = ideal_weights[k]
-                
-                # 應用前端調紐
-                final_weight = base_weight
-                if k == "BlueEyesForbidden":
-                    final_weight *= eye_toggle
-                elif k == "BlackNoseRequired":
-                    final_weight *= nose_toggle
-                elif k == "BodyWeight_norm":
-                    final_weight *= clothes_toggle
-                
-                weighted_distance_sq += ((input_val - ideal_val) ** 2) * final_weight
-            
-            distance = np.sqrt(weighted_distance_sq)
-            
-            # 應用管制犬懲罰
-            if breed in REGULATED_BREEDS:
-                distance *= REGULATED_PENALTY_MULTIPLIER
-            
-            print(f"與「{breed}」理想向量的(加權)距離: {distance:.4f}")
+        input_vector = [float(feature_dict[k]) for k in FEATURE_ORDER]
 
-            if distance < min_distance:
-                min_distance = distance
-                best_match_breed = breed
+        result = classify_breeds([input_vector],
+                                 eye_toggle=eye_toggle,
+                                 nose_toggle=nose_toggle,
+                                 clothes_toggle=clothes_toggle)
+
+        for breed, distance in zip(BREED_NAMES, result["distances"][0]):
+            print(f"與「{breed}」理想向量的(加權)距離: {distance:.4f}")
 
         # 應用否決閾值
-        if min_distance > DISTANCE_THRESHOLD:
-            print(f"否決！最小距離 {min_distance:.4f} > 閾值 {DISTANCE_THRESHOLD}。")
-            best_match_breed = "其他犬種" # 強制覆寫分類結果
+        if result["vetoed"][0]:
+            print(f"否決！最小距離 {result['min_distance'][0]:.4f} > 閾值 {DISTANCE_THRESHOLD}。")
 
-        status = "管制犬種" if best_match_breed in REGULATED_BREEDS else "非管制犬種"
-        
-        return {"breed": best_match_breed, "status": status}
+        # 各犬種的距離一併回傳，報告中的距離與最近犬種即以此為準 (與本次使用的開關、參數一致)
+        return {"breed": str(result["breed"][0]), "status": str(result["status"][0]),
+                "distances": {breed: float(d) for breed, d in zip(BREED_NAMES, result["distances"][0])}}
         
     except (ValueError, TypeError) as e:
         print(f"錯誤：無法將 VLM 的回傳值轉換為數字。錯誤訊息: {e}")
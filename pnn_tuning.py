@@ -0,0 +1,299 @@
+# pnn_tuning.py (以已萃取的特徵離線調整 PNN 參數：一次以 NumPy 廣播評估整組參數)
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+import pnn_model
+
+# 每批同時評估的 (參數組 × 樣本 × 犬種) 元素上限，控制記憶體用量 (約 8 bytes/元素)
+CHUNK_ELEMENTS = 20_000_000
+
+
+# --- 資料載入 ---
+def _label_aliases():
+    """接受完整標籤，也接受括號內的縮寫 (例如 APBT、AmStaff) 與 other"""
+    aliases = {}
+    for index, label in enumerate(pnn_model.BREED_LABELS):
+        aliases[label.lower()] = index
+        if " (" in label:
+            name, abbreviation = label[:-1].split(" (", 1)
+            aliases[name.lower()] = index
+            aliases[abbreviation.lower()] = index
+    aliases["other"] = len(pnn_model.BREED_NAMES)
+    return aliases
+
+
+def load_samples(path):
+    """
+    讀取有標籤的特徵資料，回傳 (特徵矩陣 N×F, 標籤索引 N)。
+    支援 JSONL (每行 {"label": ..., "features": {...}} 或特徵欄位與 label 同層) 與 CSV (label 欄 + 8 個特徵欄)。
+    標籤索引對應 pnn_model.BREED_LABELS，最後一格為「其他犬種」。
+    """
+    aliases = _label_aliases()
+    records = []
+    if path.endswith(".csv"):
+        with open(path, newline='', encoding='utf-8') as f:
+            records = list(csv.DictReader(f))
+    else:
+        with open(path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    features, labels = [], []
+    for line_no, record in enumerate(records, 1):
+        label = str(record.get("label", "")).strip().lower()
+        if label not in aliases:
+            print(f"略過第 {line_no} 筆：未知的標籤 '{record.get('label')}'")
+            continue
+        values = record.get("features", record)
+        try:
+            features.append([float(values[k]) for k in pnn_model.FEATURE_ORDER])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"略過第 {line_no} 筆：特徵不完整或格式錯誤 ({e})")
+            continue
+        labels.append(aliases[label])
+    return np.array(features, dtype=float).reshape(-1, len(pnn_model.FEATURE_ORDER)), np.array(labels, dtype=int)
+
+
+def load_from_cache(labels_path):
+    """
+    由標籤 CSV (image,label) 與 vlm_cache 中已萃取的特徵組出資料集，不呼叫 VLM。
+    使用目前的特徵萃取模型與縮圖設定組出快取鍵；快取中沒有的圖片會被略過。
+    """
+    import vlm_numeric
+
+    aliases = _label_aliases()
+    features, labels, missing = [], [], 0
+    with open(labels_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            label = row.get("label", "").strip().lower()
+            if label not in aliases:
+                print(f"略過 {row.get('image')}：未知的標籤 '{row.get('label')}'")
+                continue
+            _, _, cached = vlm_numeric._prepare_feature_request(row["image"])
+            if cached is None:
+                missing += 1
+                continue
+            features.append([float(cached[k]) for k in pnn_model.FEATURE_ORDER])
+            labels.append(aliases[label])
+    if missing:
+        print(f"{missing} 張圖片在特徵快取中找不到，已略過")
+    return np.array(features, dtype=float).reshape(-1, len(pnn_model.FEATURE_ORDER)), np.array(labels, dtype=int)
+
+
+def make_synthetic_samples(n, noise=0.12, other_ratio=0.2, seed=0):
+    """在各犬種理想向量附近產生帶雜訊的樣本，另有 other_ratio 比例的均勻隨機「其他犬種」"""
+    rng = np.random.default_rng(seed)
+    n_breeds = len(pnn_model.BREED_NAMES)
+    labels = rng.integers(0, n_breeds, size=n)
+    labels[rng.random(n) < other_ratio] = n_breeds
+    features = np.empty((n, len(pnn_model.FEATURE_ORDER)))
+    is_other = labels == n_breeds
+    features[~is_other] = pnn_model.IDEAL_MATRIX[labels[~is_other]] + rng.normal(0, noise, ((~is_other).sum(), features.shape[1]))
+    features[is_other] = rng.random((is_other.sum(), features.shape[1]))
+    return np.clip(features, 0.0, 1.0), labels
+
+
+# --- 參數空間 ---
+def parse_range(spec):
+    """"1.5:2.5:11" 代表 linspace(1.5, 2.5, 11)；"1.0,1.1" 為明確清單"""
+    if ":" in spec:
+        start, stop, num = spec.split(":")
+        return np.linspace(float(start), float(stop), int(num))
+    return np.array([float(v) for v in spec.split(",") if v], dtype=float)
+
+
+def sample_variants(count, ideal_sigma=0.05, weight_sigma=0.25, seed=0):
+    """
+    隨機搜尋用的 (理想向量, 權重) 組合：第 0 組為目前參數，其餘在目前參數附近擾動。
+    權重為 0 的特徵 (例如 APBT 不看鼻色) 維持為 0。回傳 (V×B×F, V×B×F)。
+    """
+    rng = np.random.default_rng(seed)
+    shape = (count,) + pnn_model.IDEAL_MATRIX.shape
+    ideals = np.clip(pnn_model.IDEAL_MATRIX + rng.normal(0, ideal_sigma, shape), 0.0, 1.0)
+    weights = pnn_model.WEIGHT_MATRIX * np.exp(rng.normal(0, weight_sigma, shape))
+    ideals[0] = pnn_model.IDEAL_MATRIX
+    weights[0] = pnn_model.WEIGHT_MATRIX
+    return ideals, weights
+
+
+# --- 廣播評估 ---
+def raw_distances(features, ideals, weights):
+    """
+    未含懲罰的加權距離 (V×N×B)。
+    展開 Σ w(x−m)² = Σ w x² − 2 Σ w m x + Σ w m²，以矩陣乘法一次算完所有參數組。
+    """
+    sq = features ** 2
+    d2 = (np.einsum('nf,vbf->vnb', sq, weights)
+          - 2.0 * np.einsum('nf,vbf->vnb', features, weights * ideals)
+          + np.einsum('vbf->vb', weights * ideals ** 2)[:, None, :])
+    return np.sqrt(np.maximum(d2, 0.0))
+
+
+def _correct_counts(min_distance, correct_if_kept, truth_other, thresholds):
+    """
+    min_distance (R×N)：每列一組 (參數組, 懲罰) 的最小距離。
+    對每個閾值計算答對數：距離 <= 閾值者以最近犬種作答，其餘判為「其他犬種」。
+    以排序 + 累加 + 各列偏移後的 searchsorted 取代 (閾值 × 樣本) 的逐一比較。回傳 R×T。
+    """
+    rows, n = min_distance.shape
+    order = np.argsort(min_distance, axis=1)
+    sorted_distance = np.take_along_axis(min_distance, order, axis=1)
+    kept_correct = np.cumsum(np.take_along_axis(correct_if_kept, order, axis=1), axis=1)
+    other_seen = np.cumsum(np.take_along_axis(np.broadcast_to(truth_other, (rows, n)), order, axis=1), axis=1)
+    zero = np.zeros((rows, 1), dtype=kept_correct.dtype)
+    kept_correct = np.hstack([zero, kept_correct])
+    other_seen = np.hstack([zero, other_seen])
+
+    # 每列加上不重疊的偏移後攤平，一次 searchsorted 即可得到每列、每個閾值的「保留筆數」
+    span = float(max(sorted_distance.max(), thresholds.max())) + 1.0
+    offsets = np.arange(rows)[:, None] * span
+    flat = (sorted_distance + offsets).ravel()
+    positions = np.searchsorted(flat, (thresholds[None, :] + offsets).ravel(), side='right')
+    kept = positions.reshape(rows, -1) - np.arange(rows)[:, None] * n
+
+    row_index = np.arange(rows)[:, None]
+    total_other = other_seen[:, -1:]
+    return kept_correct[row_index, kept] + (total_other - other_seen[row_index, kept])
+
+
+def evaluate_grid(features, labels, ideals, weights, penalties, thresholds):
+    """
+    評估所有 (參數組 V × 懲罰 P × 閾值 T) 的準確率，回傳 V×P×T 陣列。
+    樣本只走一次矩陣運算；懲罰與閾值只影響距離之後的步驟，因此不重算距離。
+    """
+    n, n_breeds = len(labels), pnn_model.IDEAL_MATRIX.shape[0]
+    regulated = np.array([breed in pnn_model.REGULATED_BREEDS for breed in pnn_model.BREED_NAMES])
+    truth_other = (labels == n_breeds)
+    accuracy = np.empty((len(ideals), len(penalties), len(thresholds)))
+
+    chunk = max(1, CHUNK_ELEMENTS // max(1, n * n_breeds * len(penalties)))
+    for start in range(0, len(ideals), chunk):
+        stop = min(start + chunk, len(ideals))
+        distances = raw_distances(features, ideals[start:stop], weights[start:stop])       # v×n×b
+        penalty_vectors = np.where(regulated, penalties[:, None], 1.0)                     # p×b
+        penalized = distances[:, None, :, :] * penalty_vectors[None, :, None, :]          # v×p×n×b
+        best = np.argmin(penalized, axis=3)
+        min_distance = np.take_along_axis(penalized, best[..., None], axis=3)[..., 0]
+        correct_if_kept = (best == labels)
+        counts = _correct_counts(min_distance.reshape(-1, n),
+                                 correct_if_kept.reshape(-1, n),
+                                 truth_other, thresholds)
+        accuracy[start:stop] = counts.reshape(stop - start, len(penalties), len(thresholds)) / n
+    return accuracy
+
+
+# --- 結果輸出 ---
+def confusion_matrix(features, labels, ideal, weight, penalty, threshold):
+    """以 pnn_model.classify_breeds (與線上相同的計算) 套用指定參數，回傳 (混淆矩陣, 準確率)"""
+    saved = (pnn_model.IDEAL_MATRIX, pnn_model.WEIGHT_MATRIX, pnn_model.PENALTY_VECTOR,
+             pnn_model.DISTANCE_THRESHOLD)
+    try:
+        pnn_model.IDEAL_MATRIX = ideal
+        pnn_model.WEIGHT_MATRIX = weight
+        pnn_model.PENALTY_VECTOR = np.array(
+            [penalty if breed in pnn_model.REGULATED_BREEDS else 1.0 for breed in pnn_model.BREED_NAMES])
+        pnn_model.DISTANCE_THRESHOLD = threshold
+        result = pnn_model.classify_breeds(features)
+    finally:
+        (pnn_model.IDEAL_MATRIX, pnn_model.WEIGHT_MATRIX, pnn_model.PENALTY_VECTOR,
+         pnn_model.DISTANCE_THRESHOLD) = saved
+    n_labels = len(pnn_model.BREED_LABELS)
+    predicted = np.where(result["vetoed"], n_labels - 1, result["best_index"])
+    matrix = np.zeros((n_labels, n_labels), dtype=int)
+    np.add.at(matrix, (labels, predicted), 1)
+    return matrix, float(np.trace(matrix)) / max(1, len(labels))
+
+
+def print_confusion(matrix):
+    names = [label.split(" (")[-1].rstrip(")") for label in pnn_model.BREED_LABELS]
+    header = "實際 \\ 預測"
+    print(f"{header:<16}" + "".join(f"{name:>16}" for name in names))
+    for name, row in zip(names, matrix):
+        print(f"{name:<16}" + "".join(f"{count:>16}" for count in row))
+
+
+def to_parameters(ideal, weight, penalty, threshold):
+    """轉成可直接貼回 pnn_model.py 的常數格式"""
+    def as_dict(matrix):
+        return {breed: {k: round(float(matrix[b, f]), 4) for f, k in enumerate(pnn_model.FEATURE_ORDER)}
+                for b, breed in enumerate(pnn_model.BREED_NAMES)}
+    return {
+        "IDEAL_VECTORS": as_dict(ideal),
+        "IDEAL_VECTORS_WEIGHTS": as_dict(weight),
+        "REGULATED_PENALTY_MULTIPLIER": round(float(penalty), 4),
+        "DISTANCE_THRESHOLD": round(float(threshold), 4),
+    }
+
+
+def tune(features, labels, ideals, weights, penalties, thresholds):
+    start = time.perf_counter()
+    accuracy = evaluate_grid(features, labels, ideals, weights, penalties, thresholds)
+    elapsed = time.perf_counter() - start
+    combos = accuracy.size
+    print(f"評估 {combos:,} 組參數 × {len(labels):,} 筆樣本，耗時 {elapsed:.2f} 秒 "
+          f"({combos * len(labels) / elapsed / 1e6:,.1f} M 組合樣本/秒)")
+
+    v, p, t = np.unravel_index(np.argmax(accuracy), accuracy.shape)
+    best = (ideals[v], weights[v], penalties[p], thresholds[t])
+    matrix, exact_accuracy = confusion_matrix(features, labels, *best)
+    baseline_matrix, baseline_accuracy = confusion_matrix(
+        features, labels, pnn_model.IDEAL_MATRIX, pnn_model.WEIGHT_MATRIX,
+        pnn_model.REGULATED_PENALTY_MULTIPLIER, pnn_model.DISTANCE_THRESHOLD)
+
+    print(f"\n目前參數準確率: {baseline_accuracy:.2%}")
+    print_confusion(baseline_matrix)
+    print(f"\n最佳參數準確率: {exact_accuracy:.2%} (參數組 #{v}{' = 目前的理想向量與權重' if v == 0 else ''}，"
+          f"懲罰 {penalties[p]:.3f}，閾值 {thresholds[t]:.3f})")
+    print_confusion(matrix)
+    return {
+        "combinations": combos,
+        "samples": int(len(labels)),
+        "seconds": elapsed,
+        "baseline_accuracy": baseline_accuracy,
+        "best_accuracy": exact_accuracy,
+        "confusion_matrix": matrix.tolist(),
+        "labels": list(pnn_model.BREED_LABELS),
+        "parameters": to_parameters(*best),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="以已萃取的特徵離線調整 PNN 參數")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--samples', help="有標籤的特徵資料 (.jsonl 或 .csv)")
+    source.add_argument('--labels', help="圖片標籤 CSV (image,label)，特徵取自 vlm_cache")
+    source.add_argument('--synthetic', type=int, help="產生 N 筆合成樣本 (測試與效能量測用)")
+    parser.add_argument('--thresholds', default="1.0:3.0:41", help="DISTANCE_THRESHOLD 候選值 (start:stop:num 或逗號清單)")
+    parser.add_argument('--penalties', default="1.0:1.3:7", help="REGULATED_PENALTY_MULTIPLIER 候選值")
+    parser.add_argument('--random', type=int, default=1,
+                        help="隨機搜尋的理想向量/權重組數 (1 = 只用目前的理想向量與權重)")
+    parser.add_argument('--ideal-sigma', type=float, default=0.05, help="隨機搜尋時理想向量的擾動標準差")
+    parser.add_argument('--weight-sigma', type=float, default=0.25, help="隨機搜尋時權重的對數擾動標準差")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="將最佳參數與混淆矩陣另存為 JSON")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.samples:
+        features, labels = load_samples(args.samples)
+    elif args.labels:
+        features, labels = load_from_cache(args.labels)
+    else:
+        features, labels = make_synthetic_samples(args.synthetic, seed=args.seed)
+    if not len(labels):
+        sys.exit("沒有可用的樣本")
+    print(f"載入 {len(labels):,} 筆樣本")
+
+    ideals, weights = sample_variants(max(1, args.random), args.ideal_sigma, args.weight_sigma, args.seed)
+    report = tune(features, labels, ideals, weights, parse_range(args.penalties), parse_range(args.thresholds))
+    if args.out:
+        with open(args.out, "w", encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"最佳參數已儲存至: {args.out}")
@@ -0,0 +1,120 @@
+# report_index.py (精簡輸出模式的批次索引頁：彙整 manifest 中每張圖片的鑑定結果)
+
+import collections
+import html
+import os
+import time
+import urllib.parse
+
+INDEX_NAME = 'index.html'
+
+# 索引頁專用的樣式，與報告頁的樣式一起寫入共用樣式表
+INDEX_CSS = """
+.index-table { width: 100%; border-collapse: collapse; font-size: 14px; }
+.index-table th, .index-table td { border-bottom: 1px solid #e2e6e5; padding: 6px 10px; text-align: left; vertical-align: middle; }
+.index-table th { background-color: #eef3f8; position: sticky; top: 0; }
+.index-table img { width: 96px; height: auto; border-radius: 4px; display: block; }
+.index-summary { display: flex; flex-wrap: wrap; gap: 30px; padding: 20px 30px 0; }
+.index-summary table { border-collapse: collapse; font-size: 14px; }
+.index-summary td { padding: 2px 12px 2px 0; }
+.index-body { padding: 20px 30px 30px; }
+.muted { color: #888; }
+"""
+
+
+def href(path, base_dir):
+    """由 base_dir 內的頁面連到 path 的相對網址"""
+    relative = os.path.relpath(path, base_dir).replace(os.sep, '/')
+    return urllib.parse.quote(relative)
+
+
+def index_rows(entries):
+    """由 manifest 紀錄整理出索引的每一列 (只保留報告仍存在者)，依圖片路徑排序"""
+    rows = []
+    for image_path in sorted(entries):
+        entry = entries[image_path]
+        if not os.path.exists(entry.get("report", "")):
+            continue
+        result = entry.get("result") or {}
+        rows.append({
+            "image": image_path,
+            "report": entry["report"],
+            "judgment": result.get("judgment") or "",
+            "breed": result.get("breed") or "",
+            "status": result.get("status") or "",
+            "case": result.get("case") or "",
+            "duplicate_of": result.get("duplicate_of") or "",
+            "completed_at": entry.get("completed_at", ""),
+        })
+    return rows
+
+
+def _summary_table(title, counter):
+    lines = "".join(f"<tr><td>{html.escape(name or '(未記錄)')}</td><td>{count}</td></tr>"
+                    for name, count in counter.most_common())
+    return f"<div><h3>{title}</h3><table>{lines}</table></div>"
+
+
+def render_index(rows, output_dir, thumbnail_for, stylesheet):
+    """產生索引頁 HTML；thumbnail_for(圖片路徑) 回傳縮圖路徑，stylesheet 為共用樣式表的檔名"""
+    body = []
+    for row in rows:
+        thumbnail = thumbnail_for(row["image"])
+        image_link = href(row["image"], output_dir)
+        if os.path.exists(thumbnail):
+            preview = f'<a href="{image_link}"><img src="{href(thumbnail, output_dir)}" alt="" loading="lazy"></a>'
+        else:
+            preview = '<span class="muted">-</span>'
+        note = (f'<br><span class="muted">沿用 {html.escape(os.path.basename(row["duplicate_of"]))}</span>'
+                if row["duplicate_of"] else "")
+        body.append(
+            f"<tr><td>{preview}</td>"
+            f'<td><a href="{href(row["report"], output_dir)}">{html.escape(os.path.basename(row["image"]))}</a>'
+            f"{note}</td>"
+            f"<td>{html.escape(row['judgment'])}</td>"
+            f"<td>{html.escape(row['breed'])}</td>"
+            f"<td>{html.escape(row['status'])}</td>"
+            f"<td>{html.escape(row['case'])}</td>"
+            f"<td>{html.escape(row['completed_at'])}</td></tr>"
+        )
+    breeds = collections.Counter(row["breed"] for row in rows)
+    statuses = collections.Counter(row["status"] for row in rows)
+    return f"""<!DOCTYPE html>
+<html lang="zh-Hant">
+<head>
+<meta charset="UTF-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>犬隻品種分析報告索引</title>
+<link rel="stylesheet" href="{stylesheet}">
+</head>
+<body>
+<div class="container">
+<div class="header"><h1>犬隻品種分析報告索引</h1></div>
+<div class="index-summary">
+<div><h3>總計</h3><p>{len(rows)} 份報告<br><span class="muted">更新於 {time.strftime("%Y-%m-%d %H:%M:%S")}</span></p></div>
+{_summary_table("PNN 品種", breeds)}
+{_summary_table("PNN 狀態", statuses)}
+</div>
+<div class="index-body">
+<table class="index-table">
+<thead><tr><th>縮圖</th><th>圖片 / 報告</th><th>VLM 初步意見</th><th>PNN 品種</th><th>PNN 狀態</th><th>報告情況</th><th>完成時間</th></tr></thead>
+<tbody>
+{chr(10).join(body)}
+</tbody>
+</table>
+</div>
+</div>
+</body>
+</html>
+"""
+
+
+def write_index(manifest, output_dir, thumbnail_for, stylesheet):
+    """依 manifest 重寫 output_dir/index.html (先寫暫存檔再原子替換)，回傳索引路徑與列數"""
+    rows = index_rows(manifest.entries)
+    path = os.path.join(output_dir, INDEX_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(render_index(rows, output_dir, thumbnail_for, stylesheet))
+    os.replace(tmp_path, path)
+    return path, len(rows)
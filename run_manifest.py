@@ -0,0 +1,139 @@
+# run_manifest.py (批次處理紀錄：增量執行與中斷續跑)
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import gemma_report
+import image_preprocess
+import model_routing
+import pnn_model
+import vlm_cache
+import vlm_numeric
+
+MANIFEST_PATH = os.path.join('out', 'manifest.jsonl')
+
+
+def prompt_version():
+    """所有提示詞 (含報告模板版本) 的雜湊；任何一段改變都會讓舊報告過期"""
+    parts = [
+        vlm_numeric.FEATURE_PROMPT,
+        vlm_numeric.COMBINED_PROMPT,
+        gemma_report.JUDGMENT_PROMPT,
+        f"report-v{gemma_report.REPORT_PROMPT_VERSION}",
+    ]
+    if gemma_report.REPORT_MODE != "llm":
+        # 快速報告模式的情況 A / B1 內容來自模板，與模型撰寫的報告不同
+        parts.append(f"report-mode-{gemma_report.REPORT_MODE}")
+    # 情況 B2 報告 Prompt 的 token 預算與列出的犬種數會改變報告內容
+    parts.append(f"report-budget-{gemma_report.REPORT_PROMPT_TOKENS}-{gemma_report.REPORT_COMPETITORS}")
+    if vlm_numeric.FEATURE_BATCH_SIZE > 1:
+        # 多圖批次萃取的特徵可能與逐張萃取略有差異
+        parts.append(vlm_numeric.batch_feature_prompt(vlm_numeric.FEATURE_BATCH_SIZE))
+    return vlm_cache.sha256_hex("\n".join(parts))[:16]
+
+
+def current_fingerprint(**options):
+    """
+    決定報告是否需要重新產生的流程設定。
+    options 為呼叫端的流程選項 (例如初步意見流程、HTML 版面)，同樣會改變輸出，一併列入。
+    """
+    return {
+        "model": model_routing.signature(),
+        "preprocess": image_preprocess.signature(),
+        "prompt_version": prompt_version(),
+        "pnn_hash": pnn_model.parameter_hash()[:16],
+        **options,
+    }
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class RunManifest:
+    """
+    以 JSONL 逐行追加的處理紀錄，每完成一張圖片寫入一行並 fsync。
+    同一張圖片以最後一行為準；中斷後重跑時，已完成且設定未變的圖片會被略過。
+    """
+
+    def __init__(self, path=MANIFEST_PATH, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint or current_fingerprint()
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中斷時可能留下寫到一半的最後一行，直接忽略
+                    continue
+                self.entries[entry["image"]] = entry
+
+    def _stat(self, image_path):
+        stat = os.stat(image_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def is_done(self, image_path):
+        """圖片內容、流程設定皆未改變且報告仍存在時回傳 True"""
+        entry = self.entries.get(image_path)
+        if entry is None or not os.path.exists(entry.get("report", "")):
+            return False
+        if any(entry.get(k) != v for k, v in self.fingerprint.items()):
+            return False
+        size, mtime_ns = self._stat(image_path)
+        if (entry.get("size"), entry.get("mtime_ns")) == (size, mtime_ns):
+            return True
+        # 檔案時間變了但內容可能相同 (例如重新複製)，以內容雜湊確認
+        return entry.get("sha256") == file_sha256(image_path)
+
+    def record(self, image_path, report_path, sha256=None, result=None):
+        """寫入一張已完成圖片的紀錄；result 為鑑定結果摘要 (供 report_index 產生批次索引)"""
+        size, mtime_ns = self._stat(image_path)
+        entry = {
+            "image": image_path,
+            "sha256": sha256 or file_sha256(image_path),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            **self.fingerprint,
+            "report": report_path,
+            "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        if result:
+            entry["result"] = result
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            manifest_dir = os.path.dirname(self.path)
+            if manifest_dir and not os.path.exists(manifest_dir):
+                os.makedirs(manifest_dir)
+            with open(self.path, "a", encoding='utf-8') as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[image_path] = entry
+
+    def compact(self):
+        """將紀錄重寫為每張圖片一行，並以原子方式取代舊檔"""
+        with self._lock:
+            if not self.entries:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
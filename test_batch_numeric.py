@@ -0,0 +1,85 @@
+# test_batch_numeric.py (串流報告寫出：partial 檔與正式報告的原子換檔)
+
+import os
+
+import pytest
+
+import batch_numeric
+import gemma_report
+
+REPORT = "### 圖片 'dog.png' 分析報告 ###\n**一、綜合評估**: 其他犬種\n\n五、免責聲明\n"
+
+
+@pytest.fixture
+def image(tmp_path, monkeypatch):
+    from PIL import Image
+
+    image_dir, output_dir = tmp_path / "images", tmp_path / "out"
+    image_dir.mkdir()
+    output_dir.mkdir()
+    monkeypatch.setattr(batch_numeric, "IMAGE_DIR", str(image_dir))
+    monkeypatch.setattr(batch_numeric, "OUTPUT_DIR", str(output_dir))
+    monkeypatch.setattr(batch_numeric, "HTML_LAYOUT", "inline")
+    path = image_dir / "dog.png"
+    Image.new("RGB", (32, 32), (120, 90, 60)).save(path)
+    return str(path)
+
+
+def _read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_partial_grows_by_line_and_final_matches_non_streamed(image):
+    expected = _read(batch_numeric.write_report(image, REPORT))
+    os.remove(batch_numeric.report_path_for(image))
+
+    writer = batch_numeric.StreamingReportWriter(image)
+    writer.open()
+    writer.feed("### 圖片 'dog.png' 分析報告 ###\n**一、綜合")
+    partial = _read(writer.partial_path)
+    assert "分析報告" in partial
+    assert "綜合" not in partial  # 未完成的一行先不寫出
+    assert not os.path.exists(writer.report_path)
+
+    writer.feed("評估**: 其他犬種\n\n五、免責聲明\n")
+    assert "綜合評估" in _read(writer.partial_path)
+
+    assert writer.close(REPORT) == writer.report_path
+    assert _read(writer.report_path) == expected
+    assert not os.path.exists(writer.partial_path)
+    assert not os.path.exists(writer.report_path + ".tmp")
+
+
+def test_failed_rename_keeps_previous_report(image, monkeypatch):
+    report_path = batch_numeric.report_path_for(image)
+    with open(report_path, "w", encoding="utf-8") as f:
+        f.write("previous")
+
+    writer = batch_numeric.StreamingReportWriter(image)
+    writer.open()
+    writer.feed(REPORT)
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(batch_numeric.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        writer.close(REPORT)
+    assert _read(report_path) == "previous"
+
+
+def test_generation_error_removes_partial(image, monkeypatch):
+    def failing_report(image_path, on_chunk=None, **kwargs):
+        on_chunk("### 圖片 'dog.png' 分析報告 ###\n")
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(batch_numeric, "STREAM_REPORTS", True)
+    monkeypatch.setattr(gemma_report, "generate_gemma_report", failing_report)
+    asset = batch_numeric.image_asset.ImageAsset(image)
+    with pytest.raises(RuntimeError):
+        batch_numeric.generate_and_write(asset)
+
+    report_path = batch_numeric.report_path_for(image)
+    assert not os.path.exists(report_path)
+    assert not os.path.exists(batch_numeric._partial_path(report_path))
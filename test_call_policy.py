@@ -0,0 +1,134 @@
+# test_call_policy.py (逾時設定、重試預算與對沖請求，不需 Ollama)
+
+import asyncio
+import collections
+import itertools
+import threading
+
+import ollama
+import pytest
+
+import call_policy
+
+
+@pytest.fixture(autouse=True)
+def policy(monkeypatch):
+    """每個測試使用全新的統計、預算與延遲視窗，且退避不等待"""
+    monkeypatch.setattr(call_policy, "POLICY_STATS", collections.Counter())
+    monkeypatch.setattr(call_policy, "budget", call_policy.RetryBudget())
+    monkeypatch.setattr(call_policy, "_latencies",
+                        collections.defaultdict(lambda: collections.deque(maxlen=call_policy.LATENCY_WINDOW)))
+    monkeypatch.setattr(call_policy, "BACKOFF_BASE_S", 0.0)
+    monkeypatch.setattr(call_policy, "MAX_RETRIES", 2)
+    monkeypatch.setattr(call_policy, "HEDGE", False)
+    return call_policy
+
+
+def _flaky(errors, result="ok"):
+    """依序拋出 errors 中的錯誤，之後回傳 result；記錄每次收到的參數"""
+    calls = []
+    pending = iter(errors)
+
+    def chat(**kwargs):
+        calls.append(kwargs)
+        error = next(pending, None)
+        if error is not None:
+            raise error
+        return result
+
+    return chat, calls
+
+
+def test_prepare_applies_stage_limits_without_overriding_caller():
+    kwargs = call_policy.prepare('judgment', {'model': 'm', 'options': {'temperature': 0}})
+    assert kwargs['timeout'] == call_policy.STAGE_TIMEOUTS['judgment']
+    assert kwargs['options'] == {'temperature': 0, 'num_predict': call_policy.STAGE_NUM_PREDICT['judgment']}
+
+    kwargs = call_policy.prepare('followup', {'timeout': 5, 'options': {'num_predict': 7}})
+    assert kwargs['timeout'] == 5
+    assert kwargs['options'] == {'num_predict': 7}
+
+
+def test_retries_timeouts_and_server_errors():
+    chat, calls = _flaky([call_policy.CallTimeout("slow"), ollama.ResponseError("busy", 503)])
+    assert call_policy.call('features', chat, {'model': 'm'}) == "ok"
+    assert len(calls) == 3
+    assert call_policy.POLICY_STATS['retries'] == 2
+    assert call_policy.POLICY_STATS['timeouts'] == 1
+
+
+def test_gives_up_after_max_retries_and_on_client_errors():
+    chat, calls = _flaky([call_policy.CallTimeout("slow")] * 5)
+    with pytest.raises(call_policy.CallTimeout):
+        call_policy.call('features', chat, {})
+    assert len(calls) == 1 + call_policy.MAX_RETRIES
+
+    chat, calls = _flaky([ollama.ResponseError("bad request", 400)])
+    with pytest.raises(ollama.ResponseError):
+        call_policy.call('features', chat, {})
+    assert len(calls) == 1
+
+
+def test_retry_budget_limits_retries(monkeypatch):
+    monkeypatch.setattr(call_policy, "budget", call_policy.RetryBudget(ratio=0.0, minimum=1))
+    chat, calls = _flaky([ConnectionError("down")] * 2)
+    with pytest.raises(ConnectionError):
+        call_policy.call('report', chat, {})
+    assert len(calls) == 2
+    assert call_policy.POLICY_STATS['budget_exhausted'] == 1
+
+
+def _enable_hedging(monkeypatch, stage, latency=0.01):
+    monkeypatch.setattr(call_policy, "HEDGE", True)
+    call_policy._latencies[stage].extend([latency] * call_policy.HEDGE_MIN_SAMPLES)
+
+
+def test_no_hedge_before_enough_samples(monkeypatch):
+    monkeypatch.setattr(call_policy, "HEDGE", True)
+    assert call_policy.hedge_delay('features') is None
+    _enable_hedging(monkeypatch, 'features')
+    assert call_policy.hedge_delay('features') == call_policy.HEDGE_MIN_DELAY_S
+
+
+def test_sync_hedge_returns_the_faster_copy(monkeypatch):
+    _enable_hedging(monkeypatch, 'features')
+    release = threading.Event()
+    counter = itertools.count()
+
+    def chat(**kwargs):
+        if next(counter) == 0:
+            release.wait(5)  # 主請求卡住，直到測試結束才放行
+            return "primary"
+        return "hedge"
+
+    try:
+        assert call_policy.call('features', chat, {}) == "hedge"
+    finally:
+        release.set()
+    assert call_policy.POLICY_STATS['hedges'] == 1
+    assert call_policy.POLICY_STATS['hedge_wins'] == 1
+
+
+def test_async_hedge_cancels_the_loser(monkeypatch):
+    _enable_hedging(monkeypatch, 'report')
+    counter = itertools.count()
+    cancelled = []
+
+    async def chat(**kwargs):
+        if next(counter) == 0:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return "primary"
+        return "hedge"
+
+    async def run():
+        result = await call_policy.call_async('report', chat, {})
+        await asyncio.sleep(0)  # 讓被取消的任務處理 CancelledError
+        return result
+
+    assert asyncio.run(run()) == "hedge"
+    assert cancelled == [True]
+    assert call_policy.POLICY_STATS['hedge_wins'] == 1
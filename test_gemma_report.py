@@ -0,0 +1,118 @@
+# test_gemma_report.py (初步意見的分類對應與升級判斷)
+
+import collections
+
+import pytest
+
+import gemma_report
+import model_routing
+import pnn_model
+
+APBT = "美國比特鬥牛犬 (APBT)"
+AMSTAFF = "美國史大佛夏牛頭犬 (AmStaff)"
+SBT = "史大佛夏牛頭犬 (SBT)"
+
+
+@pytest.mark.parametrize("judgment, label", [
+    (APBT, APBT),
+    ("American Pit Bull Terrier", APBT),
+    ("  amstaff ", AMSTAFF),
+    ("Staffordshire Bull Terrier", SBT),
+    # 「美國史大佛夏牛頭犬」包含「史大佛夏牛頭犬」，應對應到較長的名稱
+    ("美國史大佛夏牛頭犬", AMSTAFF),
+    ("American Staffordshire Terrier", AMSTAFF),
+    ("其他犬種", "其他犬種"),
+])
+def test_judgment_label(judgment, label):
+    assert gemma_report.judgment_label(judgment) == label
+
+
+@pytest.mark.parametrize("judgment", ["黃金獵犬", "APBT 或 SBT", "不確定"])
+def test_judgment_label_ambiguous_or_unknown(judgment):
+    assert gemma_report.judgment_label(judgment) is None
+
+
+@pytest.fixture
+def small_judgment_model(monkeypatch):
+    monkeypatch.setitem(model_routing.STAGE_MODELS, 'judgment', "small")
+    monkeypatch.setattr(model_routing, "ESCALATION_MODEL", "large")
+
+
+def test_escalation_reason(small_judgment_model):
+    assert gemma_report.escalation_reason("不確定") == "uncertain"
+    assert gemma_report.escalation_reason("APBT") is None
+    assert gemma_report.escalation_reason("APBT", {"breed": SBT}) == "disagree"
+    assert gemma_report.escalation_reason("American Pit Bull Terrier", {"breed": APBT}) is None
+    # PNN 分類失敗 (未知) 不是可比較的分類，不視為衝突
+    assert gemma_report.escalation_reason("APBT", {"breed": "未知"}) is None
+
+
+def test_no_escalation_when_stage_already_uses_escalation_model(monkeypatch):
+    monkeypatch.setitem(model_routing.STAGE_MODELS, 'judgment', "large")
+    monkeypatch.setattr(model_routing, "ESCALATION_MODEL", "large")
+    assert gemma_report.escalation_reason("不確定") is None
+
+
+# --- 情況 B2 報告 Prompt 的 token 預算 ---
+@pytest.fixture
+def b2_case(monkeypatch):
+    """統計歸零；set_prompt_budget 改動的預算在測試結束時還原"""
+    monkeypatch.setattr(gemma_report, "PROMPT_STATS", collections.Counter())
+    monkeypatch.setattr(gemma_report, "REPORT_STATS", collections.Counter())
+    monkeypatch.setattr(gemma_report, "REPORT_PROMPT_TOKENS", gemma_report.REPORT_PROMPT_TOKENS)
+    monkeypatch.setattr(gemma_report, "REPORT_COMPETITORS", gemma_report.REPORT_COMPETITORS)
+    monkeypatch.setattr(gemma_report.vlm_cache.report_cache, "mode", "off")
+    features = dict(pnn_model.IDEAL_VECTORS[SBT])
+    classification = pnn_model.classify_breed(features)
+    assert classification["breed"] == SBT
+    return features, classification
+
+
+def _breeds_listed(content):
+    vectors = content.split("**知識庫 1")[1].split("**知識庫 2")[0]
+    return [breed for breed in pnn_model.BREED_NAMES if breed in vectors]
+
+
+def test_b2_prompt_lists_all_breeds_without_budget(b2_case):
+    features, classification = b2_case
+    gemma_report.set_prompt_budget(0, len(pnn_model.BREED_NAMES))
+    content, budget = gemma_report.build_b2_data_prompt("dog.jpg", features, classification, SBT)
+    listed = _breeds_listed(content)
+    assert sorted(listed) == sorted(pnn_model.BREED_NAMES)
+    assert budget["breeds"] == len(pnn_model.BREED_NAMES)
+    assert budget["tokens"] == budget["full_tokens"] == sum(budget["sections"].values())
+    # 只組 Prompt 不計入統計
+    assert not gemma_report.PROMPT_STATS
+
+
+def test_b2_prompt_trims_farthest_breeds_to_fit_budget(b2_case):
+    features, classification = b2_case
+    _, full = gemma_report.build_b2_data_prompt("dog.jpg", features, classification, SBT)
+    gemma_report.set_prompt_budget(full["full_tokens"] - 1, len(pnn_model.BREED_NAMES))
+    content, budget = gemma_report.build_b2_data_prompt("dog.jpg", features, classification, SBT)
+    gemma_report.set_prompt_budget(1, len(pnn_model.BREED_NAMES))
+    _, minimal = gemma_report.build_b2_data_prompt("dog.jpg", features, classification, SBT)
+
+    assert budget["tokens"] <= full["full_tokens"] - 1
+    assert budget["breeds"] < len(pnn_model.BREED_NAMES)
+    # PNN 結論一定保留，其餘依 classification_result 的距離由近到遠
+    distances = classification["distances"]
+    expected = [SBT] + sorted((b for b in distances if b != SBT), key=distances.get)
+    listed = _breeds_listed(content)
+    assert set(listed) == set(expected[:budget["breeds"]])
+    # 預算再小也至少列出 PNN 結論
+    assert minimal["breeds"] == 1
+
+
+def test_b2_stats_recorded_only_for_sent_requests(b2_case):
+    features, classification = b2_case
+    gemma_report.build_report_prompt("dog.jpg", features, classification, SBT)
+    assert not gemma_report.PROMPT_STATS
+
+    messages = gemma_report.build_report_messages("dog.jpg", features, classification, SBT, images=[])
+    assert messages[0] == {'role': 'system', 'content': gemma_report.REPORT_SYSTEM_PROMPT}
+    assert gemma_report.PROMPT_STATS["prompts"] == 1
+
+    gemma_report._finish_llm_report({"message": {"content": "報告"}, "prompt_eval_count": 900},
+                                    None, "dog.jpg", case="B2")
+    assert gemma_report.PROMPT_STATS["prompt_eval_tokens"] == 900
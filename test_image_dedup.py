@@ -0,0 +1,40 @@
+# test_image_dedup.py (重複與近似圖片分組)
+
+import pytest
+
+import image_dedup
+
+
+def _write(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_group_duplicates_exact_copies(tmp_path):
+    a = _write(tmp_path, "a.jpg", b"aaaa")
+    b = _write(tmp_path, "b.jpg", b"bbbbbb")
+    c = _write(tmp_path, "c.jpg", b"aaaa")
+    digests = {}
+    groups = image_dedup.group_duplicates([a, b, c], None, digests)
+    assert groups == [(a, [c]), (b, [])]
+    assert digests[a] == digests[c] != digests[b]
+
+
+def test_group_duplicates_negative_distance_disables(tmp_path):
+    a = _write(tmp_path, "a.jpg", b"aaaa")
+    c = _write(tmp_path, "c.jpg", b"aaaa")
+    assert image_dedup.group_duplicates([a, c], -1) == [(a, []), (c, [])]
+
+
+def test_group_duplicates_compares_with_leader_only(tmp_path, monkeypatch):
+    if image_dedup.Image is None:
+        pytest.skip("需要 Pillow 才會啟用感知雜湊")
+    # 檔案大小決定代表圖片：a 最大、c 最小；a-b 距離 4、b-c 距離 4、a-c 距離 8
+    a = _write(tmp_path, "a.jpg", b"a" * 30)
+    b = _write(tmp_path, "b.jpg", b"b" * 20)
+    c = _write(tmp_path, "c.jpg", b"c" * 10)
+    hashes = {a: 0x00, b: 0x0F, c: 0xFF}
+    monkeypatch.setattr(image_dedup, "dhash", hashes.get)
+    # c 與 b 相近，但 b 已併入 a 的組，c 與代表圖片 a 的距離超過上限，不能經由 b 串連
+    assert image_dedup.group_duplicates([c, b, a], 5) == [(c, []), (a, [b])]
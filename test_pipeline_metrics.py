@@ -0,0 +1,35 @@
+# test_pipeline_metrics.py (串流呼叫的彙整與錯誤處理)
+
+import asyncio
+
+import pytest
+
+import pipeline_metrics
+
+
+def _parts(*texts, done_reason="stop"):
+    parts = [{"message": {"content": text}} for text in texts]
+    parts[-1].update(done=True, done_reason=done_reason, eval_count=len(texts))
+    return parts
+
+
+def test_stream_returns_last_part_with_full_content():
+    chunks = []
+    response = pipeline_metrics.timed_chat_stream(
+        'report', lambda stage, **kwargs: iter(_parts("第一段", "第二段", "", done_reason="length")),
+        chunks.append)
+    assert chunks == ["第一段", "第二段"]
+    assert response["message"]["content"] == "第一段第二段"
+    assert response["done_reason"] == "length"
+
+
+def test_empty_stream_raises_clear_error():
+    with pytest.raises(RuntimeError, match="未收到任何回應"):
+        pipeline_metrics.timed_chat_stream('report', lambda stage, **kwargs: iter(()), print)
+
+    async def empty(stage, **kwargs):
+        return
+        yield
+
+    with pytest.raises(RuntimeError, match="未收到任何回應"):
+        asyncio.run(pipeline_metrics.timed_chat_stream_async('report', empty, print))
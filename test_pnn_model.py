@@ -0,0 +1,55 @@
+# test_pnn_model.py (PNN 向量化分類與逐筆版本的一致性)
+
+import numpy as np
+import pytest
+
+import pnn_model
+
+
+def _reference_classify(feature_dict, eye_toggle=1.0, nose_toggle=1.0, clothes_toggle=1.0):
+    """向量化之前的逐筆寫法 (逐犬種、逐特徵累加)，作為 classify_breeds 的對照"""
+    toggles = {"BlueEyesForbidden": eye_toggle, "BlackNoseRequired": nose_toggle,
+               "BodyWeight_norm": clothes_toggle}
+    distances = {}
+    for breed, ideal in pnn_model.IDEAL_VECTORS.items():
+        weighted_distance_sq = 0.0
+        for k in sorted(feature_dict):
+            weight = pnn_model.IDEAL_VECTORS_WEIGHTS[breed][k] * toggles.get(k, 1.0)
+            weighted_distance_sq += ((feature_dict[k] - ideal[k]) ** 2) * weight
+        distance = np.sqrt(weighted_distance_sq)
+        if breed in pnn_model.REGULATED_BREEDS:
+            distance *= pnn_model.REGULATED_PENALTY_MULTIPLIER
+        distances[breed] = distance
+    best = min(distances, key=distances.get)
+    if distances[best] > pnn_model.DISTANCE_THRESHOLD:
+        best = "其他犬種"
+    status = "管制犬種" if best in pnn_model.REGULATED_BREEDS else "非管制犬種"
+    return best, status, distances
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_classify_breeds_matches_per_record(seed):
+    rng = np.random.default_rng(seed)
+    # 超出 0~1 的值讓部分樣本超過否決閾值
+    matrix = rng.uniform(-1.0, 2.0, size=(50, len(pnn_model.FEATURE_ORDER)))
+    toggles = dict(zip(("eye_toggle", "nose_toggle", "clothes_toggle"), rng.uniform(0.0, 2.0, size=3)))
+
+    result = pnn_model.classify_breeds(matrix, **toggles)
+
+    for row, features in enumerate(matrix):
+        feature_dict = dict(zip(pnn_model.FEATURE_ORDER, features))
+        breed, status, distances = _reference_classify(feature_dict, **toggles)
+        assert result["breed"][row] == breed
+        assert result["status"][row] == status
+        assert list(result["distances"][row]) == [distances[b] for b in pnn_model.BREED_NAMES]
+
+        single = pnn_model.classify_breed(feature_dict, **toggles)
+        assert (single["breed"], single["status"]) == (breed, status)
+        assert single["distances"] == {b: float(d) for b, d in distances.items()}
+
+
+def test_classify_breeds_vetoes_distant_features():
+    matrix = np.full((1, len(pnn_model.FEATURE_ORDER)), 100.0)
+    result = pnn_model.classify_breeds(matrix)
+    assert result["vetoed"][0]
+    assert result["breed"][0] == "其他犬種"
@@ -0,0 +1,54 @@
+# test_pnn_tuning.py (離線調參的廣播評估與線上分類一致)
+
+import json
+
+import numpy as np
+import pytest
+
+import pnn_model
+import pnn_tuning
+
+
+# CHUNK_ELEMENTS=1 讓每次只評估一組變體，驗證分塊結果與一次算完相同
+@pytest.mark.parametrize("chunk_elements", [pnn_tuning.CHUNK_ELEMENTS, 1])
+def test_evaluate_grid_matches_classify_breeds(monkeypatch, chunk_elements):
+    monkeypatch.setattr(pnn_tuning, "CHUNK_ELEMENTS", chunk_elements)
+    features, labels = pnn_tuning.make_synthetic_samples(300, seed=1)
+    ideals, weights = pnn_tuning.sample_variants(3, seed=2)
+    penalties = np.array([1.0, 1.1])
+    thresholds = np.array([0.35, 0.8, 1.3, 2.0])
+
+    accuracy = pnn_tuning.evaluate_grid(features, labels, ideals, weights, penalties, thresholds)
+
+    assert accuracy.shape == (3, 2, 4)
+    for v in range(len(ideals)):
+        for p, penalty in enumerate(penalties):
+            for t, threshold in enumerate(thresholds):
+                _, expected = pnn_tuning.confusion_matrix(features, labels, ideals[v], weights[v],
+                                                          penalty, threshold)
+                assert accuracy[v, p, t] == expected
+
+
+def test_confusion_matrix_restores_model_parameters():
+    features, labels = pnn_tuning.make_synthetic_samples(20, seed=3)
+    before = pnn_model.IDEAL_MATRIX.copy(), pnn_model.DISTANCE_THRESHOLD
+    pnn_tuning.confusion_matrix(features, labels, pnn_model.IDEAL_MATRIX * 0.5, pnn_model.WEIGHT_MATRIX, 1.5, 0.1)
+    assert np.array_equal(pnn_model.IDEAL_MATRIX, before[0])
+    assert pnn_model.DISTANCE_THRESHOLD == before[1]
+
+
+def test_load_samples_accepts_label_aliases(tmp_path):
+    feature_values = {key: 0.5 for key in pnn_model.FEATURE_ORDER}
+    path = tmp_path / "samples.jsonl"
+    path.write_text("\n".join(json.dumps(record, ensure_ascii=False) for record in [
+        {"label": "APBT", "features": feature_values},
+        {"label": "other", **feature_values},
+        {"label": "美國惡霸犬", "features": feature_values},
+        {"label": "golden retriever", "features": feature_values},
+        {"label": "SBT", "features": {"MuzzleHeadRatio": 0.4}},
+    ]), encoding="utf-8")
+
+    features, labels = pnn_tuning.load_samples(str(path))
+    assert features.shape == (3, len(pnn_model.FEATURE_ORDER))
+    assert [pnn_model.BREED_LABELS[i] for i in labels] == [
+        "美國比特鬥牛犬 (APBT)", "其他犬種", "美國惡霸犬 (American Bully)"]
@@ -0,0 +1,73 @@
+# test_run_manifest.py (增量執行與中斷續跑的處理紀錄)
+
+import json
+import os
+
+import run_manifest
+
+FINGERPRINT = {"model": "m", "preprocess": "p", "prompt_version": "v1", "pnn_hash": "h"}
+
+
+def _setup(tmp_path):
+    image = tmp_path / "dog.jpg"
+    image.write_bytes(b"image-bytes")
+    report = tmp_path / "dog_report.html"
+    report.write_text("<html></html>", encoding="utf-8")
+    return str(image), str(report), str(tmp_path / "manifest.jsonl")
+
+
+def test_completed_image_is_skipped_after_restart(tmp_path):
+    image, report, path = _setup(tmp_path)
+    manifest = run_manifest.RunManifest(path, fingerprint=FINGERPRINT)
+    assert not manifest.is_done(image)
+    manifest.record(image, report, sha256=run_manifest.file_sha256(image), result={"breed": "其他犬種"})
+
+    resumed = run_manifest.RunManifest(path, fingerprint=FINGERPRINT)
+    assert resumed.is_done(image)
+    assert resumed.entries[image]["result"] == {"breed": "其他犬種"}
+
+
+def test_changed_settings_or_missing_report_reprocess(tmp_path):
+    image, report, path = _setup(tmp_path)
+    run_manifest.RunManifest(path, fingerprint=FINGERPRINT).record(image, report)
+
+    assert not run_manifest.RunManifest(path, fingerprint=dict(FINGERPRINT, prompt_version="v2")).is_done(image)
+    assert not run_manifest.RunManifest(path, fingerprint=dict(FINGERPRINT, html_layout="compact")).is_done(image)
+    os.remove(report)
+    assert not run_manifest.RunManifest(path, fingerprint=FINGERPRINT).is_done(image)
+
+
+def test_touched_file_is_checked_by_content(tmp_path):
+    image, report, path = _setup(tmp_path)
+    run_manifest.RunManifest(path, fingerprint=FINGERPRINT).record(image, report)
+
+    stat = os.stat(image)
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert run_manifest.RunManifest(path, fingerprint=FINGERPRINT).is_done(image)
+
+    with open(image, "wb") as f:
+        f.write(b"edited-bytes")
+    assert not run_manifest.RunManifest(path, fingerprint=FINGERPRINT).is_done(image)
+
+
+def test_interrupted_last_line_is_ignored_and_compact_keeps_latest(tmp_path):
+    image, report, path = _setup(tmp_path)
+    manifest = run_manifest.RunManifest(path, fingerprint=FINGERPRINT)
+    manifest.record(image, report, result={"breed": "a"})
+    manifest.record(image, report, result={"breed": "b"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"image": "half-writ')
+
+    resumed = run_manifest.RunManifest(path, fingerprint=FINGERPRINT)
+    assert resumed.entries[image]["result"] == {"breed": "b"}
+    resumed.compact()
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert [entry["result"] for entry in lines] == [{"breed": "b"}]
+
+
+def test_fingerprint_includes_caller_options():
+    fingerprint = run_manifest.current_fingerprint(flow="combined", html_layout="compact")
+    assert fingerprint["flow"] == "combined"
+    assert fingerprint["html_layout"] == "compact"
+    assert {"model", "preprocess", "prompt_version", "pnn_hash"} <= set(fingerprint)
@@ -0,0 +1,77 @@
+# test_vlm_cache.py (SQLite 快取的鍵、模式與 LRU 淘汰)
+
+import pytest
+
+import vlm_cache
+
+
+class FakeClock:
+    """取代 vlm_cache.time，讓 last_access 的先後順序可預期"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1.0
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(vlm_cache, "time", fake)
+    return fake
+
+
+def _cache(tmp_path, **kwargs):
+    return vlm_cache.VLMCache(path=str(tmp_path / "cache.sqlite3"), table="features", **kwargs)
+
+
+def test_keys_depend_on_image_model_and_prompt():
+    key = vlm_cache.VLMCache.make_key(b"image", "gemma3:4b", "prompt")
+    assert key == vlm_cache.VLMCache.make_key_from_digest(vlm_cache.sha256_hex(b"image"), "gemma3:4b", "prompt")
+    assert key != vlm_cache.VLMCache.make_key(b"other", "gemma3:4b", "prompt")
+    assert key != vlm_cache.VLMCache.make_key(b"image", "gemma3:12b", "prompt")
+    assert key != vlm_cache.VLMCache.make_key(b"image", "gemma3:4b", "prompt v2")
+
+
+def test_round_trip_and_persistence(tmp_path):
+    cache = _cache(tmp_path)
+    key = cache.make_key(b"image", "m", "p")
+    assert cache.get(key) is None
+    cache.put(key, {"MuzzleHeadRatio": 0.4, "初步意見": "其他犬種"})
+    cache.close()
+
+    reopened = _cache(tmp_path)
+    assert reopened.get(key) == {"MuzzleHeadRatio": 0.4, "初步意見": "其他犬種"}
+    assert reopened.stats()["hits"] == 1
+
+
+def test_lru_evicts_least_recently_used(tmp_path, clock):
+    cache = _cache(tmp_path, max_entries=2)
+    a, b, c = (cache.make_key(name.encode(), "m", "p") for name in "abc")
+    cache.put(a, 1)
+    cache.put(b, 2)
+    assert cache.get(a) == 1  # a 變成最近使用，b 成為最久未使用
+    cache.put(c, 3)
+
+    assert cache.evictions == 1
+    assert cache.get(b) is None
+    assert (cache.get(a), cache.get(c)) == (1, 3)
+
+
+def test_off_and_refresh_modes(tmp_path):
+    key = vlm_cache.VLMCache.make_key(b"image", "m", "p")
+    _cache(tmp_path).put(key, 1)
+
+    off = _cache(tmp_path, mode="off")
+    off.put(key, 2)
+    assert off.get(key) is None
+
+    refresh = _cache(tmp_path, mode="refresh")
+    assert refresh.get(key) is None
+    refresh.put(key, 3)
+    assert _cache(tmp_path).get(key) == 3
+
+    with pytest.raises(ValueError):
+        _cache(tmp_path, mode="bogus")
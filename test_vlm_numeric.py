@@ -0,0 +1,103 @@
+# test_vlm_numeric.py (VLM 回傳的容錯解析與缺欄位補問，不需 Ollama)
+
+import collections
+import json
+
+import image_asset
+import vlm_numeric
+
+
+def _features(value=0.5):
+    return {key: value for key in vlm_numeric.FEATURE_KEYS}
+
+
+def test_salvage_valid_json_is_not_repaired():
+    data, missing, repaired = vlm_numeric.salvage(json.dumps(_features()), vlm_numeric.FEATURE_SCHEMA)
+    assert data == _features()
+    assert missing == []
+    assert not repaired
+
+
+def test_salvage_repairs_common_mistakes():
+    body = ", ".join(f"'{key.lower()}': 0.5" for key in vlm_numeric.FEATURE_KEYS)
+    content = "以下是結果：\n```json\n{" + body + ", 'Extra': 1, }\n```"
+    data, missing, repaired = vlm_numeric.salvage(content, vlm_numeric.FEATURE_SCHEMA)
+    assert data == _features()
+    assert missing == []
+    assert repaired
+
+
+def test_salvage_clamps_and_reports_missing_keys():
+    features = _features()
+    features["ShoulderHeight_norm"] = 1.7
+    del features["HeadBreadthIndex"]
+    data, missing, repaired = vlm_numeric.salvage(json.dumps(features), vlm_numeric.FEATURE_SCHEMA)
+    assert data["ShoulderHeight_norm"] == 1.0
+    assert missing == ["HeadBreadthIndex"]
+    assert repaired
+
+
+def test_salvage_falls_back_to_key_value_text():
+    content = "ShoulderHeight_norm: 0.7\nBodyWeight_norm = 0.25\n其餘無法判斷"
+    data, missing, repaired = vlm_numeric.salvage(content, vlm_numeric.FEATURE_SCHEMA)
+    assert data == {"ShoulderHeight_norm": 0.7, "BodyWeight_norm": 0.25}
+    assert set(missing) == set(vlm_numeric.FEATURE_KEYS) - set(data)
+    assert repaired
+
+
+def test_loads_lenient():
+    assert vlm_numeric._loads_lenient("結果 {a: 1, 'b': True, c: None,} 完") == {"a": 1, "b": True, "c": None}
+    assert vlm_numeric._loads_lenient("沒有 JSON") is None
+
+
+def _image(tmp_path):
+    from PIL import Image
+
+    path = tmp_path / "dog.png"
+    Image.new("RGB", (32, 32), (120, 90, 60)).save(path)
+    return str(path)
+
+
+# 第一次回覆缺少 HeadBreadthIndex
+FIRST_REPLY = json.dumps({key: 0.5 for key in vlm_numeric.FEATURE_KEYS if key != "HeadBreadthIndex"})
+
+
+def _run_extraction(tmp_path, monkeypatch, followup_keys):
+    """以假的 timed_chat 執行一次萃取：第一次回覆 FIRST_REPLY，補問時回覆 followup_keys"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(vlm_numeric.vlm_cache.feature_cache, "mode", "off")
+    monkeypatch.setattr(vlm_numeric, "PARSE_STATS", collections.Counter())
+    calls = []
+
+    def fake_timed_chat(stage, chat, policy=None, **request):
+        calls.append((policy, request))
+        content = FIRST_REPLY if policy is None else json.dumps({key: 0.25 for key in followup_keys})
+        return {"message": {"content": content}}
+
+    monkeypatch.setattr(vlm_numeric.pipeline_metrics, "timed_chat", fake_timed_chat)
+    asset = image_asset.ImageAsset(_image(tmp_path))
+    result = vlm_numeric._extract_with(asset, vlm_numeric.FEATURE_PROMPT, vlm_numeric.FEATURE_SCHEMA,
+                                       'features', "特徵萃取", "test-model")
+    return result, calls
+
+
+def test_followup_resends_the_image_turn_for_missing_keys(tmp_path, monkeypatch):
+    result, calls = _run_extraction(tmp_path, monkeypatch, ["HeadBreadthIndex"])
+    assert result["HeadBreadthIndex"] == 0.25
+    assert vlm_numeric.PARSE_STATS["retried"] == 1
+
+    (first_policy, first), (policy, followup) = calls
+    assert first_policy is None and policy == 'followup'
+    # 多輪對話：開頭與第一次呼叫相同 (含圖片)，接著是模型先前的回覆與只要求缺少欄位的追問
+    assert followup["messages"][0] == first["messages"][0]
+    assert followup["messages"][0]["images"]
+    assert followup["messages"][1] == {"role": "assistant", "content": FIRST_REPLY}
+    assert "HeadBreadthIndex" in followup["messages"][2]["content"]
+    assert followup["format"]["required"] == ["HeadBreadthIndex"]
+
+
+def test_followup_that_still_misses_keys_is_wasted(tmp_path, monkeypatch):
+    result, calls = _run_extraction(tmp_path, monkeypatch, [])
+    assert result is None
+    assert len(calls) == 2
+    assert vlm_numeric.PARSE_STATS["wasted"] == 1
@@ -0,0 +1,68 @@
+# test_watch_folder.py (增量掃描與失敗重試)
+
+import os
+import time
+
+import pytest
+
+import watch_folder
+
+
+def _write(path, content, age_s=10.0):
+    """寫入檔案並把 mtime 調到 age_s 秒前 (已超過靜置時間)"""
+    path.write_bytes(content)
+    stamp = time.time() - age_s
+    os.utime(path, (stamp, stamp))
+    return str(path)
+
+
+@pytest.fixture
+def scanner(tmp_path):
+    scanner = watch_folder.FolderScanner(str(tmp_path), (".jpg",), use_inotify=False, max_attempts=3)
+    yield scanner
+    scanner.close()
+
+
+def _paths(found):
+    return [path for path, _ in found]
+
+
+def test_new_and_changed_files_are_reported_once(tmp_path, scanner):
+    a = _write(tmp_path / "a.jpg", b"a")
+    (tmp_path / "notes.txt").write_text("x")
+    assert _paths(scanner.scan(force=True)) == [a]
+    assert scanner.scan() == []
+
+    (tmp_path / "sub").mkdir()
+    b = _write(tmp_path / "sub" / "b.jpg", b"b")
+    assert _paths(scanner.scan()) == [b]
+
+
+def test_files_still_being_written_wait_until_settled(tmp_path, scanner):
+    path = _write(tmp_path / "a.jpg", b"partial", age_s=0.0)
+    assert scanner.scan(force=True) == []
+    _write(tmp_path / "a.jpg", b"complete")
+    assert _paths(scanner.scan()) == [path]
+
+
+def test_failed_image_is_retried_a_bounded_number_of_times(tmp_path, scanner):
+    path = _write(tmp_path / "a.jpg", b"a")
+    assert _paths(scanner.scan(force=True)) == [path]
+
+    # 第 1、2 次失敗後重試；第 3 次失敗即放棄
+    assert scanner.forget(path)
+    assert _paths(scanner.scan()) == [path]
+    assert scanner.forget(path)
+    assert _paths(scanner.scan()) == [path]
+    assert not scanner.forget(path)
+    assert scanner.scan() == []
+    assert scanner.scan(force=True) == []
+
+    # 檔案再次變更後重新計算嘗試次數
+    _write(tmp_path / "a.jpg", b"fixed", age_s=5.0)
+    assert _paths(scanner.scan(force=True)) == [path]
+    assert scanner.forget(path)
+
+
+def test_forget_unknown_path_is_ignored(scanner):
+    assert not scanner.forget("never-seen.jpg")
@@ -0,0 +1,166 @@
+# vlm_cache.py (以內容定址的 VLM 結果快取：SQLite + LRU)
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_PATH = os.path.join('out', 'vlm_cache.sqlite3')
+CACHE_MAX_ENTRIES = 20000  # 超過即依最久未使用 (LRU) 淘汰
+
+# 快取模式 (失效開關)：
+#   "on"      正常讀寫
+#   "off"     完全不使用快取
+#   "refresh" 忽略舊資料、重新呼叫 VLM 並覆寫
+CACHE_MODES = ("on", "off", "refresh")
+CACHE_MODE = os.environ.get("VLM_CACHE", "on")
+
+
+def sha256_hex(data):
+    """回傳 bytes 或字串的 SHA-256 十六進位摘要"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class VLMCache:
+    """
+    以 (圖片 SHA-256, 模型名稱, 提示詞 SHA-256) 為鍵的持久化快取。
+    值以 JSON 儲存；讀取時更新 last_access 以實作 LRU 淘汰。
+    """
+
+    def __init__(self, path=CACHE_PATH, table="features",
+                 max_entries=CACHE_MAX_ENTRIES, mode=CACHE_MODE):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"未知的快取模式: {mode} (可用: {', '.join(CACHE_MODES)})")
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                    image_sha256 TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_sha256 TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (image_sha256, model, prompt_sha256)
+                )"""
+            )
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_lru ON {self.table} (last_access)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(image_bytes, model, prompt):
+        """由圖片內容、模型與提示詞組出快取鍵"""
+        return (sha256_hex(image_bytes), model, sha256_hex(prompt))
+
+    @staticmethod
+    def make_key_from_digest(image_sha256, model, prompt):
+        """與 make_key 相同，但使用已算好的圖片 SHA-256 (例如 ImageAsset.sha256)"""
+        return (image_sha256, model, sha256_hex(prompt))
+
+    def get(self, key):
+        """命中時回傳先前儲存的值，否則回傳 None"""
+        if self.mode != "on":
+            if self.mode == "refresh":
+                self.misses += 1
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                f"SELECT value FROM {self.table} "
+                "WHERE image_sha256 = ? AND model = ? AND prompt_sha256 = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute(
+                f"UPDATE {self.table} SET last_access = ? "
+                "WHERE image_sha256 = ? AND model = ? AND prompt_sha256 = ?",
+                (time.time(), *key),
+            )
+            conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        """寫入一筆結果，並在超過上限時淘汰最久未使用的項目"""
+        if self.mode == "off":
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} "
+                "(image_sha256, model, prompt_sha256, value, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            count = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE rowid IN ("
+                    f"SELECT rowid FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self.evictions += overflow
+            conn.commit()
+
+    def clear(self):
+        """清空此快取表 (例如更換提示詞或模型權重後的手動失效)"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# 共用的快取實例 (同一個 SQLite 檔中的不同資料表)：特徵萃取、初步意見、報告原文
+feature_cache = VLMCache(table="features")
+judgment_cache = VLMCache(table="judgments")
+report_cache = VLMCache(table="reports")
+SHARED_CACHES = {"特徵": feature_cache, "初步意見": judgment_cache, "報告": report_cache}
+
+
+def set_mode(mode):
+    """切換所有共用快取的模式 ("on" / "off" / "refresh")"""
+    if mode not in CACHE_MODES:
+        raise ValueError(f"未知的快取模式: {mode} (可用: {', '.join(CACHE_MODES)})")
+    for cache in SHARED_CACHES.values():
+        cache.mode = mode
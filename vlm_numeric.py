@@ -1,41 +1,143 @@
 # vlm_numeric.py
 
-import ollama
-import base64
+import asyncio
+import collections
 import json
 import os
+import re
 
-def image_to_base64(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+import image_asset
+import image_preprocess
+import model_routing
+import ollama_pool
+import pipeline_metrics
+import vlm_cache
 
-def get_features_from_vlm(image_path):
-    """
-    使用 VLM 從圖片中提取更詳細、具區分性的犬隻特徵數值。
-    """
-    if not os.path.exists(image_path):
-        print(f"錯誤：圖片路徑不存在 {image_path}")
-        return None
+FEATURE_KEYS = [
+    "ShoulderHeight_norm", "BodyWeight_norm", "MuzzleHeadRatio", "BlackNoseRequired",
+    "BlueEyesForbidden", "ChestWidthDepth", "BodySquareness", "HeadBreadthIndex",
+]
+
+# 初步意見的可選分類 (與 gemma_report.JUDGMENT_PROMPT 一致)
+BREED_LABELS = [
+    "美國比特鬥牛犬 (APBT)",
+    "美國史大佛夏牛頭犬 (AmStaff)",
+    "史大佛夏牛頭犬 (SBT)",
+    "美國惡霸犬 (American Bully)",
+    "其他犬種",
+]
+
+# 中文版提示（特徵名稱維持英文）
+FEATURE_PROMPT = """
+    你是一位專業的犬隻品種鑑定員。請分析圖片中的狗，針對以下每一個特徵給予 0.0 到 1.0 的分數：
+    0.0 代表「完全不符合」，1.0 代表「完全符合」。
+    請只回傳嚴格的 JSON 格式，不要包含其他文字或說明。
+
+    特徵說明如下：
+    1) ShoulderHeight_norm：目視推估肩高的相對值，正規化到 0~1（越高越接近 1，越矮越接近 0，如 Bully通常為 0.3~0.4）。
+    2) BodyWeight_norm：目視推估體重或肌肉量的相對值，正規化到 0~1（越壯或重越接近 1）。
+    3) MuzzleHeadRatio：吻長 ÷ 頭長。長吻（如 APBT）≈ 高分；短吻或立方（如 Bully）≈ 低分。
+    4) BlackNoseRequired：鼻子是否明顯為黑色。黑色=1，其他顏色=0，不確定=0.5。
+    5) BlueEyesForbidden：眼睛是否非藍色。若明顯不是藍色=1，藍眼=0，不確定=0.5。
+    6) ChestWidthDepth：胸寬 ÷ 胸深。胸寬小於胸深（如 APBT）≈ 低分，胸寬與胸深相近或較寬≈ 高分。
+    7) BodySquareness：身體比例是否接近方形。肩高≈身長=1，身長略大於肩高≈0.4，明顯長身或低矮≈更低。
+    8) HeadBreadthIndex：頭部寬度與方正度。顱骨寬闊、立方感重（如 Bully）≈ 高分；楔形或較窄（如 APBT）≈ 低分。
+
+    請嚴格依下列 JSON 格式回傳：
+    {
+      "ShoulderHeight_norm": 0.0,
+      "BodyWeight_norm": 0.0,
+      "MuzzleHeadRatio": 0.0,
+      "BlackNoseRequired": 0.0,
+      "BlueEyesForbidden": 0.0,
+      "ChestWidthDepth": 0.0,
+      "BodySquareness": 0.0,
+      "HeadBreadthIndex": 0.0
+    }
+"""
+
+# 合併模式：一次呼叫同時取得 8 項特徵分數與初步品種意見，省去一次圖片 prompt-eval
+COMBINED_PROMPT = """
+    你是一位頂尖的犬隻品種鑑定專家。請分析圖片中的狗，完成以下兩項工作，並只回傳嚴格的 JSON 格式。
+
+    [工作一：特徵分數]
+    針對以下每一個特徵給予 0.0 到 1.0 的分數：0.0 代表「完全不符合」，1.0 代表「完全符合」。
+    1) ShoulderHeight_norm：目視推估肩高的相對值，正規化到 0~1（越高越接近 1，越矮越接近 0，如 Bully通常為 0.3~0.4）。
+    2) BodyWeight_norm：目視推估體重或肌肉量的相對值，正規化到 0~1（越壯或重越接近 1）。
+    3) MuzzleHeadRatio：吻長 ÷ 頭長。長吻（如 APBT）≈ 高分；短吻或立方（如 Bully）≈ 低分。
+    4) BlackNoseRequired：鼻子是否明顯為黑色。黑色=1，其他顏色=0，不確定=0.5。
+    5) BlueEyesForbidden：眼睛是否非藍色。若明顯不是藍色=1，藍眼=0，不確定=0.5。
+    6) ChestWidthDepth：胸寬 ÷ 胸深。胸寬小於胸深（如 APBT）≈ 低分，胸寬與胸深相近或較寬≈ 高分。
+    7) BodySquareness：身體比例是否接近方形。肩高≈身長=1，身長略大於肩高≈0.4，明顯長身或低矮≈更低。
+    8) HeadBreadthIndex：頭部寬度與方正度。顱骨寬闊、立方感重（如 Bully）≈ 高分；楔形或較窄（如 APBT）≈ 低分。
+
+    [工作二：初步意見]
+    憑你的第一直覺，於 PreliminaryJudgment 欄位填入這隻狗最接近的「一個」分類：
+    - 美國比特鬥牛犬 (APBT)
+    - 美國史大佛夏牛頭犬 (AmStaff)
+    - 史大佛夏牛頭犬 (SBT)
+    - 美國惡霸犬 (American Bully)
+    - 其他犬種
+    如果圖片中的犬隻明顯是 拳師犬(Boxer), 法國鬥牛犬(French Bulldog), 
+    英國鬥牛犬(Bulldog), 阿根廷杜告犬 (Dogo Argentino), 土佐犬 (Tosa), 
+    紐波利頓犬(Neapolitan Mastiff), 波士頓㹴(Boston Terrier),
+    黃金獵犬(Golden Retriever), 或任何其他非上列目標犬種的狗，請一律填入「其他犬種」。
 
-    b64_image = image_to_base64(image_path)
-
-    # 中文版提示（特徵名稱維持英文）
-    prompt = """
-        你是一位專業的犬隻品種鑑定員。請分析圖片中的狗，針對以下每一個特徵給予 0.0 到 1.0 的分數：
-        0.0 代表「完全不符合」，1.0 代表「完全符合」。
-        請只回傳嚴格的 JSON 格式，不要包含其他文字或說明。
-
-        特徵說明如下：
-        1) ShoulderHeight_norm：目視推估肩高的相對值，正規化到 0~1（越高越接近 1，越矮越接近 0，如 Bully通常為 0.3~0.4）。
-        2) BodyWeight_norm：目視推估體重或肌肉量的相對值，正規化到 0~1（越壯或重越接近 1）。
-        3) MuzzleHeadRatio：吻長 ÷ 頭長。長吻（如 APBT）≈ 高分；短吻或立方（如 Bully）≈ 低分。
-        4) BlackNoseRequired：鼻子是否明顯為黑色。黑色=1，其他顏色=0，不確定=0.5。
-        5) BlueEyesForbidden：眼睛是否非藍色。若明顯不是藍色=1，藍眼=0，不確定=0.5。
-        6) ChestWidthDepth：胸寬 ÷ 胸深。胸寬小於胸深（如 APBT）≈ 低分，胸寬與胸深相近或較寬≈ 高分。
-        7) BodySquareness：身體比例是否接近方形。肩高≈身長=1，身長略大於肩高≈0.4，明顯長身或低矮≈更低。
-        8) HeadBreadthIndex：頭部寬度與方正度。顱骨寬闊、立方感重（如 Bully）≈ 高分；楔形或較窄（如 APBT）≈ 低分。
-
-        請嚴格依下列 JSON 格式回傳：
+    請嚴格依下列 JSON 格式回傳：
+    {
+      "ShoulderHeight_norm": 0.0,
+      "BodyWeight_norm": 0.0,
+      "MuzzleHeadRatio": 0.0,
+      "BlackNoseRequired": 0.0,
+      "BlueEyesForbidden": 0.0,
+      "ChestWidthDepth": 0.0,
+      "BodySquareness": 0.0,
+      "HeadBreadthIndex": 0.0,
+      "PreliminaryJudgment": "其他犬種"
+    }
+"""
+
+# 傳給 ollama.chat(format=...) 的 JSON Schema，讓模型只能輸出合法欄位與範圍
+FEATURE_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "number", "minimum": 0.0, "maximum": 1.0} for key in FEATURE_KEYS},
+    "required": FEATURE_KEYS,
+    "additionalProperties": False,
+}
+
+COMBINED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **FEATURE_SCHEMA["properties"],
+        "PreliminaryJudgment": {"type": "string", "enum": BREED_LABELS},
+    },
+    "required": FEATURE_KEYS + ["PreliminaryJudgment"],
+    "additionalProperties": False,
+}
+
+# 批次萃取：一次請求送出 K 張圖片，提示詞只評估一次，回傳 K 組特徵 (1 代表逐張呼叫)
+FEATURE_BATCH_SIZE = max(1, int(os.environ.get('VLM_FEATURE_BATCH', '1')))
+
+# {count} 於送出前替換為本批圖片數
+BATCH_FEATURE_PROMPT = """
+    你是一位專業的犬隻品種鑑定員。以下依序附上 {count} 張圖片（第 1 張到第 {count} 張），每張圖片各有一隻狗。
+    請「分別」分析每一張圖片中的狗，針對以下每一個特徵給予 0.0 到 1.0 的分數：
+    0.0 代表「完全不符合」，1.0 代表「完全符合」。各張圖片獨立評分，不要互相比較或沿用分數。
+    請只回傳嚴格的 JSON 格式，不要包含其他文字或說明。
+
+    特徵說明如下：
+    1) ShoulderHeight_norm：目視推估肩高的相對值，正規化到 0~1（越高越接近 1，越矮越接近 0，如 Bully通常為 0.3~0.4）。
+    2) BodyWeight_norm：目視推估體重或肌肉量的相對值，正規化到 0~1（越壯或重越接近 1）。
+    3) MuzzleHeadRatio：吻長 ÷ 頭長。長吻（如 APBT）≈ 高分；短吻或立方（如 Bully）≈ 低分。
+    4) BlackNoseRequired：鼻子是否明顯為黑色。黑色=1，其他顏色=0，不確定=0.5。
+    5) BlueEyesForbidden：眼睛是否非藍色。若明顯不是藍色=1，藍眼=0，不確定=0.5。
+    6) ChestWidthDepth：胸寬 ÷ 胸深。胸寬小於胸深（如 APBT）≈ 低分，胸寬與胸深相近或較寬≈ 高分。
+    7) BodySquareness：身體比例是否接近方形。肩高≈身長=1，身長略大於肩高≈0.4，明顯長身或低矮≈更低。
+    8) HeadBreadthIndex：頭部寬度與方正度。顱骨寬闊、立方感重（如 Bully）≈ 高分；楔形或較窄（如 APBT）≈ 低分。
+
+    請嚴格依下列 JSON 格式回傳，images 陣列依圖片順序恰好包含 {count} 個物件：
+    {
+      "images": [
         {
           "ShoulderHeight_norm": 0.0,
           "BodyWeight_norm": 0.0,
@@ -46,29 +148,474 @@ def get_features_from_vlm(image_path):
           "BodySquareness": 0.0,
           "HeadBreadthIndex": 0.0
         }
+      ]
+    }
+"""
+
+def batch_feature_prompt(count):
+    return BATCH_FEATURE_PROMPT.replace("{count}", str(count))
+
+def batch_feature_schema(count):
+    """K 張圖片的回傳格式：{"images": [K 個 FEATURE_SCHEMA 物件]}"""
+    return {
+        "type": "object",
+        "properties": {
+            "images": {"type": "array", "items": FEATURE_SCHEMA, "minItems": count, "maxItems": count},
+        },
+        "required": ["images"],
+        "additionalProperties": False,
+    }
+
+def set_feature_batch(size):
+    global FEATURE_BATCH_SIZE
+    FEATURE_BATCH_SIZE = max(1, int(size))
+
+# 批次萃取統計：batches 批次呼叫數、images 批次涵蓋的圖片數、
+# malformed 陣列格式錯誤或長度不符而整批改為逐張的次數、fallback_images 改為逐張萃取的圖片數
+BATCH_STATS = collections.Counter()
+
+# 解析結果統計：clean 直接成功、repaired 經修補成功、retried 補問後成功、wasted 整次呼叫作廢
+PARSE_STATS = collections.Counter()
+
+def image_to_base64(image_path):
+    return image_asset.as_asset(image_path).b64
+
+def _prepare_feature_request(image_path, prompt=FEATURE_PROMPT, model=None):
     """
+    查詢快取，回傳 (ImageAsset, 快取鍵, 快取結果)。
+    image_path 可為路徑字串或 ImageAsset；未命中時呼叫端再取用 asset.model_b64。
+    model 預設為特徵萃取階段的模型。
+    """
+    asset = image_asset.as_asset(image_path)
+    # 縮圖設定會改變模型看到的圖片，因此併入快取鍵
+    model_key = f"{model or model_routing.model_for('features')}|{image_preprocess.signature()}"
+    cache_key = vlm_cache.VLMCache.make_key_from_digest(asset.sha256, model_key, prompt)
+    return asset, cache_key, vlm_cache.feature_cache.get(cache_key)
+
+def _feature_messages(b64_image, prompt=FEATURE_PROMPT):
+    return [
+        {
+            'role': 'user',
+            'content': prompt,
+            'images': [b64_image]
+        }
+    ]
+
+def parse_features(response_content):
+    """將 VLM 回傳的文字解析為特徵字典 (嚴格版)"""
+    json_str = response_content.strip().replace('```json', '').replace('```', '')
+    return json.loads(json_str)
+
+# --- 容錯解析 ---
+def _normalize_key(key):
+    return re.sub(r'[^a-z]', '', str(key).lower())
+
+def _loads_lenient(text):
+    """盡量把接近 JSON 的文字轉成 dict：去除說明文字、尾逗號、單引號與 Python 常值"""
+    text = text.replace('```json', '').replace('```', '')
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        text = text[start:end + 1]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    repaired = re.sub(r',\s*([}\]])', r'\1', text)
+    repaired = repaired.replace("'", '"')
+    repaired = re.sub(r'\bTrue\b', 'true', re.sub(r'\bFalse\b', 'false', re.sub(r'\bNone\b', 'null', repaired)))
+    repaired = re.sub(r'([{,]\s*)([A-Za-z_][A-Za-z0-9_]*)\s*:', r'\1"\2":', repaired)
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError:
+        return None
+
+def _coerce(value, spec):
+    """依 schema 欄位定義轉型；數值夾到 minimum~maximum，字串對應到 enum"""
+    if spec.get("type") == "number":
+        number = float(value)
+        if number != number:  # NaN
+            raise ValueError("NaN")
+        return min(max(number, spec.get("minimum", number)), spec.get("maximum", number))
+    text = str(value).strip().replace("\"", "")
+    for option in spec.get("enum", []):
+        if option == text or _normalize_key(option) == _normalize_key(text):
+            return option
+    for option in spec.get("enum", []):
+        if option in text:
+            return option
+    if spec.get("enum"):
+        raise ValueError(f"不在可選值內: {text}")
+    return text
+
+def salvage(response_content, schema):
+    """
+    容錯解析 VLM 回傳：修補常見的格式錯誤、忽略多餘欄位、大小寫不符的欄位名稱也能對應。
+    回傳 (資料, 缺少的欄位, 是否經過修補)。
+    """
+    properties = schema["properties"]
+    canonical = {_normalize_key(key): key for key in properties}
+    data, repaired = {}, False
 
     try:
-        print(f"正在呼叫 VLM 分析圖片: {os.path.basename(image_path)}...")
-        response = ollama.chat(
-            model='gemma3:27b-it-qat',
-            messages=[
-                {
-                    'role': 'user',
-                    'content': prompt,
-                    'images': [b64_image]
-                }
-            ]
-        )
-        
+        parsed = json.loads(response_content.strip().replace('```json', '').replace('```', ''))
+    except json.JSONDecodeError:
+        parsed = _loads_lenient(response_content)
+        repaired = True
+
+    if isinstance(parsed, dict):
+        for raw_key, value in parsed.items():
+            key = canonical.get(_normalize_key(raw_key))
+            if key is None:
+                repaired = True
+                continue
+            try:
+                data[key] = _coerce(value, properties[key])
+            except (TypeError, ValueError):
+                repaired = True
+            if key in data and (raw_key != key or data[key] != value):
+                repaired = True
+    else:
+        # 完全無法解析時，以正規表達式逐一撈出 "欄位: 數值"
+        repaired = True
+        for key, spec in properties.items():
+            if spec.get("type") != "number":
+                continue
+            match = re.search(rf'{re.escape(key)}\W{{0,3}}\s*[:=]\s*(-?\d+(?:\.\d+)?)',
+                              response_content, flags=re.IGNORECASE)
+            if match:
+                data[key] = _coerce(match.group(1), spec)
+
+    # 字串欄位 (例如初步意見) 也可從原始文字中直接找選項
+    for key, spec in properties.items():
+        if key not in data and spec.get("enum"):
+            try:
+                data[key] = _coerce(response_content, spec)
+                repaired = True
+            except ValueError:
+                pass
+
+    missing = [key for key in schema.get("required", properties) if key not in data]
+    return data, missing, repaired
+
+def _subschema(schema, keys):
+    return {
+        "type": "object",
+        "properties": {key: schema["properties"][key] for key in keys},
+        "required": list(keys),
+        "additionalProperties": False,
+    }
+
+def _followup_messages(messages, response_content, missing):
+    """
+    只補問缺少欄位的多輪對話：沿用原本附圖片的提問與模型先前的回覆，再要求只回傳缺少的欄位。
+    缺欄位通常是模型根本沒輸出，因此必須讓它重新看圖片；開頭與第一次呼叫相同，
+    同一台主機可沿用已評估的 Prompt 前綴 (KV 快取)，實際只需評估先前回覆與一句追問。
+    """
+    return list(messages) + [
+        {'role': 'assistant', 'content': response_content},
+        {'role': 'user', 'content': f"你的回覆缺少或無法解析以下欄位：{', '.join(missing)}。"
+                                    f"請再看一次照片，只回傳這些欄位的 JSON，不要包含其他文字。"},
+    ]
+
+def _record_outcome(stage, outcome):
+    PARSE_STATS["calls"] += 1
+    PARSE_STATS[outcome] += 1
+    pipeline_metrics.annotate(stage, parse=outcome)
+
+def _merge_retry(data, retry_content, schema, missing):
+    extra, still_missing, _ = salvage(retry_content, _subschema(schema, missing))
+    data.update(extra)
+    return still_missing
+
+def _extraction_flow(asset, prompt, schema, stage, label, model, cache_key):
+    """
+    單張萃取的決策流程 (同步與非同步共用)：以 generator 逐步 yield (策略鍵, chat 參數)，
+    由呼叫端實際送出請求後把回應 send 回來 (呼叫失敗則 throw 回來)。
+    流程為 schema 約束呼叫 → 容錯解析 → 缺欄位時以多輪對話補問一次；結束時以 StopIteration 回傳資料或 None。
+    """
+    response_content = None
+    try:
+        print(f"正在呼叫 VLM {label} ({model}): {asset.filename}...")
+        messages = _feature_messages(asset.model_b64, prompt)
+        response = yield None, {'model': model, 'messages': messages, 'format': schema}
         response_content = response['message']['content']
-        json_str = response_content.strip().replace('```json', '').replace('```', '')
-        features = json.loads(json_str)
-        
-        print(f"VLM 分析完成。")
-        return features
+        data, missing, repaired = salvage(response_content, schema)
+
+        outcome = "repaired" if repaired else "clean"
+        if missing:
+            print(f"VLM 回傳缺少欄位 {missing} ({asset.filename})，只針對缺少的欄位補問一次...")
+            retry = yield 'followup', {'model': model,
+                                       'messages': _followup_messages(messages, response_content, missing),
+                                       'format': _subschema(schema, missing)}
+            missing = _merge_retry(data, retry['message']['content'], schema, missing)
+            outcome = "retried"
+        if missing:
+            raise ValueError(f"補問後仍缺少欄位: {missing}")
+
+        _record_outcome(stage, outcome)
+        vlm_cache.feature_cache.put(cache_key, data)
+        return data
 
     except Exception as e:
-        print(f"從 VLM 獲取特徵時發生錯誤: {e}")
-        print(f"VLM 原始回傳內容: {response_content if 'response_content' in locals() else 'N/A'}")
+        _record_outcome(stage, "wasted")
+        print(f"從 VLM {label}時發生錯誤: {e}")
+        print(f"VLM 原始回傳內容: {response_content if response_content is not None else 'N/A'}")
+        return None
+
+def _cached_features(asset, prompt, stage, label, model):
+    asset, cache_key, cached = _prepare_feature_request(asset, prompt, model)
+    if cached is not None:
+        print(f"快取命中，略過 VLM {label}: {asset.filename}")
+        pipeline_metrics.annotate(stage, cache_hit=True)
+    return asset, cache_key, cached
+
+def _extract(image_path, prompt, schema, stage, label):
+    """
+    單張圖片的萃取流程 (同步)：快取 → _extraction_flow。
+    階段模型失敗時，若有設定較大的升級模型則改用它重跑。
+    """
+    asset = image_asset.as_asset(image_path)
+    if not asset.exists():
+        print(f"錯誤：圖片路徑不存在 {image_path}")
+        return None
+
+    models = model_routing.models_for(stage)
+    for attempt, model in enumerate(models):
+        if attempt:
+            print(f"{models[attempt - 1]} 萃取失敗，改用 {model} 重跑: {asset.filename}")
+            model_routing.record_escalation(stage, "failed")
+        data = _extract_with(asset, prompt, schema, stage, label, model)
+        if data is not None:
+            return data
+    return None
+
+def _extract_with(asset, prompt, schema, stage, label, model):
+    asset, cache_key, cached = _cached_features(asset, prompt, stage, label, model)
+    if cached is not None:
+        return cached
+    flow = _extraction_flow(asset, prompt, schema, stage, label, model, cache_key)
+    try:
+        policy, request = next(flow)
+        while True:
+            try:
+                response = pipeline_metrics.timed_chat(stage, ollama_pool.chat, policy=policy, **request)
+            except Exception as e:
+                policy, request = flow.throw(e)
+            else:
+                policy, request = flow.send(response)
+    except StopIteration as done:
+        return done.value
+
+async def _extract_async(image_path, prompt, schema, stage, label, client):
+    """_extract 的非同步版本，使用傳入的 ollama.AsyncClient"""
+    asset = image_asset.as_asset(image_path)
+    if not asset.exists():
+        print(f"錯誤：圖片路徑不存在 {image_path}")
+        return None
+
+    models = model_routing.models_for(stage)
+    for attempt, model in enumerate(models):
+        if attempt:
+            print(f"{models[attempt - 1]} 萃取失敗，改用 {model} 重跑: {asset.filename}")
+            model_routing.record_escalation(stage, "failed")
+        data = await _extract_with_async(asset, prompt, schema, stage, label, model, client)
+        if data is not None:
+            return data
+    return None
+
+async def _extract_with_async(asset, prompt, schema, stage, label, model, client):
+    asset, cache_key, cached = _cached_features(asset, prompt, stage, label, model)
+    if cached is not None:
+        return cached
+    flow = _extraction_flow(asset, prompt, schema, stage, label, model, cache_key)
+    try:
+        policy, request = next(flow)
+        while True:
+            try:
+                response = await pipeline_metrics.timed_chat_async(stage, client.chat, policy=policy, **request)
+            except Exception as e:
+                policy, request = flow.throw(e)
+            else:
+                policy, request = flow.send(response)
+    except StopIteration as done:
+        return done.value
+
+def get_features_from_vlm(image_path):
+    """
+    使用 VLM 從圖片中提取更詳細、具區分性的犬隻特徵數值。
+    結果以 (圖片內容, 模型, 提示詞) 為鍵寫入 vlm_cache，重跑相同圖片時不再呼叫 VLM。
+    呼叫以 FEATURE_SCHEMA 約束輸出；格式稍有偏差時先容錯修補，缺欄位才補問。
+    image_path 可為路徑字串或 ImageAsset。
+    """
+    features = _extract(image_path, FEATURE_PROMPT, FEATURE_SCHEMA, 'features', "特徵萃取")
+    if features is not None:
+        print(f"VLM 分析完成。")
+    return features
+
+async def get_features_from_vlm_async(image_path, client):
+    """get_features_from_vlm 的非同步版本，使用傳入的 ollama.AsyncClient"""
+    return await _extract_async(image_path, FEATURE_PROMPT, FEATURE_SCHEMA, 'features', "特徵萃取", client)
+
+# --- 多圖批次萃取 ---
+def parse_feature_batch(response_content, count):
+    """
+    解析批次回傳，回傳長度為 count 的清單 (無法修補的圖片為 None)；
+    陣列缺失或長度不符時回傳 None，由呼叫端整批改為逐張萃取。
+    """
+    try:
+        parsed = json.loads(response_content.strip().replace('```json', '').replace('```', ''))
+    except json.JSONDecodeError:
+        parsed = _loads_lenient(response_content)
+    items = parsed.get("images") if isinstance(parsed, dict) else parsed
+    if not isinstance(items, list) or len(items) != count:
+        return None
+    results = []
+    for item in items:
+        data, missing, _ = salvage(json.dumps(item, ensure_ascii=False), FEATURE_SCHEMA)
+        results.append(None if missing or not isinstance(item, dict) else data)
+    return results
+
+def _prepare_batch(image_paths, count):
+    """
+    查詢批次快取，回傳 (assets, 快取鍵, 已有的結果)。
+    鍵使用設定的批次大小 (即使最後一批不足 count 張)，同樣設定重跑時即可命中。
+    """
+    prompt = batch_feature_prompt(count)
+    assets, keys, results = [], [], []
+    for image_path in image_paths:
+        asset, key, cached = _prepare_feature_request(image_path, prompt)
+        assets.append(asset)
+        keys.append(key)
+        results.append(cached)
+    return assets, keys, results
+
+def _chunks(indices, size):
+    return [indices[i:i + size] for i in range(0, len(indices), size)]
+
+def _batch_request(model, assets, chunk):
+    """組出一批圖片的 chat 參數；最後一批不足設定張數時，提示詞與格式依實際張數產生"""
+    count = len(chunk)
+    names = ", ".join(assets[i].filename for i in chunk)
+    print(f"正在呼叫 VLM 批次特徵萃取 ({model}，{count} 張): {names}...")
+    request = {
+        "model": model,
+        "messages": [{'role': 'user', 'content': batch_feature_prompt(count),
+                      'images': [assets[i].model_b64 for i in chunk]}],
+        "format": batch_feature_schema(count),
+    }
+    return count, names, request
+
+def _finish_batch(chunk, assets, keys, results, parsed):
+    """寫入批次結果並回傳需要改為逐張萃取的索引"""
+    if parsed is None:
+        BATCH_STATS["malformed"] += 1
+        return list(chunk)
+    fallback = []
+    for i, data in zip(chunk, parsed):
+        if data is None:
+            fallback.append(i)
+            continue
+        results[i] = data
+        vlm_cache.feature_cache.put(keys[i], data)
+    return fallback
+
+def get_features_batch(image_paths, batch_size=None):
+    """
+    以一次請求送出 batch_size 張圖片萃取特徵，回傳與 image_paths 對齊的特徵清單 (失敗者為 None)。
+    回傳陣列格式錯誤或長度不符時整批改為逐張呼叫；個別物件缺欄位時只有該張改為逐張呼叫。
+    batch_size 為 1 時等同逐張呼叫 get_features_from_vlm。
+    """
+    batch_size = batch_size or FEATURE_BATCH_SIZE
+    if batch_size <= 1:
+        return [get_features_from_vlm(image_path) for image_path in image_paths]
+
+    model = model_routing.model_for('features')
+    assets, keys, results = _prepare_batch(image_paths, batch_size)
+    pending = [i for i, cached in enumerate(results) if cached is None]
+    for i in range(len(results)):
+        if results[i] is not None:
+            print(f"快取命中，略過 VLM 特徵萃取: {assets[i].filename}")
+
+    fallback = []
+    for chunk in _chunks(pending, batch_size):
+        count, names, request = _batch_request(model, assets, chunk)
+        parsed = None
+        with pipeline_metrics.batch(f"特徵批次 x{count}: {names}"):
+            try:
+                response = pipeline_metrics.timed_chat('features', ollama_pool.chat, policy='features_batch',
+                                                       **request)
+                parsed = parse_feature_batch(response['message']['content'], count)
+            except Exception as e:
+                print(f"VLM 批次特徵萃取時發生錯誤: {e}")
+        BATCH_STATS["batches"] += 1
+        BATCH_STATS["images"] += count
+        fallback += _finish_batch(chunk, assets, keys, results, parsed)
+
+    if fallback:
+        BATCH_STATS["fallback_images"] += len(fallback)
+        print(f"{len(fallback)} 張圖片的批次結果無法使用，改為逐張萃取...")
+        for i in fallback:
+            results[i] = get_features_from_vlm(assets[i])
+    return results
+
+async def get_features_batch_async(image_paths, client, batch_size=None):
+    """get_features_batch 的非同步版本，各批次同時送出"""
+    batch_size = batch_size or FEATURE_BATCH_SIZE
+    if batch_size <= 1:
+        return list(await asyncio.gather(*(get_features_from_vlm_async(path, client) for path in image_paths)))
+
+    model = model_routing.model_for('features')
+    assets, keys, results = _prepare_batch(image_paths, batch_size)
+    pending = [i for i, cached in enumerate(results) if cached is None]
+
+    async def run_chunk(chunk):
+        count, names, request = _batch_request(model, assets, chunk)
+        parsed = None
+        with pipeline_metrics.batch(f"特徵批次 x{count}: {names}"):
+            try:
+                response = await pipeline_metrics.timed_chat_async('features', client.chat, policy='features_batch',
+                                                                    **request)
+                parsed = parse_feature_batch(response['message']['content'], count)
+            except Exception as e:
+                print(f"VLM 批次特徵萃取時發生錯誤: {e}")
+        BATCH_STATS["batches"] += 1
+        BATCH_STATS["images"] += count
+        fallback = _finish_batch(chunk, assets, keys, results, parsed)
+        if fallback:
+            BATCH_STATS["fallback_images"] += len(fallback)
+            print(f"{len(fallback)} 張圖片的批次結果無法使用，改為逐張萃取...")
+            singles = await asyncio.gather(*(get_features_from_vlm_async(assets[i], client) for i in fallback))
+            for i, data in zip(fallback, singles):
+                results[i] = data
+
+    await asyncio.gather(*(run_chunk(chunk) for chunk in _chunks(pending, batch_size)))
+    return results
+
+def _split_combined(data):
+    """將合併模式的資料拆成 {"features": {...}, "prelim_judgment": "..."}"""
+    data = dict(data)
+    prelim_judgment = str(data.pop("PreliminaryJudgment", "鑑定失敗")).strip().replace("\"", "")
+    return {"features": data, "prelim_judgment": prelim_judgment}
+
+def parse_combined(response_content):
+    """將合併模式的回傳解析為 {"features": {...}, "prelim_judgment": "..."}"""
+    return _split_combined(parse_features(response_content))
+
+def get_features_and_judgment(image_path):
+    """
+    合併模式：以一次 VLM 呼叫同時取得 8 項特徵分數與初步品種意見。
+    回傳 {"features": {...}, "prelim_judgment": "..."}，失敗時回傳 None。
+    """
+    data = _extract(image_path, COMBINED_PROMPT, COMBINED_SCHEMA, 'combined', "合併萃取")
+    if data is None:
+        return None
+    result = _split_combined(data)
+    print(f"VLM 合併萃取完成，初步意見為: {result['prelim_judgment']}")
+    return result
+
+async def get_features_and_judgment_async(image_path, client):
+    """get_features_and_judgment 的非同步版本，使用傳入的 ollama.AsyncClient"""
+    data = await _extract_async(image_path, COMBINED_PROMPT, COMBINED_SCHEMA, 'combined', "合併萃取", client)
+    if data is None:
         return None
+    return _split_combined(data)
@@ -0,0 +1,158 @@
+# watch_folder.py (監看圖片資料夾：增量掃描新到的圖片，供常駐服務模式逐張送入處理佇列)
+
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # 非 Linux 或未安裝 inotify_simple 時改以定期掃描偵測新檔
+    INotify = None
+    inotify_flags = None
+
+POLL_INTERVAL_S = 1.0
+# 檔案最後修改後需靜置多久才視為上傳完成 (避免讀到寫到一半的檔案)
+SETTLE_S = 1.0
+# 每隔多久完整重掃一次，補上「原地覆寫」這類不會改變資料夾 mtime 的變更
+FULL_RESCAN_S = 300.0
+# 同一版本 (大小與 mtime 相同) 的圖片處理失敗時最多嘗試幾次；檔案再次變更後重新計算
+MAX_ATTEMPTS = 3
+
+
+class FolderScanner:
+    """
+    以 os.scandir 增量掃描 root 下所有子資料夾，poll() 每次只回傳新出現或內容變更、且已寫完的圖片。
+    只有 mtime 改變 (有檔案新增、刪除或改名)、仍有檔案在寫入中、或 inotify 回報有事件的資料夾
+    才會重新列出檔案；其餘資料夾只檢查 mtime。可用 inotify_simple 時以 inotify 事件即時喚醒。
+    """
+
+    def __init__(self, root, extensions, settle_s=SETTLE_S, use_inotify=True, max_attempts=MAX_ATTEMPTS):
+        self.root = root
+        self.extensions = tuple(extensions)
+        self.settle_s = settle_s
+        self.max_attempts = max_attempts
+        self.seen = {}       # 已回傳的圖片 -> (大小, mtime_ns)
+        self.failures = {}   # 處理失敗的圖片 -> ((大小, mtime_ns), 失敗次數)
+        self.settling = {}   # 資料夾 -> 仍在寫入中的圖片集合
+        self.dirs = {}       # 資料夾 -> (mtime_ns, 子資料夾清單)
+        self.dirty = set()   # inotify 回報有事件或有圖片待重試、下次必須重新列出的資料夾
+        self.scans = 0
+        self.listed_dirs = 0
+        self._last_full_scan = 0.0
+        self._inotify = INotify() if (use_inotify and INotify is not None) else None
+        self._watches = {}   # inotify watch descriptor -> 資料夾
+
+    @property
+    def mode(self):
+        return "inotify" if self._inotify is not None else "定期掃描"
+
+    def _watch(self, dirpath):
+        if self._inotify is None or dirpath in self._watches.values():
+            return
+        mask = (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE
+                | inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+        try:
+            self._watches[self._inotify.add_watch(dirpath, mask)] = dirpath
+        except OSError as e:
+            print(f"無法以 inotify 監看 {dirpath}，改以定期掃描: {e}")
+
+    def _scan_dir(self, dirpath, force, now, found):
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            self.dirs.pop(dirpath, None)
+            self.settling.pop(dirpath, None)
+            return
+        known = self.dirs.get(dirpath)
+        if (not force and known is not None and known[0] == mtime_ns
+                and dirpath not in self.dirty and not self.settling.get(dirpath)):
+            # 資料夾本身沒有變化：只需往下檢查子資料夾
+            for subdir in known[1]:
+                self._scan_dir(subdir, force, now, found)
+            return
+
+        self.dirty.discard(dirpath)
+        self.listed_dirs += 1
+        self._watch(dirpath)
+        subdirs, settling = [], set()
+        try:
+            entries = sorted(os.scandir(dirpath), key=lambda entry: entry.name)
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(self.extensions):
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            if self.seen.get(entry.path) == key:
+                continue
+            if stat.st_size == 0 or now - stat.st_mtime < self.settle_s:
+                settling.add(entry.path)
+                continue
+            self.seen[entry.path] = key
+            found.append((entry.path, stat.st_mtime))
+        self.dirs[dirpath] = (mtime_ns, subdirs)
+        self.settling[dirpath] = settling
+        for subdir in subdirs:
+            self._scan_dir(subdir, force, now, found)
+
+    def scan(self, force=False):
+        """
+        掃描一次，回傳 [(圖片路徑, 檔案 mtime), ...]，依路徑排序 (與 batch_numeric 的處理順序一致)。
+        force=True 或距上次完整掃描超過 FULL_RESCAN_S 時重新列出所有資料夾。
+        """
+        now = time.time()
+        if now - self._last_full_scan >= FULL_RESCAN_S:
+            force = True
+            self._last_full_scan = now
+        found = []
+        if os.path.isdir(self.root):
+            self._scan_dir(self.root, force, now, found)
+        self.scans += 1
+        return sorted(found)
+
+    def forget(self, path):
+        """
+        圖片處理失敗時呼叫，讓下次掃描再回傳一次；同一版本的檔案最多嘗試 max_attempts 次，
+        之後直到檔案再次變更前不再回傳。回傳 True 表示會重試。
+        """
+        key = self.seen.get(path)
+        if key is None:
+            return False
+        failed_key, attempts = self.failures.get(path, (key, 0))
+        attempts = attempts + 1 if failed_key == key else 1
+        self.failures[path] = (key, attempts)
+        if attempts >= self.max_attempts:
+            return False
+        del self.seen[path]
+        # 資料夾 mtime 沒有變化，標記為需重新列出才會再掃到這個檔案
+        self.dirty.add(os.path.dirname(path))
+        return True
+
+    def wait(self, timeout):
+        """等待下一次掃描的時機：有 inotify 時事件一到即返回，否則固定睡 timeout 秒"""
+        if self._inotify is None:
+            time.sleep(timeout)
+            return
+        if any(self.settling.values()):
+            # 仍有寫入中的檔案時不能只等事件：靜置時間一到就要再掃一次
+            timeout = min(timeout, self.settle_s)
+        for event in self._inotify.read(timeout=int(timeout * 1000)):
+            dirpath = self._watches.get(event.wd)
+            if dirpath is not None:
+                self.dirty.add(dirpath)
+
+    def poll(self, timeout=POLL_INTERVAL_S):
+        """等待後掃描一次，回傳新到的圖片"""
+        self.wait(timeout)
+        return self.scan()
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None